@@ -1,28 +1,43 @@
 #!/usr/bin/env python
 import os
+import io
+import csv
 import sys
 import json
+import gzip
 import configparser
-import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-from urllib.parse import urlparse
+from urllib.parse import urljoin
 from loguru import logger
 import time
 import random
+import functools
+from dataclasses import dataclass
 from tabulate import tabulate
-from collections import defaultdict
+from collections import defaultdict, deque, Counter
 import concurrent.futures
 import threading
 import multiprocessing
+import queue
+from psycopg2.extras import execute_values, RealDictCursor
+
+# Сжатие сырого HTML перед сохранением в БД
+import lz4.frame
 
 # Импорт библиотек для извлечения контента
 import trafilatura
+from trafilatura.settings import use_config
+from lxml import etree
+from lxml import html as lxml_html
 
 # Константы
 NUM_PAGES_FROM_DOMAIN = 5000  # Максимальное количество страниц с одного домена
 CONFIG_PATH = "config/config.ini"
 COOKIES_DIR = "cookies"  # Директория с файлами cookie
+COOKIE_FILE_EXTENSIONS = ('.json.gz', '.json')  # Расширения файлов cookie (сжатые и старые несжатые)
 LOGS_DIR = "logs"  # Директория для логов
 MAX_RETRIES = 3  # Максимальное количество повторных попыток
 MAX_WORKERS = 50  # Максимальное количество параллельных потоков
@@ -30,6 +45,46 @@ MAX_CONCURRENT_PER_DOMAIN = 5 # Максимальное количество п
 MAX_REDIRECTS = 5  # Максимальное количество редиректов
 REQUEST_TIMEOUT = 40  # Таймаут запросов в секундах
 N_JOBS = max(1, multiprocessing.cpu_count() - 1)  # Количество процессов для параллельной обработки (оставляем 1 ядро для системы)
+WRITE_BATCH_SIZE = 500  # Количество строк, записываемых в БД одним запросом
+WRITE_FLUSH_INTERVAL = 5  # Максимальное время ожидания новых строк перед записью накопленных (в секундах)
+CURSOR_ITERSIZE = 10000  # Количество строк, получаемых серверным курсором за один запрос
+LIMITER_MIN_DELAY = 0.05  # Минимальная пауза перед запросом к домену в секундах
+LIMITER_MAX_DELAY = 5  # Максимальная пауза перед запросом к домену в секундах
+LIMITER_SLOW_RESPONSE = 5  # Время ответа в секундах, после которого сервер считается перегруженным
+MAX_PAGE_BYTES = 4 * 1024 * 1024  # Максимальный размер загружаемой страницы в байтах
+HTML_CONTENT_TYPES = {'text/html', 'application/xhtml+xml'}  # Допустимые типы контента страниц
+LOG_PER_PAGE = False  # Логировать каждую обработанную страницу (иначе только сводка каждые LOG_PROGRESS_EVERY страниц)
+LOG_PROGRESS_EVERY = 1000  # Периодичность вывода сводки о ходе обработки (в страницах)
+
+# Стандартные HTTP заголовки, общие для всех сессий
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'Cache-Control': 'max-age=0'
+}
+
+# Пул подключений к БД, общий для всех потоков процесса
+db_pool = None
+
+# Страницы, которые не удалось загрузить; флаг ошибки устанавливается одним запросом после этапа
+failed_page_ids = []
+failed_page_ids_lock = threading.Lock()
+
+# HTTP-сессии по доменам для переиспользования соединений (keep-alive)
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+# Адаптивные ограничители частоты запросов по доменам
+domain_limiters = {}
+domain_limiters_lock = threading.Lock()
+
+# Конфигурация Trafilatura, создается один раз при загрузке модуля
+TRAFILATURA_CONFIG = use_config()
+TRAFILATURA_CONFIG.set("DEFAULT", "MIN_OUTPUT_SIZE", "0")
+TRAFILATURA_CONFIG.set("DEFAULT", "EXTRACTION_TIMEOUT", "10")
 
 # Статистика выполнения
 stats = {
@@ -46,6 +101,14 @@ stats = {
     }
 }
 
+@dataclass(slots=True)
+class PageRec:
+    """Страница для загрузки сырого контента"""
+    id_page: int
+    page_url: str
+    domain: str
+    publication_date: datetime | None
+
 # ---------------------------------------------------
 # Настройка и конфигурация
 # ---------------------------------------------------
@@ -74,7 +137,11 @@ def setup_logging():
         format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {line} : {message}",
         level="INFO",
         rotation="1 day",
-        retention=10
+        retention=10,
+        # Запись в файл выполняется в фоновом потоке и не блокирует рабочие потоки
+        enqueue=True,
+        backtrace=False,
+        diagnose=False
     )
 
     return logger
@@ -96,11 +163,24 @@ def load_config(config_path=CONFIG_PATH):
 # Функции для извлечения контента
 # ---------------------------------------------------
 
-def extract_content(html_content):
-    """Извлечение контента с помощью библиотеки Trafilatura"""
+def extract_content(html_content, url=None):
+    """
+    Извлечение контента с помощью библиотеки Trafilatura.
+    Выполняется в отдельном процессе, поэтому статистику не изменяет
+    """
+    # Заранее удаляем скрипты и стили, чтобы Trafilatura обходила дерево меньшего размера.
+    # Если HTML не удалось разобрать, передаем исходную строку
+    try:
+        document = lxml_html.fromstring(html_content)
+        etree.strip_elements(document, 'script', 'style', 'noscript', with_tail=False)
+    except (etree.ParserError, ValueError):
+        document = html_content
+
     # Извлекаем основной контент
     extracted_text = trafilatura.extract(
-        html_content,
+        document,
+        url=url,
+        config=TRAFILATURA_CONFIG,
         favor_precision=True,
         include_links=False,
         include_images=False,
@@ -110,31 +190,41 @@ def extract_content(html_content):
         deduplicate=True
     )
 
-    if not extracted_text:
-        stats['parser_stats']['trafilatura']['failed'] += 1
-        return None
+    return extracted_text or None
 
-    stats['parser_stats']['trafilatura']['success'] += 1
-    return extracted_text
+def extract_compressed_content(raw_lz4, url=None):
+    """Распаковка сжатого LZ4 сырого HTML и извлечение из него контента"""
+    html_content = lz4.frame.decompress(raw_lz4).decode('utf-8', errors='replace')
+    return extract_content(html_content, url)
 
 # ---------------------------------------------------
 # Функции для работы с базой данных
 # ---------------------------------------------------
 
-def get_db_connection(db_config):
-    """Создание подключения к базе данных"""
-    conn = psycopg2.connect(
+def init_db_pool(db_config):
+    """Создание пула подключений к базе данных, общего для всех потоков"""
+    global db_pool
+    db_pool = ThreadedConnectionPool(
+        2,
+        MAX_WORKERS + 2,  # рабочие потоки + поток записи + основной поток
         host=db_config['host'],
         port=db_config['port'],
         dbname=db_config['dbname'],
         user=db_config['user'],
         password=db_config['password']
     )
-    return conn
+    return db_pool
+
+def close_db_pool():
+    """Закрытие всех подключений пула"""
+    global db_pool
+    if db_pool is not None:
+        db_pool.closeall()
+        db_pool = None
 
 def get_pages_for_raw_content(conn):
     """
-    Получение списка страниц для загрузки сырого контента
+    Получение страниц для загрузки сырого контента (генератор)
     Не более NUM_PAGES_FROM_DOMAIN страниц с одного домена,
     отсортированных по publication_date по убыванию
     """
@@ -153,7 +243,7 @@ def get_pages_for_raw_content(conn):
         LEFT JOIN
             news_pages_content npc ON np.id_page = npc.id_page
         WHERE
-            (npc.id_page IS NULL OR npc.page_raw_content IS NULL)
+            (npc.id_page IS NULL OR (npc.page_raw_content IS NULL AND npc.raw_lz4 IS NULL))
             AND np.is_error = FALSE
     )
     SELECT
@@ -170,28 +260,23 @@ def get_pages_for_raw_content(conn):
     """
 
     try:
-        with conn.cursor() as cursor:
+        # Серверный курсор отдает строки порциями, строки сразу преобразуются в компактные записи
+        with conn.cursor(name='raw_pages') as cursor:
+            cursor.itersize = CURSOR_ITERSIZE
             cursor.execute(query, (NUM_PAGES_FROM_DOMAIN,))
-            pages = cursor.fetchall()
-
-        # Преобразуем результат в список словарей для удобства
-        result = []
-        for page in pages:
-            result.append({
-                'id_page': page[0],
-                'page_url': page[1],
-                'domain': page[2],
-                'publication_date': page[3]
-            })
-
-        return result
+            for row in cursor:
+                yield PageRec(*row)
+
+        # Завершаем читающую транзакцию, чтобы соединение не оставалось в состоянии idle in transaction
+        conn.commit()
     except Exception as e:
+        conn.rollback()
         logger.error(f"Error fetching pages list for raw content: {e}")
         raise
 
 def get_pages_for_content_extraction(conn):
     """
-    Получение списка страниц для извлечения контента
+    Получение страниц для извлечения контента вместе с сырым HTML (генератор)
     Выбираются страницы, у которых есть сырой контент,
     но отсутствует контент
     """
@@ -200,7 +285,9 @@ def get_pages_for_content_extraction(conn):
         npc.id_page,
         COALESCE(npc.page_url, np.page_url) as page_url,
         s.domain,
-        COALESCE(npc.publication_date, np.publication_date) as publication_date
+        COALESCE(npc.publication_date, np.publication_date) as publication_date,
+        npc.page_raw_content,
+        npc.raw_lz4
     FROM
         news_pages_content npc
     JOIN
@@ -208,7 +295,7 @@ def get_pages_for_content_extraction(conn):
     JOIN
         sitemaps s ON np.id_sitemap = s.id_sitemap
     WHERE
-        npc.page_raw_content IS NOT NULL
+        (npc.page_raw_content IS NOT NULL OR npc.raw_lz4 IS NOT NULL)
         AND npc.content IS NULL
         AND np.is_error = FALSE
     ORDER BY
@@ -216,133 +303,130 @@ def get_pages_for_content_extraction(conn):
     """
 
     try:
-        with conn.cursor() as cursor:
+        # Серверный курсор отдает строки порциями, строки сразу возвращаются в виде словарей
+        with conn.cursor(name='extraction_pages', cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = CURSOR_ITERSIZE
             cursor.execute(query)
-            pages = cursor.fetchall()
-
-        # Преобразуем результат в список словарей для удобства
-        result = []
-        for page in pages:
-            result.append({
-                'id_page': page[0],
-                'page_url': page[1],
-                'domain': page[2],
-                'publication_date': page[3]
-            })
-
-        return result
+            yield from cursor
+
+        # Завершаем читающую транзакцию, чтобы соединение не оставалось в состоянии idle in transaction
+        conn.commit()
     except Exception as e:
+        conn.rollback()
         logger.error(f"Error fetching pages list for content extraction: {e}")
         raise
 
-def save_raw_content_to_db(conn, content_info):
-    """Сохранение сырого контента страницы в базу данных"""
+def save_raw_content_to_db(conn, rows):
+    """
+    Пакетное сохранение сырого контента страниц в базу данных.
+    Строки загружаются через COPY во временную таблицу,
+    откуда переносятся в news_pages_content одним запросом.
+    Сырой HTML сохраняется сжатым LZ4 в колонку raw_lz4
+    """
+    if not rows:
+        return True
+
+    create_query = """
+    CREATE TEMP TABLE tmp_news_pages_content (
+        id_page integer,
+        page_url text,
+        publication_date timestamptz,
+        raw_lz4 bytea
+    ) ON COMMIT DROP
+    """
+
     insert_query = """
     INSERT INTO news_pages_content
-        (id_page, page_url, publication_date, page_raw_content)
-    VALUES
-        (%s, %s, %s, %s)
+        (id_page, page_url, publication_date, raw_lz4)
+    SELECT
+        id_page, page_url, publication_date, raw_lz4
+    FROM
+        tmp_news_pages_content
     ON CONFLICT (id_page) DO UPDATE SET
         page_url = EXCLUDED.page_url,
         publication_date = EXCLUDED.publication_date,
-        page_raw_content = EXCLUDED.page_raw_content,
+        page_raw_content = NULL,
+        raw_lz4 = EXCLUDED.raw_lz4,
         fetched_at = NOW()
     """
 
+    # Формируем CSV в памяти (None записывается как пустое значение, т.е. NULL, bytea передается в hex-формате)
+    buffer = io.StringIO()
+    csv_writer = csv.writer(buffer)
+    for content_info in rows:
+        csv_writer.writerow([
+            content_info['id_page'],
+            content_info.get('page_url'),
+            content_info.get('publication_date'),
+            '\\x' + content_info['raw_lz4'].hex()
+        ])
+    buffer.seek(0)
+
     try:
         with conn.cursor() as cursor:
-            cursor.execute(
-                insert_query,
-                (
-                    content_info['id_page'],
-                    content_info.get('page_url'),
-                    content_info.get('publication_date'),
-                    content_info['page_raw_content']
-                )
+            cursor.execute(create_query)
+            cursor.copy_expert(
+                "COPY tmp_news_pages_content (id_page, page_url, publication_date, raw_lz4) FROM STDIN WITH (FORMAT csv)",
+                buffer
             )
+            cursor.execute(insert_query)
         conn.commit()
-        status = "successfully" if content_info['page_raw_content'] else "with error"
-        logger.debug(f"Raw content for page ID={content_info['id_page']} saved to DB {status}")
+        logger.debug(f"Raw content for {len(rows)} pages saved to DB")
         return True
     except Exception as e:
         conn.rollback()
-        logger.error(f"Error saving raw content to DB: {e}")
+        logger.error(f"Error saving raw content batch ({len(rows)} pages) to DB: {e}")
         return False
 
-def get_raw_content_from_db(conn, id_page):
-    """Получение сырого контента из базы данных"""
-    query = """
-    SELECT
-        page_raw_content,
-        content
-    FROM
-        news_pages_content
-    WHERE
-        id_page = %s
-    """
-
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute(query, (id_page,))
-            result = cursor.fetchone()
-
-        if not result:
-            logger.error(f"No raw content found for page ID={id_page}")
-            return None, None
-
-        return result[0], result[1]
-    except Exception as e:
-        logger.error(f"Error fetching raw content from DB: {e}")
-        return None, None
+def save_extracted_content_to_db(conn, rows):
+    """Пакетное сохранение извлеченного контента в базу данных"""
+    if not rows:
+        return True
 
-def save_extracted_content_to_db(conn, content_info):
-    """Сохранение извлеченного контента в базу данных"""
     update_query = """
-    UPDATE news_pages_content
+    UPDATE news_pages_content AS npc
     SET
-        content = %s
+        content = v.content
+    FROM (VALUES %s) AS v (id_page, content)
     WHERE
-        id_page = %s
+        npc.id_page = v.id_page
     """
 
+    values = [(content_info['id_page'], content_info.get('content')) for content_info in rows]
+
     try:
         with conn.cursor() as cursor:
-            cursor.execute(
-                update_query,
-                (
-                    content_info.get('content'),
-                    content_info['id_page']
-                )
-            )
+            execute_values(cursor, update_query, values, template="(%s::int, %s::text)", page_size=WRITE_BATCH_SIZE)
         conn.commit()
-        logger.info(f"Extracted content for page ID={content_info['id_page']} saved to DB")
+        logger.debug(f"Extracted content for {len(rows)} pages saved to DB")
         return True
     except Exception as e:
         conn.rollback()
-        logger.error(f"Error saving extracted content to DB: {e}")
+        logger.error(f"Error saving extracted content batch ({len(rows)} pages) to DB: {e}")
         return False
 
-def update_page_error_status(conn, id_page, is_error):
-    """Обновление статуса ошибки страницы в базе данных"""
+def flush_page_error_statuses(conn):
+    """Установка флага ошибки для всех накопленных неудачных страниц одним запросом"""
+    with failed_page_ids_lock:
+        page_ids = failed_page_ids[:]
+        failed_page_ids.clear()
+
+    if not page_ids:
+        return True
+
     update_query = """
     UPDATE news_pages
     SET
-        is_error = %s
+        is_error = TRUE
     WHERE
-        id_page = %s
+        id_page = ANY(%s)
     """
 
     try:
         with conn.cursor() as cursor:
-            cursor.execute(
-                update_query,
-                (
-                    is_error,
-                    id_page
-                )
-            )
+            cursor.execute(update_query, (page_ids,))
         conn.commit()
-        logger.info(f"Error status for page ID={id_page} updated to {is_error}")
+        logger.info(f"Error status set for {len(page_ids)} pages")
         return True
     except Exception as e:
         conn.rollback()
@@ -354,9 +438,16 @@ def update_page_error_status(conn, id_page, is_error):
 # ---------------------------------------------------
 
 def extract_domain_from_url(url):
-    """Извлечение домена из URL"""
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc
+    """Извлечение домена из URL без полного разбора через urlparse"""
+    # Хост начинается после схемы и заканчивается перед путем, параметрами или якорем
+    start = url.find('://')
+    start = 0 if start < 0 else start + 3
+    end = len(url)
+    for separator in '/?#':
+        position = url.find(separator, start, end)
+        if position >= 0:
+            end = position
+    domain = url[start:end]
 
     # Убираем префикс www. если он есть
     if domain.startswith('www.'):
@@ -364,113 +455,189 @@ def extract_domain_from_url(url):
 
     return domain
 
-def load_cookies(domain):
-    """Загрузка cookies для указанного домена, используя самый свежий файл"""
-    cookie_files = []
-
+@functools.lru_cache(maxsize=1)
+def get_cookie_files():
+    """
+    Однократное сканирование COOKIES_DIR.
+    Возвращает словарь {домен: имя самого свежего файла cookie}
+    """
     # Проверяем существование директории
     if not os.path.exists(COOKIES_DIR):
         logger.warning(f"Cookies directory not found: {COOKIES_DIR}")
-        return []
+        return {}
 
-    # Ищем все файлы для указанного домена
+    latest_files = {}
     for filename in os.listdir(COOKIES_DIR):
-        if filename.startswith(f"{domain}_") and filename.endswith('.json'):
-            cookie_files.append(filename)
+        extension = next((ext for ext in COOKIE_FILE_EXTENSIONS if filename.endswith(ext)), None)
+        if extension is None:
+            continue
 
-    if not cookie_files:
-        logger.warning(f"No cookie files found for domain: {domain}")
-        return []
+        # Извлекаем домен и дату из имени файла (формат domain_DD-MM-YYYY.json.gz или domain_DD-MM-YYYY.json)
+        domain, separator, date_str = filename[:-len(extension)].rpartition('_')
+        if not separator:
+            continue
 
-    # Парсим даты из имен файлов
-    date_files = []
-    for filename in cookie_files:
-        # Извлекаем дату из имени файла (формат domain_DD-MM-YYYY.json)
-        date_str = filename.replace(f"{domain}_", "").replace(".json", "")
         try:
             file_date = datetime.strptime(date_str, "%d-%m-%Y")
-            date_files.append((file_date, filename))
         except ValueError:
             logger.warning(f"Invalid date format in cookie file: {filename}")
             continue
 
-    if not date_files:
-        logger.warning(f"No valid cookie files with dates found for domain: {domain}")
-        return []
+        # Оставляем самый свежий файл для каждого домена
+        if domain not in latest_files or file_date > latest_files[domain][0]:
+            latest_files[domain] = (file_date, filename)
+
+    return {domain: filename for domain, (_, filename) in latest_files.items()}
+
+@functools.lru_cache(maxsize=256)
+def load_cookies(domain):
+    """
+    Загрузка cookies для указанного домена из самого свежего файла.
+    Возвращает словарь {имя: значение} для requests, файл читается один раз за запуск
+    """
+    latest_file = get_cookie_files().get(domain)
+    if not latest_file:
+        logger.warning(f"No cookie files found for domain: {domain}")
+        return {}
 
-    # Находим самый свежий файл
-    latest_file = max(date_files, key=lambda x: x[0])[1]
     cookie_path = os.path.join(COOKIES_DIR, latest_file)
 
     logger.debug(f"Using cookie file: {latest_file}")
 
     try:
-        with open(cookie_path, 'r') as f:
+        opener = gzip.open if latest_file.endswith('.gz') else open
+        with opener(cookie_path, 'rt') as f:
             cookies = json.load(f)
-        return cookies
+        return {cookie['name']: cookie['value'] for cookie in cookies}
     except (json.JSONDecodeError, IOError) as e:
         logger.error(f"Error loading cookie file {latest_file}: {e}")
-        return []
+        return {}
+
+class DomainLimiter:
+    """
+    Адаптивная пауза между запросами к домену.
+    Пауза растет при медленных ответах и ошибках 429/5xx и постепенно снижается, пока сервер отвечает нормально
+    """
 
-def cookies_to_dict(cookies_list):
-    """Преобразование списка cookies в словарь для requests"""
-    cookies_dict = {}
-    for cookie in cookies_list:
-        cookies_dict[cookie['name']] = cookie['value']
-    return cookies_dict
+    def __init__(self):
+        self.delay = 0.2
 
-def get_default_headers():
-    """Получение стандартных HTTP заголовков"""
-    return {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-        'Cache-Control': 'max-age=0'
-    }
+    def wait(self):
+        time.sleep(self.delay)
 
-def fetch_page_content(page_info, retry=0, redirect_count=0):
+    def on_result(self, latency, status_code):
+        if status_code is None or status_code == 429 or status_code >= 500 or latency > LIMITER_SLOW_RESPONSE:
+            self.delay = min(self.delay * 2, LIMITER_MAX_DELAY)
+        else:
+            self.delay = max(self.delay * 0.9, LIMITER_MIN_DELAY)
+
+def get_domain_limiter(domain):
+    """Получение ограничителя частоты запросов для домена"""
+    with domain_limiters_lock:
+        limiter = domain_limiters.get(domain)
+        if limiter is None:
+            limiter = domain_limiters[domain] = DomainLimiter()
+        return limiter
+
+class UnsupportedContentError(requests.exceptions.RequestException):
+    """Страница не является HTML или превышает допустимый размер, повторная загрузка не имеет смысла"""
+
+def read_html_content(response):
+    """Потоковое чтение тела ответа с проверкой типа контента и ограничением размера"""
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type and content_type not in HTML_CONTENT_TYPES:
+        raise UnsupportedContentError(f"Unsupported content type: {content_type}")
+
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit() and int(content_length) > MAX_PAGE_BYTES:
+        raise UnsupportedContentError(f"Page is too large: {content_length} bytes")
+
+    # Тело читается частями (уже распакованными из gzip/deflate), чтобы не держать в памяти гигантские страницы
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=65536):
+        body.extend(chunk)
+        if len(body) > MAX_PAGE_BYTES:
+            raise UnsupportedContentError(f"Page is too large: more than {MAX_PAGE_BYTES} bytes")
+
+    # Декодируем один раз, без повторного определения кодировки по содержимому
+    return body.decode(response.encoding or 'utf-8', errors='replace')
+
+def get_http_session(domain):
+    """
+    Получение HTTP-сессии для домена.
+    Сессия создается один раз: заголовки и cookies задаются при создании,
+    а соединения с сервером переиспользуются между запросами
+    """
+    with http_sessions_lock:
+        session = http_sessions.get(domain)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_PER_DOMAIN, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(DEFAULT_HEADERS)
+            session.cookies.update(load_cookies(domain))
+            http_sessions[domain] = session
+        return session
+
+def fetch_page_content(page_info):
     """Скачивание HTML-контента страницы с поддержкой повторных попыток и обработкой редиректов"""
-    url = page_info['page_url']
-    domain = page_info.get('domain')
-
-    # Если домен не указан, извлекаем его из URL
+    url = page_info.page_url
+    # Домен всегда приходит из БД вместе со страницей
+    domain = page_info.domain
     if not domain:
-        domain = extract_domain_from_url(url)
+        logger.error(f"Domain is missing for page {url}")
+        # Флаг ошибки в БД устанавливает вызывающая сторона
+        return {
+            'id_page': page_info.id_page,
+            'page_url': url,
+            'publication_date': page_info.publication_date,
+            'raw_lz4': None,
+            'content_size': 0,
+            'is_error': True
+        }
 
     # Сохраняем оригинальный домен для проверки редиректов
     original_domain = domain
 
-    # Загрузка cookies
-    cookies_list = load_cookies(domain)
-    cookies_dict = cookies_to_dict(cookies_list)
+    # Сессия с cookies и заголовками домена
+    session = get_http_session(domain)
+    limiter = get_domain_limiter(domain)
 
-    # Получение заголовков
-    headers = get_default_headers()
+    for attempt in range(MAX_RETRIES):
+        current_url = url
+
+        try:
+            # Запросы без автоматического следования редиректам, редиректы обрабатываются вручную
+            for redirect_count in range(MAX_REDIRECTS + 1):
+                limiter.wait()
+                started = time.monotonic()
+                try:
+                    response = session.get(
+                        current_url,
+                        timeout=REQUEST_TIMEOUT,
+                        allow_redirects=False,
+                        stream=True
+                    )
+                except requests.exceptions.RequestException:
+                    # Таймаут или обрыв соединения считаем признаком перегрузки сервера
+                    limiter.on_result(time.monotonic() - started, None)
+                    raise
+                limiter.on_result(time.monotonic() - started, response.status_code)
+
+                if not response.is_redirect or redirect_count == MAX_REDIRECTS:
+                    break
+
+                redirect_url = response.headers.get('Location')
+                if not redirect_url:
+                    break
+
+                # Тело редиректа не нужно, освобождаем соединение
+                response.close()
+
+                # Если ссылка относительная, преобразуем в абсолютную
+                redirect_url = urljoin(current_url, redirect_url)
 
-    try:
-        # Прямой запрос без автоматического следования редиректам
-        response = requests.get(
-            url,
-            cookies=cookies_dict,
-            headers=headers,
-            timeout=REQUEST_TIMEOUT,
-            allow_redirects=False
-        )
-
-        # Обработка редиректов вручную
-        if response.is_redirect and redirect_count < MAX_REDIRECTS:
-            redirect_url = response.headers.get('Location')
-
-            # Если ссылка относительная, преобразуем в абсолютную
-            if redirect_url and not redirect_url.startswith(('http://', 'https://')):
-                # Собираем полный URL для относительного редиректа
-                parsed_url = urlparse(url)
-                base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-                redirect_url = f"{base_url}{redirect_url if redirect_url.startswith('/') else '/' + redirect_url}"
-
-            if redirect_url:
                 # Проверяем домен редиректа
                 redirect_domain = extract_domain_from_url(redirect_url)
 
@@ -481,155 +648,140 @@ def fetch_page_content(page_info, retry=0, redirect_count=0):
                 )
 
                 if not allowed_redirect:
-                    logger.warning(f"Заблокирован редирект на другой домен: {url} -> {redirect_url} ({original_domain} -> {redirect_domain})")
+                    logger.warning(f"Заблокирован редирект на другой домен: {current_url} -> {redirect_url} ({original_domain} -> {redirect_domain})")
                     # Возвращаем ошибку, не следуем редиректу на другой домен
                     raise requests.exceptions.InvalidURL(f"Редирект на другой домен не разрешен: {redirect_domain}")
 
-                logger.debug(f"Редирект {redirect_count+1}/{MAX_REDIRECTS}: {url} -> {redirect_url}")
-
-                # Создаем новый page_info с обновленным URL
-                new_page_info = page_info.copy()
-                new_page_info['page_url'] = redirect_url
-
-                # Увеличиваем счетчик редиректов и рекурсивно делаем запрос
-                return fetch_page_content(new_page_info, retry, redirect_count + 1)
+                logger.debug(f"Редирект {redirect_count+1}/{MAX_REDIRECTS}: {current_url} -> {redirect_url}")
+                current_url = redirect_url
 
-        # Если был 3xx/4xx/5xx статус, но не редирект
-        response.raise_for_status()
+            # Если был 3xx/4xx/5xx статус, но не редирект
+            with response:
+                response.raise_for_status()
+                html_content = read_html_content(response)
 
-        html_content = response.text
-
-        # Создаем базовый результат
-        result = {
-            'id_page': page_info['id_page'],
-            'page_url': page_info['page_url'],
-            'publication_date': page_info.get('publication_date'),
-            'page_raw_content': html_content,
-            'content_size': len(html_content)
-        }
+            # Создаем базовый результат
+            result = {
+                'id_page': page_info.id_page,
+                'page_url': current_url,
+                'publication_date': page_info.publication_date,
+                # Быстрое сжатие в рабочем потоке уменьшает объем передаваемых в БД данных
+                'raw_lz4': lz4.frame.compress(html_content.encode('utf-8'), compression_level=1),
+                'content_size': len(html_content)
+            }
 
-        return result
-    except requests.exceptions.RequestException as e:
-        # Если не превышено максимальное количество попыток, пробуем снова
-        if retry < MAX_RETRIES - 1:
-            logger.warning(f"Error loading {url}, attempt {retry + 1}/{MAX_RETRIES}: {e}")
-            # Экспоненциальная задержка с небольшой случайностью
-            delay = (2 ** retry) + random.uniform(0, 1)
-            time.sleep(delay)
-            return fetch_page_content(page_info, retry + 1, redirect_count)
-
-        logger.error(f"Failed to load page {url} after {MAX_RETRIES} attempts: {e}")
-
-        # Устанавливаем флаг ошибки для этой страницы в базе данных
-        config = load_config()
-        conn = get_db_connection(config)
-        update_page_error_status(conn, page_info['id_page'], True)
-        conn.close()
-
-        return {
-            'id_page': page_info['id_page'],
-            'page_url': page_info['page_url'],
-            'publication_date': page_info.get('publication_date'),
-            'page_raw_content': None,
-            'content_size': 0,
-            'is_error': True
-        }
+            return result
+        except UnsupportedContentError as e:
+            logger.warning(f"Skipping page {url}: {e}")
+            break
+        except requests.exceptions.RequestException as e:
+            # Если не превышено максимальное количество попыток, пробуем снова
+            if attempt < MAX_RETRIES - 1:
+                logger.warning(f"Error loading {url}, attempt {attempt + 1}/{MAX_RETRIES}: {e}")
+                # Экспоненциальная задержка с небольшой случайностью
+                delay = (2 ** attempt) + random.uniform(0, 1)
+                time.sleep(delay)
+                continue
+
+            logger.error(f"Failed to load page {url} after {MAX_RETRIES} attempts: {e}")
+
+    # Флаг ошибки в БД устанавливает вызывающая сторона
+    return {
+        'id_page': page_info.id_page,
+        'page_url': page_info.page_url,
+        'publication_date': page_info.publication_date,
+        'raw_lz4': None,
+        'content_size': 0,
+        'is_error': True
+    }
 
 # ---------------------------------------------------
 # Функции для обработки страниц и многопоточности
 # ---------------------------------------------------
 
-def process_page_raw_content(page, db_config):
-    """Загрузка и сохранение сырого контента страницы"""
-    # Создаем отдельное подключение для каждого потока
-    conn = get_db_connection(db_config)
-
-    # Скачивание контента
-    content_info = fetch_page_content(page)
-
-    # Сохранение контента в БД
-    if content_info and 'id_page' in content_info:
-        success = save_raw_content_to_db(conn, content_info)
-        domain = page['domain']
-
-        # Обновляем статистику
-        if success and content_info['page_raw_content']:
-            stats['successful_raw_pages'] += 1
-            stats['domains_stats'][domain]['success'] += 1
-            content_size = content_info['content_size']
-            stats['total_content_size'] += content_size
-            stats['domains_stats'][domain]['size'] += content_size
-        else:
-            stats['failed_raw_pages'] += 1
-            stats['domains_stats'][domain]['failed'] += 1
+def db_writer_thread(write_queue, save_func):
+    """
+    Запись результатов в БД пачками по WRITE_BATCH_SIZE строк.
+    Строки поступают из очереди, None в очереди означает завершение работы
+    """
+    conn = db_pool.getconn()
+    rows = []
 
-            # Если установлен флаг ошибки, обновим статус в БД
-            if content_info.get('is_error', False):
-                update_page_error_status(conn, content_info['id_page'], True)
+    try:
+        while True:
+            try:
+                row = write_queue.get(timeout=WRITE_FLUSH_INTERVAL)
+            except queue.Empty:
+                # Новых строк нет - записываем то, что уже накопилось
+                save_func(conn, rows)
+                rows = []
+                continue
+
+            if row is None:
+                break
+
+            rows.append(row)
+            if len(rows) >= WRITE_BATCH_SIZE:
+                save_func(conn, rows)
+                rows = []
+
+        # Записываем остаток
+        save_func(conn, rows)
+    finally:
+        db_pool.putconn(conn)
+
+def start_db_writer(save_func):
+    """Запуск потока записи в БД, возвращает очередь и поток"""
+    write_queue = queue.Queue(maxsize=WRITE_BATCH_SIZE * 4)
+    writer = threading.Thread(target=db_writer_thread, args=(write_queue, save_func), daemon=True)
+    writer.start()
+    return write_queue, writer
+
+def stop_db_writer(write_queue, writer):
+    """Остановка потока записи в БД с записью оставшихся строк"""
+    write_queue.put(None)
+    writer.join()
+
+def update_raw_page_stats(domain, success, content_size):
+    """
+    Обновление статистики скачивания страницы.
+    Вызывается только из потока, собирающего результаты, поэтому блокировки не нужны
+    """
+    domain_stats = stats['domains_stats'][domain]
+    if success:
+        stats['successful_raw_pages'] += 1
+        stats['total_content_size'] += content_size
+        domain_stats['success'] += 1
+        domain_stats['size'] += content_size
     else:
-        success = False
         stats['failed_raw_pages'] += 1
-        domain = page['domain']
-        stats['domains_stats'][domain]['failed'] += 1
-
-    # Закрытие соединения
-    conn.close()
-
-    # Случайная задержка между запросами для снижения нагрузки на сервер
-    time.sleep(random.uniform(0.5, 2.0))
-
-    return success
-
-def process_page_content_extraction(page, db_config):
-    """Извлечение контента из сырого HTML и сохранение в БД"""
-    # Создаем отдельное подключение для каждого потока
-    conn = get_db_connection(db_config)
-
-    # Получаем сырой контент и текущие значения
-    raw_content, current_content = get_raw_content_from_db(conn, page['id_page'])
+        domain_stats['failed'] += 1
 
-    if not raw_content:
-        logger.error(f"No raw content found for page ID={page['id_page']}")
-        conn.close()
-        return False
-
-    # Готовим словарь с извлеченным контентом
-    extracted_content = {}
-
-    # Проверяем и извлекаем контент, если нужно
-    if current_content is None:
-        content = extract_content(raw_content)
-        extracted_content['content'] = content
-        stats['parser_stats']['trafilatura']['parsed'] += 1 if content else 0
+def process_page_raw_content(page, write_queue):
+    """
+    Загрузка сырого контента страницы и передача его в поток записи в БД.
+    Возвращает признак успеха и размер контента для статистики
+    """
+    # Скачивание контента
+    content_info = fetch_page_content(page)
+    success = False
+    content_size = 0
 
-    # Если есть что сохранять, сохраняем
-    if extracted_content:
-        extracted_content['id_page'] = page['id_page']
-        success = save_extracted_content_to_db(conn, extracted_content)
+    if content_info.get('is_error', False):
+        # Флаг ошибки устанавливается для всех неудачных страниц после завершения этапа
+        with failed_page_ids_lock:
+            failed_page_ids.append(content_info['id_page'])
     else:
-        logger.info(f"No content to extract for page ID={page['id_page']}")
-        success = True
+        # Сохранение контента в БД выполняет поток записи
+        write_queue.put(content_info)
+        success = bool(content_info['content_size'])
 
-    # Закрытие соединения
-    conn.close()
+        if success:
+            content_size = content_info['content_size']
 
-    return success
+    return success, content_size
 
-def process_content_extraction_batch(pages_batch, db_config_dict):
-    """Обработка пачки страниц для извлечения контента в отдельном процессе"""
-    results = []
-    # Преобразуем db_config_dict обратно в объект для использования с psycopg2
-    for page in pages_batch:
-        try:
-            success = process_page_content_extraction(page, db_config_dict)
-            results.append(success)
-            logger.info(f"Extracted content for page ID={page['id_page']} ({page['page_url']})")
-        except Exception as e:
-            logger.error(f"Error extracting content for page ID={page['id_page']}: {e}")
-            results.append(False)
-    return results
-
-def process_pages(pages, process_func, db_config, use_multiprocessing=False):
+def process_pages(pages, process_func, use_multiprocessing=False):
     """
     Параллельная обработка страниц с использованием ThreadPoolExecutor
     или ProcessPoolExecutor в зависимости от параметра use_multiprocessing
@@ -637,107 +789,154 @@ def process_pages(pages, process_func, db_config, use_multiprocessing=False):
 
     # Если мультипроцессорная обработка не требуется или это функция скачивания контента
     if not use_multiprocessing or process_func == process_page_raw_content:
-        return process_pages_threaded(pages, process_func, db_config)
+        return process_pages_threaded(pages, process_func)
     else:
         # Используем мультипроцессорную обработку для извлечения контента
-        return process_pages_multiprocessing(pages, db_config)
+        return process_pages_multiprocessing(pages, process_func)
 
-def process_pages_threaded(pages, process_func, db_config):
+def process_pages_threaded(pages, process_func):
     """Параллельная обработка страниц с использованием ThreadPoolExecutor"""
     results = []
 
     # Распределение страниц по доменам для управления параллелизмом
     domain_pages = defaultdict(list)
     for page in pages:
-        domain_pages[page['domain']].append(page)
+        domain_pages[page.domain].append(page)
 
     logger.info(f"Starting to process {len(pages)} pages from {len(domain_pages)} different domains using threads")
 
-    # Блокировка для безопасного обновления счетчиков
-    domain_lock = threading.Lock()
-
-    # Используем словарь для отслеживания числа параллельных запросов к домену
-    domain_counters = {domain: 0 for domain in domain_pages.keys()}
+    # Поток, записывающий результаты в БД пачками
+    write_queue, writer = start_db_writer(save_raw_content_to_db)
 
     def wrapped_process_func(page):
-        domain = page['domain']
-
-        # Атомарно увеличиваем счетчик запросов для домена
-        with domain_lock:
-            if domain_counters[domain] >= MAX_CONCURRENT_PER_DOMAIN:
-                # Если достигнут лимит для домена, задержка
-                logger.debug(f"Waiting for domain {domain} (active {domain_counters[domain]})")
-                time.sleep(random.uniform(0.5, 1.5))
-
-            # Увеличиваем счетчик текущих запросов к домену
-            domain_counters[domain] += 1
-
         try:
             # Обрабатываем страницу
-            result = process_func(page, db_config)
+            result = process_func(page, write_queue)
             return result
         except Exception as e:
-            logger.error(f"Error processing page {page['page_url']}: {e}")
-            return False
-        finally:
-            # Атомарно уменьшаем счетчик запросов для домена
-            with domain_lock:
-                domain_counters[domain] -= 1
-
-    # Создаем плоский список всех страниц для обработки
-    all_pages = []
-    for domain_pages_list in domain_pages.values():
-        all_pages.extend(domain_pages_list)
-
-    # Перемешиваем страницы для более равномерного распределения доменов
-    random.shuffle(all_pages)
-
-    # Обрабатываем все страницы параллельно с учетом ограничений
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Запускаем выполнение для всех страниц
-        futures = {executor.submit(wrapped_process_func, page): page for page in all_pages}
+            logger.error(f"Error processing page {page.page_url}: {e}")
+            return False, 0
 
-        for future in concurrent.futures.as_completed(futures):
-            page = futures[future]
-            try:
-                result = future.result()
-                results.append(result)
-                logger.info(f"Done page: {page['page_url']}")
-            except Exception as e:
-                logger.error(f"Error collecting result for {page['page_url']}: {e}")
-                results.append(False)
+    # Очереди страниц по доменам и число выполняемых задач каждого домена.
+    # В ready_domains находятся домены, у которых есть страницы и свободный слот
+    domain_queues = {domain: deque(domain_pages_list) for domain, domain_pages_list in domain_pages.items()}
+    ready_domains = deque(domain_queues)
+    in_flight = Counter()
+    futures = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        def submit_ready_pages():
+            # Домены обходятся по кругу, пока есть свободные потоки
+            while ready_domains and len(futures) < MAX_WORKERS:
+                domain = ready_domains.popleft()
+                page = domain_queues[domain].popleft()
+                futures[executor.submit(wrapped_process_func, page)] = page
+                in_flight[domain] += 1
+
+                if domain_queues[domain] and in_flight[domain] < MAX_CONCURRENT_PER_DOMAIN:
+                    ready_domains.append(domain)
+
+        submit_ready_pages()
+
+        # Новая страница отправляется сразу после завершения любой задачи
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                page = futures.pop(future)
+                domain = page.domain
+                try:
+                    success, content_size = future.result()
+                    if LOG_PER_PAGE:
+                        logger.info(f"Done page: {page.page_url}")
+                except Exception as e:
+                    logger.error(f"Error collecting result for {page.page_url}: {e}")
+                    success, content_size = False, 0
+
+                # Статистика обновляется только здесь, в одном потоке
+                update_raw_page_stats(domain, success, content_size)
+                results.append(success)
+
+                if len(results) % LOG_PROGRESS_EVERY == 0:
+                    logger.info(f"Fetched {len(results)}/{len(pages)} pages, successful: {stats['successful_raw_pages']}")
+
+                # Домен, упиравшийся в лимит, снова может получить задачу
+                in_flight[domain] -= 1
+                if domain_queues[domain] and in_flight[domain] == MAX_CONCURRENT_PER_DOMAIN - 1:
+                    ready_domains.append(domain)
+
+            submit_ready_pages()
+
+    # Дожидаемся записи оставшихся результатов
+    stop_db_writer(write_queue, writer)
 
     return results
 
-def process_pages_multiprocessing(pages, db_config):
-    """Параллельная обработка страниц с использованием ProcessPoolExecutor"""
+def process_pages_multiprocessing(pages, process_func):
+    """
+    Извлечение контента с использованием ProcessPoolExecutor.
+    Страницы с сырым HTML читаются потоком из БД, запись результатов выполняется в потоке основного процесса,
+    в процессы передается только разбор HTML
+    """
     results = []
 
-    logger.info(f"Starting to process {len(pages)} pages for content extraction using {N_JOBS} processes")
+    logger.info(f"Starting content extraction using {N_JOBS} processes")
+
+    # Ограничение числа страниц, одновременно находящихся в обработке, чтобы не держать в памяти весь HTML
+    max_in_flight = N_JOBS * 4
 
-    # Преобразуем db_config в словарь для передачи между процессами
-    db_config_dict = {k: db_config[k] for k in db_config}
+    # Поток, записывающий извлеченный контент в БД пачками
+    write_queue, writer = start_db_writer(save_extracted_content_to_db)
+
+    def collect_result(future, page):
+        try:
+            content = future.result()
+        except Exception as e:
+            logger.error(f"Error extracting content for page ID={page['id_page']}: {e}")
+            results.append(False)
+            return
+
+        # Статистика обновляется только в основном процессе
+        if content:
+            stats['parser_stats']['trafilatura']['success'] += 1
+            stats['parser_stats']['trafilatura']['parsed'] += 1
+            if LOG_PER_PAGE:
+                logger.info(f"Extracted content for page ID={page['id_page']} ({page['page_url']})")
+        else:
+            stats['parser_stats']['trafilatura']['failed'] += 1
 
-    # Равномерно распределяем страницы по процессам
-    batch_size = max(1, len(pages) // N_JOBS)
-    batches = [pages[i:i + batch_size] for i in range(0, len(pages), batch_size)]
+        write_queue.put({'id_page': page['id_page'], 'content': content})
+        results.append(True)
 
-    # Обрабатываем страницы в параллельных процессах
-    with concurrent.futures.ProcessPoolExecutor(max_workers=N_JOBS) as executor:
-        # Запускаем выполнение для всех пачек
-        futures = {executor.submit(process_content_extraction_batch, batch, db_config_dict):
-                  i for i, batch in enumerate(batches)}
+        if len(results) % LOG_PROGRESS_EVERY == 0:
+            logger.info(f"Extracted content for {len(results)} pages")
 
-        for future in concurrent.futures.as_completed(futures):
-            batch_index = futures[future]
-            try:
-                batch_results = future.result()
-                results.extend(batch_results)
-                logger.info(f"Completed batch {batch_index+1}/{len(batches)} with {len(batch_results)} pages")
-            except Exception as e:
-                logger.error(f"Error processing batch {batch_index+1}: {e}")
-                # Добавляем False для всех страниц в пачке
-                results.extend([False] * len(batches[batch_index]))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=N_JOBS) as executor:
+            futures = {}
+
+            for page in pages:
+                # Сырой HTML передается в процесс и больше не нужен в основном процессе.
+                # Сжатый HTML распаковывается уже в дочернем процессе
+                raw_content = page.pop('page_raw_content')
+                raw_lz4 = page.pop('raw_lz4')
+                if raw_lz4 is not None:
+                    future = executor.submit(extract_compressed_content, bytes(raw_lz4), page['page_url'])
+                else:
+                    future = executor.submit(process_func, raw_content, page['page_url'])
+                futures[future] = page
+
+                # Ждем завершения хотя бы одной задачи, если очередь процессов заполнена
+                if len(futures) >= max_in_flight:
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        collect_result(future, futures.pop(future))
+
+            for future in concurrent.futures.as_completed(futures):
+                collect_result(future, futures[future])
+    finally:
+        # Дожидаемся записи оставшихся результатов
+        stop_db_writer(write_queue, writer)
 
     return results
 
@@ -858,18 +1057,22 @@ def main():
     # Загрузка конфигурации
     db_config = load_config()
 
+    # Пул подключений к БД, общий для всех потоков
+    init_db_pool(db_config)
+
     # Подключение к БД
-    conn = get_db_connection(db_config)
+    conn = db_pool.getconn()
 
     # Этап 1: Получение сырого контента
     logger.info("Stage 1: Fetching raw content")
-    pages_for_raw = get_pages_for_raw_content(conn)
+    pages_for_raw = list(get_pages_for_raw_content(conn))
     stats['total_raw_pages'] = len(pages_for_raw)
     logger.info(f"Found {len(pages_for_raw)} pages for raw content fetching")
 
     if pages_for_raw:
         # Многопоточная обработка для получения сырого контента
-        results_raw = process_pages(pages_for_raw, process_page_raw_content, db_config, use_multiprocessing=False)
+        results_raw = process_pages(pages_for_raw, process_page_raw_content, use_multiprocessing=False)
+        flush_page_error_statuses(conn)
         success_count_raw = results_raw.count(True)
         logger.info(f"Processed {len(pages_for_raw)} raw pages, successful: {success_count_raw}, with errors: {len(pages_for_raw) - success_count_raw}")
     else:
@@ -877,21 +1080,22 @@ def main():
 
     # Этап 2: Извлечение контента
     logger.info("Stage 2: Extracting content")
+    # Страницы вместе с сырым HTML читаются потоком, список целиком в память не загружается
     pages_for_extraction = get_pages_for_content_extraction(conn)
-    stats['total_parsed_pages'] = len(pages_for_extraction)
-    logger.info(f"Found {len(pages_for_extraction)} pages for content extraction")
 
-    if pages_for_extraction:
-        # Используем мультипроцессорную обработку для извлечения контента
-        logger.info(f"Using {N_JOBS} processes for content extraction")
-        results_extraction = process_pages(pages_for_extraction, process_page_content_extraction, db_config, use_multiprocessing=True)
+    # Используем мультипроцессорную обработку для извлечения контента
+    results_extraction = process_pages(pages_for_extraction, extract_content, use_multiprocessing=True)
+    stats['total_parsed_pages'] = len(results_extraction)
+
+    if results_extraction:
         success_count_extraction = results_extraction.count(True)
-        logger.info(f"Processed {len(pages_for_extraction)} pages for extraction, successful: {success_count_extraction}, with errors: {len(pages_for_extraction) - success_count_extraction}")
+        logger.info(f"Processed {len(results_extraction)} pages for extraction, successful: {success_count_extraction}, with errors: {len(results_extraction) - success_count_extraction}")
     else:
         logger.info("No pages for content extraction")
 
-    # Закрываем соединение
-    conn.close()
+    # Возвращаем соединение и закрываем пул
+    db_pool.putconn(conn)
+    close_db_pool()
 
     # Фиксируем время окончания
     stats['end_time'] = datetime.now()
@@ -1,29 +1,42 @@
 #!/usr/bin/env python
 import json
+import gzip
 import time
 import os
+import shutil
 import tempfile
 from datetime import datetime
+from collections import defaultdict
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from webdriver_manager.chrome import ChromeDriverManager
 
 # Глобальные переменные
 SITEMAP_FILE_PATH = "sitemaps.txt"  # Файл с URL сайтемапов
 COOKIE_PATH = "cookies"  # Папка для сохранения файлов с куками
+MAX_BROWSERS = 4  # Количество браузеров, работающих параллельно
+PAGE_LOAD_TIMEOUT = 10  # Максимальное время ожидания загрузки страницы в секундах
+JS_SETTLE_DELAY = 1  # Пауза после загрузки страницы для выполнения отложенных скриптов в секундах
 
 # Создаем папку для куков, если ее нет
 if not os.path.exists(COOKIE_PATH):
     os.makedirs(COOKIE_PATH)
 
+# Файлы с куками по доменам, папка сканируется один раз при запуске
+files_by_domain = defaultdict(list)
+for file in os.listdir(COOKIE_PATH):
+    files_by_domain[file.rpartition("_")[0]].append(file)
+
 # Функция для проверки существования cookie за сегодняшний день
 def cookie_exists_for_today(domain):
     current_date = datetime.now().strftime("%d-%m-%Y")
-    filename = f"{domain}_{current_date}.json"
-    filepath = os.path.join(COOKIE_PATH, filename)
-    return os.path.exists(filepath)
+    filename = f"{domain}_{current_date}.json.gz"
+    return filename in files_by_domain[domain]
 
 # Функция для извлечения доменов из файла сайтемапов
 def extract_domains_from_sitemap_file(file_path):
@@ -52,28 +65,25 @@ if not URLS:
     print("Не удалось загрузить домены из файла. Завершение работы.")
     exit(1)
 
-# Создаем временную папку для профиля Chrome
-temp_dir = tempfile.mkdtemp()
-
-# Настройки браузера
-options = Options()
-options.add_argument("--headless=new")  # Новый headless-режим
-options.add_argument("--no-sandbox")
-options.add_argument("--disable-dev-shm-usage")
-options.add_argument("--disable-gpu")
-options.add_argument("--disable-software-rasterizer")
-options.add_argument("--remote-debugging-port=9222")
-options.add_argument("--disable-blink-features=AutomationControlled")
-options.add_argument(f"--user-data-dir={temp_dir}")  # Используем уникальный временный профиль
-options.add_argument("--window-size=1920x1080")
-options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36")
-
-# Запуск драйвера Chrome
-service = Service(ChromeDriverManager(driver_version="134.0.6998.35").install())
-driver = webdriver.Chrome(service=service, options=options)
-
-# Обрабатываем каждый URL из списка
-for url in URLS:
+# Функция для запуска отдельного экземпляра Chrome со своим временным профилем
+def create_driver(driver_path, temp_dir):
+    # Настройки браузера
+    options = Options()
+    options.add_argument("--headless=new")  # Новый headless-режим
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--disable-software-rasterizer")
+    # Порт отладки не фиксируется, чтобы параллельные браузеры не конфликтовали
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.add_argument(f"--user-data-dir={temp_dir}")  # Используем уникальный временный профиль
+    options.add_argument("--window-size=1920x1080")
+    options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36")
+
+    return webdriver.Chrome(service=Service(driver_path), options=options)
+
+# Функция для получения и сохранения cookie одного домена
+def save_cookies_for_url(driver, url):
     # Извлекаем доменное имя из URL
     parsed_url = urlparse(url)
     domain = parsed_url.netloc
@@ -82,33 +92,65 @@ for url in URLS:
     if cookie_exists_for_today(domain):
         log_entry = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Cookie для {domain} уже существуют. Пропускаем."
         print(log_entry)
-        continue
+        return
 
     driver.get(url)
-    time.sleep(10)  # даем время на выполнение JS
+
+    # Ждем окончания загрузки страницы вместо фиксированной паузы
+    try:
+        WebDriverWait(driver, PAGE_LOAD_TIMEOUT).until(
+            lambda d: d.execute_script("return document.readyState") == "complete"
+        )
+    except TimeoutException:
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Страница {url} не загрузилась за {PAGE_LOAD_TIMEOUT} сек, сохраняем полученные cookie")
+    time.sleep(JS_SETTLE_DELAY)  # даем время на выполнение отложенного JS
 
     # Получаем куки
     cookies = driver.get_cookies()
 
-    # Формируем имя файла: "<домен>_<дата>.json"
+    # Формируем имя файла: "<домен>_<дата>.json.gz"
     current_date = datetime.now().strftime("%d-%m-%Y")
-    filename = f"{domain}_{current_date}.json"
+    filename = f"{domain}_{current_date}.json.gz"
     filepath = os.path.join(COOKIE_PATH, filename)
 
-    # Сохраняем куки в JSON-файл
-    with open(filepath, "w") as f:
-        json.dump(cookies, f, indent=4)
+    # Сохраняем куки в сжатый компактный JSON-файл
+    with gzip.open(filepath, "wt", compresslevel=6) as f:
+        json.dump(cookies, f, separators=(',', ':'))
 
     # Удаляем старые файлы с куками для данного домена (кроме только что созданного)
-    for file in os.listdir(COOKIE_PATH):
-        if file.startswith(domain + "_") and file != filename:
+    for file in files_by_domain[domain]:
+        if file != filename:
             os.remove(os.path.join(COOKIE_PATH, file))
+    files_by_domain[domain] = [filename]
 
     # Записываем краткий лог
     log_entry = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Cookies сохранены для {domain} [{len(cookies)}]"
     print(log_entry)
 
-# Завершаем работу драйвера
-driver.quit()
+# Функция для обработки части доменов в одном браузере
+def process_urls(driver_path, urls):
+    # Создаем временную папку для профиля Chrome
+    temp_dir = tempfile.mkdtemp()
+    driver = create_driver(driver_path, temp_dir)
+    try:
+        for url in urls:
+            try:
+                save_cookies_for_url(driver, url)
+            except WebDriverException as e:
+                print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Ошибка при получении cookie для {url}: {e}")
+    finally:
+        # Завершаем работу драйвера
+        driver.quit()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+# Драйвер Chrome скачивается один раз и используется всеми браузерами
+driver_path = ChromeDriverManager(driver_version="134.0.6998.35").install()
+
+# Распределяем домены между браузерами и обрабатываем их параллельно
+num_browsers = min(MAX_BROWSERS, len(URLS))
+with ThreadPoolExecutor(max_workers=num_browsers) as executor:
+    futures = [executor.submit(process_urls, driver_path, URLS[i::num_browsers]) for i in range(num_browsers)]
+    for future in futures:
+        future.result()
 
 print("Скрипт выполнен успешно!")
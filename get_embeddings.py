@@ -1,18 +1,29 @@
 #!/usr/bin/env python
 import os
+import re
+import argparse
 import time
+import hashlib
 import asyncio
+import httpx
 import psycopg2
-from psycopg2.extras import execute_values
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 from tqdm import tqdm
 import logging
 import configparser
 from tabulate import tabulate
 from datetime import datetime
+from collections import defaultdict
 import tiktoken
 
+# Более быстрый цикл событий, если установлен uvloop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -31,7 +42,7 @@ load_dotenv()
 BATCH_SIZE = 100  # Количество текстов, обрабатываемых за один раз
 MAX_RETRIES = 3
 RETRY_DELAY = 2  # Задержка между повторными попытками в секундах
-CONCURRENCY_LIMIT = 5  # Лимит параллельных запросов к API
+CONCURRENCY_LIMIT = 32  # Лимит параллельных запросов к API
 CONFIG_PATH = "config/config.ini"
 CONFIG_SECTION_DB = "RSS-News.postgres_local"
 CONFIG_SECTION_OPENAI = "OpenAI"
@@ -39,6 +50,31 @@ CONTENT_MIN_LENGTH = 500
 TOTAL_LIMIT = 1000
 PRICE_PER_1M_TOKENS = 0.02 # цена за 1 млн токенов
 MAX_CONTENT_LENGTH = 8192 # Максимальная длина контента в токенах
+MAX_TEXTS_PER_REQUEST = 128 # Максимальное количество текстов в одном запросе к API
+MAX_TOKENS_PER_REQUEST = 250_000 # Максимальное суммарное количество токенов в одном запросе (лимит API - 300 тыс.)
+MAX_TOKENS_PER_MINUTE = 1_000_000 # Лимит токенов в минуту (TPM) для модели эмбеддингов
+MAX_REQUESTS_PER_MINUTE = 3000 # Лимит запросов в минуту (RPM) для модели эмбеддингов
+CHARS_PER_TOKEN_ESTIMATE = 2.5 # Оценка символов на токен (кириллица) для текстов, которые не токенизируются
+
+def parse_reset_duration(value):
+    """
+    Разбор времени до сброса лимита из заголовков ответа API
+
+    :param value: Значение заголовка: число секунд ("20") или длительность ("1m30s", "250ms")
+    :return: Время в секундах или None, если значение не удалось разобрать
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
 
 def load_config():
     """Загрузка конфигурации из файла"""
@@ -61,17 +97,35 @@ def load_config():
     return db_config, openai_config
 
 class EmbeddingProcessor:
-    def __init__(self, db_config, openai_config):
+    def __init__(self, db_config, openai_config, force_refresh=False):
         """
         Инициализация процессора эмбеддингов
 
         :param db_config: Словарь с параметрами подключения к БД
         :param openai_config: Словарь с параметрами OpenAI
+        :param force_refresh: Пересчитать эмбеддинги и для страниц, у которых они уже есть
         """
         self.db_config = db_config
         self.openai_config = openai_config
-        self.client = AsyncOpenAI(api_key=openai_config['api_key'])
-        self.semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
+        self.force_refresh = force_refresh
+        # Один долгоживущий HTTP-клиент с пулом keep-alive соединений на все запросы к API
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+            timeout=httpx.Timeout(60.0, connect=10.0)
+        )
+        # Повторные попытки выполняются в get_embeddings_bulk с учетом лимитов API, встроенные повторы клиента отключены
+        self.client = AsyncOpenAI(api_key=openai_config['api_key'], http_client=self.http_client, max_retries=0)
+
+        # Ограничение частоты по токенам и по запросам в соответствии с лимитами API
+        self.token_limiter = AsyncLimiter(MAX_TOKENS_PER_MINUTE, 60)
+        self.request_limiter = AsyncLimiter(MAX_REQUESTS_PER_MINUTE, 60)
+        # Момент (по часам цикла событий), до которого все запросы приостановлены после ответа 429
+        self.rate_limit_until = 0
+
+        # Подключения к БД на весь запуск: self.conn используется циклом событий (чтение контента
+        # и поиск в кэше), self.save_conn - только потоком сохранения, транзакции не пересекаются
+        self.conn = self.connect_to_db()
+        self.save_conn = self.connect_to_db()
 
         # Инициализация токенизатора для модели
         # Используем соответствующий токенизатор для модели эмбеддингов
@@ -88,43 +142,61 @@ class EmbeddingProcessor:
             'failed_embeddings': 0,
             'skipped_texts': 0,
             'start_time': datetime.now(),
-            'domains_stats': {},
+            'domains_stats': defaultdict(lambda: {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0, 'chars': 0}),
             'tokens_sent': 0,
             'chars_sent': 0,
             'avg_tokens_per_text': 0,
             'avg_chars_per_token': 0,
-            'truncated_texts': 0
+            'truncated_texts': 0,
+            'cache_hits': 0,
+            'duplicate_texts': 0
         }
 
+        # Тексты, ожидающие ответа API, по хэшу: повторы того же текста не отправляются,
+        # а получают эмбеддинг первого экземпляра (хэш -> список повторов)
+        self.pending_duplicates = {}
+
     def connect_to_db(self):
         """Создание подключения к БД"""
         return psycopg2.connect(**self.db_config)
 
     def get_unprocessed_contents(self):
-        """Получение контента, для которого еще не созданы эмбеддинги"""
-        with self.connect_to_db() as conn:
-            with conn.cursor() as cursor:
-                query = """
-                SELECT npc.id_page, npc.content, s.domain
-                FROM news_pages_content npc
-                LEFT JOIN content_embeddings ce ON npc.id_page = ce.id_page
-                JOIN news_pages np ON npc.id_page = np.id_page
-                JOIN sitemaps s ON np.id_sitemap = s.id_sitemap
-                WHERE ce.id IS NULL AND npc.content IS NOT NULL AND LENGTH(npc.content) >= %s
-                ORDER BY npc.publication_date DESC
-                LIMIT %s
-                """
-                cursor.execute(query, (CONTENT_MIN_LENGTH, TOTAL_LIMIT))
-                return cursor.fetchall()
-
-    def truncate_text_to_token_limit(self, text):
+        """
+        Получение контента, для которого еще не созданы эмбеддинги (генератор пакетов по BATCH_SIZE)
+        Строки читаются серверным курсором порциями, а не загружаются в память целиком
+        """
+        # При принудительном обновлении выбираются и страницы с уже созданными эмбеддингами
+        not_processed_filter = "" if self.force_refresh else \
+            "NOT EXISTS (SELECT 1 FROM content_embeddings ce WHERE ce.id_page = npc.id_page) AND"
+        query = f"""
+        SELECT npc.id_page, npc.content, s.domain
+        FROM news_pages_content npc
+        JOIN news_pages np ON npc.id_page = np.id_page
+        JOIN sitemaps s ON np.id_sitemap = s.id_sitemap
+        WHERE {not_processed_filter}
+            npc.content IS NOT NULL AND LENGTH(npc.content) >= %s
+        ORDER BY npc.publication_date DESC
+        LIMIT %s
+        """
+
+        # WITH HOLD: курсор переживает коммиты поиска в кэше в том же подключении
+        with self.conn.cursor(name='emb_stream', withhold=True) as cursor:
+            cursor.itersize = BATCH_SIZE * 2
+            cursor.execute(query, (CONTENT_MIN_LENGTH, TOTAL_LIMIT))
+            while batch := cursor.fetchmany(BATCH_SIZE):
+                yield batch
+        self.conn.commit()
+
+    def truncate_text_to_token_limit(self, text, tokens=None):
         """
         Обрезает текст до указанного количества токенов
 
         :param text: Исходный текст
+        :param tokens: Уже полученные токены текста (если не переданы, текст токенизируется заново)
         :return: Обрезанный текст, количество токенов, длина в символах
         """
-        tokens = self.tokenizer.encode(text)
+        if tokens is None:
+            tokens = self.tokenizer.encode(text)
         original_token_count = len(tokens)
 
         # Проверяем, нужно ли обрезать
@@ -139,133 +211,363 @@ class EmbeddingProcessor:
 
         return truncated_text, len(truncated_tokens), len(truncated_text)
 
-    async def get_embedding(self, text, id_page, domain):
+    def update_domain_stats(self, domain, key, value=1):
+        """Обновление статистики домена"""
+        self.stats['domains_stats'][domain][key] += value
+
+    def get_cached_embeddings(self, content_hashes):
         """
-        Получение эмбеддинга для текста
+        Поиск готовых эмбеддингов в кэше по хэшам контента одним запросом
 
-        :param text: Текст для получения эмбеддинга
-        :param id_page: Идентификатор страницы
-        :param domain: Домен страницы
-        :return: Кортеж (id_page, embedding)
+        :param content_hashes: Список SHA-256 хэшей обрезанных текстов
+        :return: Словарь {content_hash: эмбеддинг в текстовом формате pgvector}
         """
-        async with self.semaphore:
-            # Обрезаем текст до максимально допустимого количества токенов
-            processed_text, token_count, char_count = self.truncate_text_to_token_limit(text)
+        if not content_hashes:
+            return {}
 
-            self.stats['tokens_sent'] += token_count
-            self.stats['chars_sent'] += char_count
+        # Блок with задает границы транзакции, подключение остается открытым
+        with self.conn as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT content_hash, embedding::text FROM embedding_cache WHERE content_hash = ANY(%s)",
+                    ([psycopg2.Binary(content_hash) for content_hash in content_hashes],)
+                )
+                return {bytes(content_hash): embedding for content_hash, embedding in cursor.fetchall()}
 
-            for attempt in range(MAX_RETRIES):
-                try:
-                    response = await self.client.embeddings.create(
-                        model=self.openai_config['model_embeddings'],
-                        input=processed_text,
-                        encoding_format="float"
-                    )
-                    embedding = response.data[0].embedding
-
-                    # Обновление статистики успешной обработки
-                    self.stats['successful_embeddings'] += 1
-                    if domain not in self.stats['domains_stats']:
-                        self.stats['domains_stats'][domain] = {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0, 'chars': 0}
-                    self.stats['domains_stats'][domain]['success'] += 1
-                    self.stats['domains_stats'][domain]['tokens'] = self.stats['domains_stats'][domain].get('tokens', 0) + token_count
-                    self.stats['domains_stats'][domain]['chars'] = self.stats['domains_stats'][domain].get('chars', 0) + char_count
-
-                    return id_page, embedding
-                except Exception as e:
-                    if attempt < MAX_RETRIES - 1:
-                        logger.warning(f"Ошибка при получении эмбеддинга для id_page={id_page}. Попытка {attempt + 1}/{MAX_RETRIES}. Ошибка: {e}")
-                        await asyncio.sleep(RETRY_DELAY * (2 ** attempt))  # Экспоненциальная задержка
+    async def get_embeddings_bulk(self, items):
+        """
+        Получение эмбеддингов для группы текстов одним запросом к API
+
+        :param items: Список кортежей (id_page, text, token_count, char_count, domain, content_hash) с уже обрезанными текстами
+        :return: Кортеж (список кортежей (id_page, embedding, content_hash), число токенов запроса)
+        """
+        loop = asyncio.get_running_loop()
+        estimated_tokens = sum(item[2] for item in items)
+
+        for attempt in range(MAX_RETRIES):
+            try:
+                # Ожидание сброса лимита после ответа 429 и свободной квоты токенов и запросов
+                pause = self.rate_limit_until - loop.time()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                await self.request_limiter.acquire()
+                await self.token_limiter.acquire(min(estimated_tokens, MAX_TOKENS_PER_MINUTE))
+
+                response = await self.client.embeddings.create(
+                    model=self.openai_config['model_embeddings'],
+                    input=[text for _, text, _, _, _, _ in items],
+                    encoding_format="float"
+                )
+
+                # Точное число токенов запроса берется из ответа API
+                actual_tokens = response.usage.prompt_tokens if response.usage else estimated_tokens
+
+                # Порядок эмбеддингов восстанавливается по индексу входного текста
+                results = []
+                for data in response.data:
+                    id_page, _, _, _, _, content_hash = items[data.index]
+                    results.append((id_page, data.embedding, content_hash))
+
+                return results, actual_tokens
+            except Exception as e:
+                id_pages = [id_page for id_page, _, _, _, _, _ in items]
+                if attempt < MAX_RETRIES - 1:
+                    logger.warning(f"Ошибка при получении эмбеддингов для {len(items)} текстов (id_page={id_pages[0]}..{id_pages[-1]}). Попытка {attempt + 1}/{MAX_RETRIES}. Ошибка: {e}")
+
+                    # При превышении лимита ждем момента его сброса, указанного API, вместо экспоненциальной задержки
+                    reset_delay = None
+                    if isinstance(e, RateLimitError):
+                        headers = e.response.headers
+                        reset_delay = parse_reset_duration(headers.get('retry-after')) or parse_reset_duration(headers.get('x-ratelimit-reset-tokens'))
+                    if reset_delay is not None:
+                        self.rate_limit_until = max(self.rate_limit_until, loop.time() + reset_delay)
                     else:
-                        logger.error(f"Не удалось получить эмбеддинг для id_page={id_page} после {MAX_RETRIES} попыток. Ошибка: {e}")
+                        await asyncio.sleep(RETRY_DELAY * (2 ** attempt))  # Экспоненциальная задержка
+                else:
+                    logger.error(f"Не удалось получить эмбеддинги для {len(items)} текстов (id_page={id_pages}) после {MAX_RETRIES} попыток. Ошибка: {e}")
+                    raise
 
-                        # Обновление статистики неудачной обработки
-                        self.stats['failed_embeddings'] += 1
-                        if domain not in self.stats['domains_stats']:
-                            self.stats['domains_stats'][domain] = {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0, 'chars': 0}
-                        self.stats['domains_stats'][domain]['failed'] += 1
+    def update_request_stats(self, items, tokens_sent=None):
+        """
+        Учет результатов запроса к API в статистике
 
-                        raise
+        Вызывается только из задачи сохранения, поэтому воркеры, ожидающие ответов API, статистику не изменяют
 
-    async def process_batch(self, batch, pbar):
+        :param items: Группа текстов запроса (id_page, text, token_count, char_count, domain, content_hash)
+        :param tokens_sent: Число токенов запроса по данным API или None, если запрос завершился ошибкой
         """
-        Обработка пакета контента
+        if tokens_sent is None:
+            self.stats['failed_embeddings'] += len(items)
+            for _, _, _, _, domain, _ in items:
+                self.update_domain_stats(domain, 'failed')
+            return
+
+        # Токены запроса распределяются между текстами пропорционально их оценкам
+        estimated_tokens = sum(item[2] for item in items)
+        self.stats['tokens_sent'] += tokens_sent
+        self.stats['successful_embeddings'] += len(items)
+        for _, _, token_estimate, char_count, domain, _ in items:
+            self.stats['chars_sent'] += char_count
+            self.update_domain_stats(domain, 'success')
+            self.update_domain_stats(domain, 'tokens', round(tokens_sent * token_estimate / estimated_tokens))
+            self.update_domain_stats(domain, 'chars', char_count)
+
+    def group_by_token_budget(self, items):
+        """
+        Разбиение текстов на группы для отдельных запросов к API
+        с учетом лимитов на количество текстов и токенов в одном запросе
+        """
+        groups = []
+        group = []
+        group_tokens = 0
+        for item in items:
+            token_count = item[2]
+            if group and (len(group) >= MAX_TEXTS_PER_REQUEST or group_tokens + token_count > MAX_TOKENS_PER_REQUEST):
+                groups.append(group)
+                group = []
+                group_tokens = 0
+            group.append(item)
+            group_tokens += token_count
+        if group:
+            groups.append(group)
+        return groups
+
+    async def prepare_batch(self, batch, pbar):
+        """
+        Подготовка пакета контента: обрезка текстов, поиск в кэше и разбиение на группы запросов к API
 
         :param batch: Список кортежей (id_page, content, domain) для обработки
         :param pbar: Прогресс-бар
-        :return: Список результатов (id_page, embedding)
+        :return: Кортеж (результаты из кэша (id_page, embedding, content_hash), группы текстов для запросов к API)
         """
-        tasks = []
-        for id_page, content, domain in batch:
+        # Каждый токен содержит хотя бы один байт, поэтому текст, длина которого в байтах
+        # не превышает лимит токенов, гарантированно не требует обрезки и не токенизируется
+        encoded_contents = [content.encode('utf-8') if content else None for _, content, _ in batch]
+        long_contents = [
+            content for (_, content, _), encoded in zip(batch, encoded_contents)
+            if encoded and len(encoded) > MAX_CONTENT_LENGTH - 1
+        ]
+
+        # Токенизация длинных текстов пакета в пуле потоков tiktoken, не блокируя цикл событий
+        token_lists = iter(await asyncio.to_thread(
+            self.tokenizer.encode_batch, long_contents, num_threads=os.cpu_count()
+        )) if long_contents else iter(())
+
+        items = []
+        for (id_page, content, domain), encoded in zip(batch, encoded_contents):
             if content:  # Проверка, что контент не пустой
-                tasks.append(self.get_embedding(content, id_page, domain))
+                if len(encoded) > MAX_CONTENT_LENGTH - 1:
+                    # Обрезаем текст до максимально допустимого количества токенов, декодирование - только при обрезке
+                    processed_text, token_count, char_count = self.truncate_text_to_token_limit(content, next(token_lists))
+                    if processed_text is not content:
+                        encoded = processed_text.encode('utf-8')
+                else:
+                    # Длина в байтах лишь гарантирует, что обрезка не нужна, но завышает число токенов
+                    # в 5-6 раз для кириллицы; для лимитера и группировки берем оценку по символам,
+                    # точное значение берется из ответа API
+                    token_count = min(len(encoded), int(len(content) / CHARS_PER_TOKEN_ESTIMATE) + 1)
+                    processed_text, char_count = content, len(content)
+                content_hash = hashlib.sha256(encoded).digest()
+                items.append((id_page, processed_text, token_count, char_count, domain, content_hash))
                 self.stats['processed_texts'] += 1
             else:
                 logger.warning(f"Пропуск id_page={id_page} из-за пустого контента")
                 self.stats['skipped_texts'] += 1
                 # Обновление статистики для домена
-                if domain not in self.stats['domains_stats']:
-                    self.stats['domains_stats'][domain] = {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0, 'chars': 0}
-                self.stats['domains_stats'][domain]['skipped'] += 1
+                self.update_domain_stats(domain, 'skipped')
                 pbar.update(1)
 
+        # Тексты, эмбеддинги которых уже есть в кэше, в API не отправляются
+        cached = self.get_cached_embeddings([item[5] for item in items])
         results = []
-        for future in asyncio.as_completed(tasks):
-            try:
-                result = await future
-                results.append(result)
-                pbar.update(1)
-            except Exception as e:
-                logger.error(f"Ошибка при обработке запроса: {e}")
-                pbar.update(1)
+        misses = []
+        for item in items:
+            id_page, _, _, _, domain, content_hash = item
+            embedding = cached.get(content_hash)
+            if embedding is None:
+                misses.append(item)
+                continue
+            results.append((id_page, embedding, content_hash))
+            self.stats['successful_embeddings'] += 1
+            self.stats['cache_hits'] += 1
+            self.update_domain_stats(domain, 'success')
+        pbar.update(len(items) - len(misses))
+
+        # Одинаковые тексты (перепечатки, зеркала) отправляются в API один раз,
+        # в том числе если такой же текст из предыдущего пакета еще ожидает ответа
+        unique = []
+        for item in misses:
+            content_hash = item[5]
+            if content_hash in self.pending_duplicates:
+                self.pending_duplicates[content_hash].append(item)
+            else:
+                self.pending_duplicates[content_hash] = []
+                unique.append(item)
 
-        return results
+        # Один запрос к API на группу текстов вместо запроса на каждый текст
+        return results, self.group_by_token_budget(unique)
 
     def save_embeddings(self, embeddings):
         """
         Сохранение эмбеддингов в БД
 
-        :param embeddings: Список кортежей (id_page, embedding)
+        :param embeddings: Список кортежей (id_page, embedding, content_hash)
         """
         if not embeddings:
             return
 
-        with self.connect_to_db() as conn:
+        # Подготовка параллельных массивов: id_page, хэш и эмбеддинг в текстовом формате pgvector.
+        # Преобразование в половинную точность (halfvec) выполняет сервер при разборе значения.
+        # Эмбеддинги из кэша уже получены в текстовом формате pgvector
+        id_pages = []
+        content_hashes = []
+        vectors = []
+        for id_page, embedding, content_hash in embeddings:
+            if not isinstance(embedding, str):
+                embedding = f"[{','.join(map(str, embedding))}]"
+            id_pages.append(id_page)
+            content_hashes.append(psycopg2.Binary(content_hash))
+            vectors.append(embedding)
+
+        # Выбираются только страницы без эмбеддингов, поэтому конфликт возможен лишь при гонке
+        # с параллельным запуском; перезапись существующих строк нужна только при принудительном обновлении
+        on_conflict = "DO UPDATE SET embedding = EXCLUDED.embedding" if self.force_refresh else "DO NOTHING"
+
+        # Отдельное подключение: сохранение идет в потоке параллельно с чтением через self.conn
+        with self.save_conn as conn:
             with conn.cursor() as cursor:
-                # Подготовка данных для вставки
-                values = [(id_page, embedding) for id_page, embedding in embeddings]
-
-                # Вставка данных с использованием execute_values для эффективности
-                execute_values(
-                    cursor,
-                    "INSERT INTO content_embeddings (id_page, embedding) VALUES %s ON CONFLICT (id_page) DO UPDATE SET embedding = EXCLUDED.embedding",
-                    values,
-                    template="(%s, %s)"
+                # Сохранение эмбеддингов и пополнение кэша одним запросом
+                cursor.execute(f"""
+                WITH new_embeddings AS (
+                    SELECT id_page, content_hash, embedding::halfvec AS embedding
+                    FROM unnest(%s::int[], %s::bytea[], %s::text[]) AS t(id_page, content_hash, embedding)
+                ), cached AS (
+                    INSERT INTO embedding_cache (content_hash, embedding)
+                    SELECT DISTINCT ON (content_hash) content_hash, embedding FROM new_embeddings
+                    ON CONFLICT (content_hash) DO NOTHING
                 )
+                INSERT INTO content_embeddings (id_page, embedding)
+                SELECT id_page, embedding FROM new_embeddings
+                ON CONFLICT (id_page) {on_conflict}
+                """, (id_pages, content_hashes, vectors))
 
-            conn.commit()
+    def resolve_duplicates(self, items, results, pbar):
+        """
+        Распространение эмбеддингов группы запроса на повторы тех же текстов
+
+        :param items: Группа текстов запроса (id_page, text, token_count, char_count, domain, content_hash)
+        :param results: Список кортежей (id_page, embedding, content_hash) или None, если запрос завершился ошибкой
+        :param pbar: Прогресс-бар
+        :return: Список кортежей (id_page, embedding, content_hash) для повторов
+        """
+        embeddings = {content_hash: embedding for _, embedding, content_hash in results or ()}
+        duplicate_results = []
+        for item in items:
+            for id_page, _, _, _, domain, content_hash in self.pending_duplicates.pop(item[5], ()):
+                pbar.update(1)
+                embedding = embeddings.get(content_hash)
+                if embedding is None:
+                    self.stats['failed_embeddings'] += 1
+                    self.update_domain_stats(domain, 'failed')
+                    continue
+                duplicate_results.append((id_page, embedding, content_hash))
+                self.stats['successful_embeddings'] += 1
+                self.stats['duplicate_texts'] += 1
+                self.update_domain_stats(domain, 'success')
+        return duplicate_results
 
     async def process_all(self):
         """Обработка всего контента"""
-        contents = self.get_unprocessed_contents()
-        total = len(contents)
-        self.stats['total_texts'] = total
-
-        if total == 0:
+        # Группы текстов передаются воркерам через очередь: новый запрос к API начинается сразу
+        # после завершения любого предыдущего, а не после завершения всего пакета
+        work_queue = asyncio.Queue(maxsize=CONCURRENCY_LIMIT * 2)
+        result_queue = asyncio.Queue()
+
+        # Общее число текстов заранее неизвестно: строки читаются потоком
+        with tqdm(desc="Получение эмбеддингов") as pbar:
+            async def producer():
+                # Первый запрос к API отправляется сразу после чтения первого пакета
+                for batch in self.get_unprocessed_contents():
+                    self.stats['total_texts'] += len(batch)
+                    cached_results, groups = await self.prepare_batch(batch, pbar)
+                    if cached_results:
+                        await result_queue.put((cached_results, None, None))
+                    for group in groups:
+                        await work_queue.put(group)
+
+                # Сигнал завершения для каждого воркера
+                for _ in range(CONCURRENCY_LIMIT):
+                    await work_queue.put(None)
+
+            async def worker():
+                # Воркер только передает результат запроса, статистику учитывает задача сохранения
+                while (group := await work_queue.get()) is not None:
+                    try:
+                        results, tokens_sent = await self.get_embeddings_bulk(group)
+                    except Exception as e:
+                        logger.error(f"Ошибка при обработке запроса: {e}")
+                        results, tokens_sent = None, None
+                    await result_queue.put((results, group, tokens_sent))
+                    pbar.update(len(group))
+
+                await result_queue.put(None)
+
+            async def saver():
+                # Сохранение результатов пачками по BATCH_SIZE, пока не завершатся все воркеры.
+                # Запись в БД выполняется в отдельном потоке через собственное подключение save_conn
+                # и не останавливает цикл событий; одновременно выполняется не более одного
+                # сохранения, так как это подключение одно
+                embeddings = []
+                save_task = None
+                finished_workers = 0
+                while finished_workers < CONCURRENCY_LIMIT:
+                    message = await result_queue.get()
+                    if message is None:
+                        finished_workers += 1
+                        continue
+
+                    # Для результатов из кэша группы запроса нет, их статистика учтена при подготовке пакета
+                    results, group, tokens_sent = message
+                    if group is not None:
+                        self.update_request_stats(group, tokens_sent)
+                        embeddings.extend(self.resolve_duplicates(group, results, pbar))
+                    if not results:
+                        continue
+
+                    embeddings.extend(results)
+                    if len(embeddings) >= BATCH_SIZE:
+                        if save_task:
+                            await save_task
+                        save_task = asyncio.create_task(asyncio.to_thread(self.save_embeddings, embeddings))
+                        embeddings = []
+
+                if save_task:
+                    await save_task
+                await asyncio.to_thread(self.save_embeddings, embeddings)
+
+            async with asyncio.TaskGroup() as task_group:
+                task_group.create_task(producer())
+                for _ in range(CONCURRENCY_LIMIT):
+                    task_group.create_task(worker())
+                task_group.create_task(saver())
+
+        if self.stats['total_texts'] == 0:
             logger.info("Все тексты уже обработаны")
-            return
-
-        logger.info(f"Найдено {total} текстов для обработки")
+        else:
+            logger.info(f"Обработано {self.stats['total_texts']} текстов")
 
-        with tqdm(total=total, desc="Получение эмбеддингов") as pbar:
-            # Разбиение на пакеты
-            for i in range(0, total, BATCH_SIZE):
-                batch = contents[i:i+BATCH_SIZE]
-                embeddings = await self.process_batch(batch, pbar)
+    def close(self):
+        """Закрытие подключений к БД"""
+        for conn in (self.conn, self.save_conn):
+            if not conn.closed:
+                conn.close()
 
-                # Сохранение результатов пакета
-                self.save_embeddings(embeddings)
+    async def run(self):
+        """Обработка всего контента с закрытием HTTP-клиента по завершении"""
+        try:
+            await self.process_all()
+        finally:
+            await self.client.close()
 
     def print_stats(self):
         """Вывод статистики сессии обработки эмбеддингов"""
@@ -293,6 +595,8 @@ class EmbeddingProcessor:
             ["Неудачных попыток", self.stats['failed_embeddings']],
             ["Пропущенных текстов", self.stats['skipped_texts']],
             ["Обрезанных текстов", self.stats['truncated_texts']],
+            ["Найдено в кэше", self.stats['cache_hits']],
+            ["Повторов текста в пакетах", self.stats['duplicate_texts']],
             ["Всего отправлено токенов", f"{self.stats['tokens_sent']:,}".replace(',', ' ')],
             ["Всего отправлено символов", f"{self.stats['chars_sent']:,}".replace(',', ' ')],
             ["Среднее кол-во токенов на текст", f"{self.stats['avg_tokens_per_text']:.1f}"],
@@ -332,7 +636,15 @@ class EmbeddingProcessor:
                 colalign=("right", "left", "right", "right", "right", "right", "right", "right", "right")
             ))
 
+def parse_args():
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(description="Создание эмбеддингов для контента новостных страниц")
+    parser.add_argument('--force-refresh', action='store_true',
+                        help="Пересчитать эмбеддинги и для страниц, у которых они уже есть")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
     start_time = time.time()
     processor = None
 
@@ -341,8 +653,10 @@ def main():
         db_config, openai_config = load_config()
 
         # Создание и запуск процессора эмбеддингов
-        processor = EmbeddingProcessor(db_config, openai_config)
-        asyncio.run(processor.process_all())
+        processor = EmbeddingProcessor(db_config, openai_config, force_refresh=args.force_refresh)
+        # asyncio.Runner принимает loop_factory начиная с Python 3.11 (asyncio.run - только с 3.12)
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+            runner.run(processor.run())
 
         logger.info("Обработка завершена успешно")
     except KeyboardInterrupt:
@@ -353,6 +667,7 @@ def main():
         # Вывод статистики, если был создан процессор
         if processor:
             processor.print_stats()
+            processor.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
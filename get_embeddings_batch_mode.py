@@ -1,21 +1,34 @@
 #!/usr/bin/env python
+import io
 import os
 import sys
 import time
+import signal
+import struct
+import hashlib
 import asyncio
-import json
-import psycopg2
-import argparse
-from psycopg2.extras import execute_values
-from openai import AsyncOpenAI, OpenAI
+import importlib.util
+import orjson
 from dotenv import load_dotenv
-from tqdm import tqdm
 import logging
 import configparser
 from tabulate import tabulate
 from datetime import datetime
-import tiktoken
-import tempfile
+from types import SimpleNamespace
+from collections import defaultdict
+from functools import lru_cache
+
+# Тяжелые библиотеки (openai, httpx, psycopg2, tiktoken) импортируются при первом использовании:
+# режиму status, который только читает файл заданий, они не нужны
+
+# Более быстрый цикл событий, если установлен uvloop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# HTTP/2 для запросов к API, если установлен пакет h2
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
 
 # Настройка логирования
 logging.basicConfig(
@@ -42,22 +55,50 @@ CONFIG_SECTION_OPENAI = "OpenAI"
 CONTENT_MIN_LENGTH = 500
 TOTAL_LIMIT = 1000
 PRICE_PER_1M_TOKENS = 0.02 # цена за 1 млн токенов
-BATCH_CHECK_INTERVAL = 10  # Интервал проверки статуса батча в секундах
+MAX_CONTENT_LENGTH = 8192 # Максимальная длина контента в токенах
+BATCH_CHECK_INTERVAL = 10  # Начальный интервал проверки статуса батча в секундах
+BATCH_CHECK_MAX_INTERVAL = 300  # Максимальный интервал проверки статуса батча в секундах
 BATCH_MAX_WAIT_TIME = 24 * 60 * 60  # Максимальное время ожидания результатов батча (24 часа)
 BATCH_INFO_FILE = "batch_jobs.json"  # Файл для хранения информации о batch-заданиях
-
-def load_config():
-    """Загрузка конфигурации из файла"""
+MODES = ('full', 'create', 'check', 'status')  # Режимы работы скрипта
+# Заголовок и завершающий маркер потока COPY в бинарном формате
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('>h', -1)
+
+@lru_cache(maxsize=4)
+def read_config(path, mtime_ns):
+    """
+    Чтение файла конфигурации (результат кэшируется, пока файл не изменится)
+
+    :param path: Путь к файлу конфигурации
+    :param mtime_ns: Время изменения файла, входит в ключ кэша
+    """
     config = configparser.ConfigParser()
-    config.read(CONFIG_PATH)
-
-    db_config = {
-        'host': config[CONFIG_SECTION_DB]['host'],
-        'port': config[CONFIG_SECTION_DB]['port'],
-        'dbname': config[CONFIG_SECTION_DB]['dbname'],
-        'user': config[CONFIG_SECTION_DB]['user'],
-        'password': config[CONFIG_SECTION_DB]['password']
-    }
+    config.read(path)
+    return config
+
+def load_config(with_db=True):
+    """
+    Загрузка конфигурации из файла
+
+    :param with_db: Загружать параметры подключения к БД (не нужны для вывода статуса)
+    :return: Кортеж (параметры БД или None, параметры OpenAI)
+    """
+    try:
+        mtime_ns = os.stat(CONFIG_PATH).st_mtime_ns
+    except FileNotFoundError:
+        mtime_ns = None
+    config = read_config(CONFIG_PATH, mtime_ns)
+
+    db_config = None
+    if with_db:
+        db_config = {
+            'host': config[CONFIG_SECTION_DB]['host'],
+            'port': config[CONFIG_SECTION_DB]['port'],
+            'dbname': config[CONFIG_SECTION_DB]['dbname'],
+            'user': config[CONFIG_SECTION_DB]['user'],
+            'password': config[CONFIG_SECTION_DB]['password']
+        }
 
     openai_config = {
         'api_key': config[CONFIG_SECTION_OPENAI]['api_key'],
@@ -66,26 +107,84 @@ def load_config():
 
     return db_config, openai_config
 
+@lru_cache(maxsize=8)
+def get_encoder(model):
+    """Токенизатор для модели эмбеддингов (создается один раз на модель)"""
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Если модель неизвестна tiktoken, используем cl100k_base (для text-embedding-3-*)
+        return tiktoken.get_encoding("cl100k_base")
+
+def pack_halfvec(embedding):
+    """
+    Упаковка эмбеддинга в бинарный формат halfvec (pgvector): размерность, зарезервированное поле
+    и значения половинной точности. Занимает ~3 КБ вместо ~50 КБ списка чисел Python
+
+    :param embedding: Список чисел
+    :return: Байты значения halfvec
+    """
+    return struct.pack(f'>hh{len(embedding)}e', len(embedding), 0, *embedding)
+
+def iter_jsonl(response):
+    """
+    Построчный разбор JSONL из потокового ответа API по мере получения данных.
+    Строки разбираются из байтов без промежуточного декодирования в str
+
+    :param response: Потоковый ответ (files.with_streaming_response.content)
+    :return: Генератор разобранных объектов
+    """
+    tail = b''
+    for chunk in response.iter_bytes():
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield orjson.loads(line)
+    if tail.strip():
+        yield orjson.loads(tail)
+
 class EmbeddingProcessor:
-    def __init__(self, db_config, openai_config):
+    def __init__(self, db_config, openai_config, precount_tokens=False, max_concurrency=CONCURRENCY_LIMIT,
+                 *, status_only=False):
         """
         Инициализация процессора эмбеддингов
 
         :param db_config: Словарь с параметрами подключения к БД
         :param openai_config: Словарь с параметрами OpenAI
+        :param precount_tokens: Точно подсчитывать токены всех текстов при создании заданий
+        :param max_concurrency: Максимальное число одновременных запросов к API
+        :param status_only: Только вывод статуса из файла заданий: клиенты API, токенизатор
+                            и подключение к БД не создаются
         """
         self.db_config = db_config
         self.openai_config = openai_config
-        self.async_client = AsyncOpenAI(api_key=openai_config['api_key'])
-        self.sync_client = OpenAI(api_key=openai_config['api_key'])
-        self.semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
+        self.precount_tokens = precount_tokens
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Событие запроса на завершение (SIGINT/SIGTERM): новая работа не начинается,
+        # начатая завершается и попадает в файл заданий
+        self.shutdown_event = asyncio.Event()
+
+        if status_only:
+            self.http_client = self.async_client = self.sync_client = self.tokenizer = None
+        else:
+            import httpx
+            from openai import AsyncOpenAI, OpenAI
+
+            # Один долгоживущий HTTP-клиент с пулом keep-alive соединений (и HTTP/2, если доступен)
+            # на все параллельные запросы к API
+            self.http_client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                timeout=httpx.Timeout(60.0, connect=10.0)
+            )
+            self.async_client = AsyncOpenAI(api_key=openai_config['api_key'], http_client=self.http_client)
+            self.sync_client = OpenAI(api_key=openai_config['api_key'])
 
-        # Инициализация токенизатора для модели
-        # Используем соответствующий токенизатор для модели эмбеддингов
-        self.tokenizer = tiktoken.encoding_for_model(openai_config['model_embeddings'])
-        if not hasattr(tiktoken.model, openai_config['model_embeddings']):
-            # Если точная модель не найдена, используем cl100k_base (для text-embedding-3-*)
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")
+            # Инициализация токенизатора для модели
+            self.tokenizer = get_encoder(openai_config['model_embeddings'])
 
         # Статистика сессии
         self.stats = {
@@ -95,26 +194,45 @@ class EmbeddingProcessor:
             'failed_embeddings': 0,
             'skipped_texts': 0,
             'start_time': datetime.now(),
-            'domains_stats': {},
+            'domains_stats': defaultdict(lambda: {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0}),
             'tokens_sent': 0,
             'avg_tokens_per_text': 0,
             'batch_jobs': 0,
-            'batch_processing_time': 0
+            'batch_processing_time': 0,
+            'duplicate_texts': 0,
+            'truncated_texts': 0
         }
 
         # Информация о batch-заданиях для отслеживания
         self.batch_jobs = self.load_batch_jobs()
+        # Последнее записанное в файл состояние: неизмененная информация повторно не сохраняется
+        self.saved_batch_jobs = orjson.dumps(self.batch_jobs)
+
+        # Одно подключение к БД на весь запуск, создается при первом обращении
+        self.conn = None
 
     def connect_to_db(self):
         """Создание подключения к БД"""
+        import psycopg2
         return psycopg2.connect(**self.db_config)
 
+    def get_conn(self):
+        """Получение общего подключения к БД (переподключение, если оно было закрыто)"""
+        if self.conn is None or self.conn.closed:
+            self.conn = self.connect_to_db()
+        return self.conn
+
+    def close(self):
+        """Закрытие подключения к БД"""
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+
     def load_batch_jobs(self):
         """Загрузка информации о batch-заданиях из файла"""
         if os.path.exists(BATCH_INFO_FILE):
             try:
-                with open(BATCH_INFO_FILE, 'r') as f:
-                    return json.load(f)
+                with open(BATCH_INFO_FILE, 'rb') as f:
+                    return orjson.loads(f.read())
             except Exception as e:
                 logger.warning(f"Ошибка при загрузке информации о batch-заданиях: {e}")
                 return {'pending': [], 'completed': [], 'failed': []}
@@ -122,111 +240,175 @@ class EmbeddingProcessor:
             return {'pending': [], 'completed': [], 'failed': []}
 
     def save_batch_jobs(self):
-        """Сохранение информации о batch-заданиях в файл"""
+        """
+        Сохранение информации о batch-заданиях в файл.
+        Данные пишутся во временный файл, который затем атомарно заменяет основной,
+        чтобы сбой во время записи не уничтожил сведения об ожидающих заданиях.
+        Если информация не изменилась с последнего сохранения, запись пропускается
+        """
+        temp_path = BATCH_INFO_FILE + '.tmp'
         try:
-            with open(BATCH_INFO_FILE, 'w') as f:
-                json.dump(self.batch_jobs, f, indent=2)
+            data = orjson.dumps(self.batch_jobs)
+            if data == self.saved_batch_jobs:
+                return
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, BATCH_INFO_FILE)
+            self.saved_batch_jobs = data
             logger.info(f"Информация о batch-заданиях сохранена в {BATCH_INFO_FILE}")
         except Exception as e:
             logger.error(f"Ошибка при сохранении информации о batch-заданиях: {e}")
 
     def get_unprocessed_contents(self):
-        """Получение контента, для которого еще не созданы эмбеддинги"""
+        """
+        Получение контента, для которого еще не созданы эмбеддинги (генератор пакетов по BATCH_SIZE)
+        Строки читаются серверным курсором порциями, а не загружаются в память целиком
+        """
         # Получение ID страниц, для которых уже созданы batch-задания
         pending_ids = []
         for job in self.batch_jobs['pending']:
             pending_ids.extend(job.get('page_ids', []))
 
-        with self.connect_to_db() as conn:
-            with conn.cursor() as cursor:
+        with self.get_conn() as conn:
+            with conn.cursor(name='unprocessed_stream') as cursor:
+                cursor.itersize = BATCH_SIZE * 2
                 query = """
                 SELECT npc.id_page, npc.content, s.domain
                 FROM news_pages_content npc
                 LEFT JOIN content_embeddings ce ON npc.id_page = ce.id_page
+                -- Исключение страниц из ожидающих batch-заданий через anti-join вместо NOT IN
+                LEFT JOIN UNNEST(%s::bigint[]) AS pending(id_page) ON npc.id_page = pending.id_page
                 JOIN news_pages np ON npc.id_page = np.id_page
                 JOIN sitemaps s ON np.id_sitemap = s.id_sitemap
                 WHERE ce.id IS NULL
+                  AND pending.id_page IS NULL
                   AND npc.content IS NOT NULL
                   AND LENGTH(npc.content) >= %s
-                  AND npc.id_page NOT IN (
-                    SELECT UNNEST(%s::bigint[])
-                  )
                 ORDER BY npc.publication_date DESC
                 LIMIT %s
                 """
-                cursor.execute(query, (CONTENT_MIN_LENGTH, pending_ids if pending_ids else [0], TOTAL_LIMIT))
-                return cursor.fetchall()
+                cursor.execute(query, (pending_ids, CONTENT_MIN_LENGTH, TOTAL_LIMIT))
+                while batch := cursor.fetchmany(BATCH_SIZE):
+                    yield batch
+
+    def truncate_text_to_token_limit(self, text, tokens):
+        """
+        Обрезает текст до максимально допустимого количества токенов
+
+        :param text: Исходный текст
+        :param tokens: Токены текста
+        :return: Обрезанный текст и количество токенов
+        """
+        if len(tokens) <= MAX_CONTENT_LENGTH - 1:
+            return text, len(tokens)
+
+        # Обрезаем до MAX_CONTENT_LENGTH - 1 токенов, чтобы запрос не был отклонен API
+        truncated_tokens = tokens[:MAX_CONTENT_LENGTH - 1]
+        self.stats['truncated_texts'] += 1
+
+        return self.tokenizer.decode(truncated_tokens), len(truncated_tokens)
 
     def prepare_batch_file(self, contents):
         """
-        Подготовка JSONL файла для Batch API
+        Подготовка JSONL файла для Batch API в памяти
 
         :param contents: Список кортежей (id_page, content, domain)
-        :return: Путь к созданному JSONL файлу и словарь с токенами по доменам
+        :return: Буфер с содержимым JSONL файла, словарь с токенами по доменам, список ID страниц,
+                 список доменов страниц (в порядке page_ids) и список пар (id_page повтора, id_page первого экземпляра текста)
         """
-        fd, temp_path = tempfile.mkstemp(suffix='.jsonl')
-
         # Словарь для хранения информации о токенах по доменам
         domain_tokens = {}
         total_tokens = 0
         page_ids = []
-
-        with os.fdopen(fd, 'w') as f:
-            for i, (id_page, content, domain) in enumerate(contents):
-                if not content:
-                    logger.warning(f"Пропуск id_page={id_page} из-за пустого контента")
-                    self.stats['skipped_texts'] += 1
-                    if domain not in self.stats['domains_stats']:
-                        self.stats['domains_stats'][domain] = {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0}
-                    self.stats['domains_stats'][domain]['skipped'] += 1
-                    continue
-
-                # Сохраняем ID страницы для отслеживания
-                page_ids.append(id_page)
-
-                # Подсчет токенов в тексте
-                tokens = self.tokenizer.encode(content)
-                token_count = len(tokens)
-                total_tokens += token_count
-
-                # Обновление статистики токенов по доменам
-                if domain not in domain_tokens:
-                    domain_tokens[domain] = 0
-                domain_tokens[domain] += token_count
-
-                # Создание запроса для Batch API
-                request = {
-                    "custom_id": str(id_page),
-                    "method": "POST",
-                    "url": "/v1/embeddings",
-                    "body": {
-                        "model": self.openai_config['model_embeddings'],
-                        "input": content,
-                        "encoding_format": "float"
-                    }
+        page_domains = []
+
+        # Одинаковые тексты (перепечатки, зеркала) отправляются в API один раз,
+        # повторы получат эмбеддинг первого экземпляра после обработки результатов
+        first_pages = {}
+        duplicates = []
+        unique_contents = []
+        for id_page, content, domain in contents:
+            if not content:
+                logger.warning(f"Пропуск id_page={id_page} из-за пустого контента")
+                self.stats['skipped_texts'] += 1
+                self.stats['domains_stats'][domain]['skipped'] += 1
+                continue
+
+            # Сохраняем ID страницы для отслеживания
+            page_ids.append(id_page)
+            page_domains.append(domain)
+
+            encoded = content.encode('utf-8')
+            content_hash = hashlib.blake2b(encoded, digest_size=16).digest()
+            if content_hash in first_pages:
+                duplicates.append((id_page, first_pages[content_hash]))
+                continue
+            first_pages[content_hash] = id_page
+
+            # Каждый токен содержит хотя бы один байт, поэтому текст, длина которого в байтах
+            # не превышает лимит токенов, гарантированно не требует обрезки и может не токенизироваться
+            needs_tokens = self.precount_tokens or len(encoded) > MAX_CONTENT_LENGTH - 1
+            unique_contents.append((id_page, content, domain, needs_tokens))
+
+        # Токенизация нужных текстов пакета одним вызовом в пуле потоков tiktoken
+        token_lists = iter(self.tokenizer.encode_ordinary_batch(
+            [content for _, content, _, needs_tokens in unique_contents if needs_tokens], num_threads=os.cpu_count()
+        ))
+
+        # Файл собирается в памяти и передается в Files API без записи на диск;
+        # orjson сразу возвращает UTF-8 байты
+        buffer = io.BytesIO()
+        for id_page, content, domain, needs_tokens in unique_contents:
+            if needs_tokens:
+                # Обрезка длинного текста по уже полученным токенам
+                content, token_count = self.truncate_text_to_token_limit(content, next(token_lists))
+            else:
+                # Приближенная оценка для логов, точное число токенов берется из результатов задания
+                token_count = len(content) // 4
+            total_tokens += token_count
+
+            # Обновление статистики токенов по доменам
+            if domain not in domain_tokens:
+                domain_tokens[domain] = 0
+            domain_tokens[domain] += token_count
+
+            # Создание запроса для Batch API
+            request = {
+                "custom_id": str(id_page),
+                "method": "POST",
+                "url": "/v1/embeddings",
+                "body": {
+                    "model": self.openai_config['model_embeddings'],
+                    "input": content,
+                    "encoding_format": "float"
                 }
+            }
 
-                f.write(json.dumps(request) + '\n')
-                self.stats['processed_texts'] += 1
+            buffer.write(orjson.dumps(request) + b'\n')
+            self.stats['processed_texts'] += 1
 
-        logger.info(f"Создан JSONL файл с {self.stats['processed_texts']} запросами, всего токенов: {total_tokens}")
-        self.stats['tokens_sent'] += total_tokens
+        tokens_note = "" if self.precount_tokens else " (оценка)"
+        logger.info(f"Создан JSONL файл с {self.stats['processed_texts']} запросами, всего токенов{tokens_note}: {total_tokens}")
+        if duplicates:
+            logger.info(f"Повторов текста в пакете: {len(duplicates)}")
 
-        return temp_path, domain_tokens, page_ids
+        buffer.seek(0)
+        return buffer, domain_tokens, page_ids, page_domains, duplicates
 
-    def upload_batch_file(self, file_path):
+    def upload_batch_file(self, buffer):
         """
         Загрузка JSONL файла через Files API
 
-        :param file_path: Путь к JSONL файлу
+        :param buffer: Буфер с содержимым JSONL файла
         :return: ID загруженного файла
         """
         try:
-            with open(file_path, 'rb') as file:
-                response = self.sync_client.files.create(
-                    file=file,
-                    purpose="batch"
-                )
+            response = self.sync_client.files.create(
+                file=('batch.jsonl', buffer, 'application/jsonl'),
+                purpose="batch"
+            )
             logger.info(f"Файл успешно загружен, ID: {response.id}")
             return response.id
         except Exception as e:
@@ -253,20 +435,27 @@ class EmbeddingProcessor:
             logger.error(f"Ошибка при создании batch-задания: {e}")
             raise
 
-    def wait_for_batch_completion(self, batch_id):
+    async def wait_for_batch_completion(self, batch_id):
         """
-        Ожидание завершения batch-задания с периодической проверкой статуса
+        Ожидание завершения batch-задания с периодической проверкой статуса.
+        Интервал проверки удваивается до BATCH_CHECK_MAX_INTERVAL, ожидание не блокирует цикл событий
 
         :param batch_id: ID batch-задания
         :return: Объект batch с результатами
         """
         start_time = time.time()
         wait_time = 0
+        interval = BATCH_CHECK_INTERVAL
 
         logger.info(f"Ожидание завершения batch-задания {batch_id}...")
 
         while wait_time < BATCH_MAX_WAIT_TIME:
-            batch = self.sync_client.batches.retrieve(batch_id)
+            if self.shutdown_event.is_set():
+                logger.warning(f"Ожидание batch-задания {batch_id} прервано по сигналу завершения")
+                return None
+
+            async with self.semaphore:
+                batch = await self.async_client.batches.retrieve(batch_id)
 
             if batch.status in ["completed", "failed", "expired", "cancelled"]:
                 end_time = time.time()
@@ -280,20 +469,25 @@ class EmbeddingProcessor:
                 elif batch.status in ["failed", "expired", "cancelled"]:
                     logger.error(f"Batch-задание завершилось с ошибкой. Статус: {batch.status}")
                     if batch.status == "failed" and batch.error_file_id:
-                        error_content = self.sync_client.files.content(batch.error_file_id)
+                        error_content = await self.async_client.files.content(batch.error_file_id)
                         logger.error(f"Ошибки: {error_content.text[:500]}...")
 
                 return batch
 
             wait_time = time.time() - start_time
             logger.info(f"Ожидание... Текущий статус: {batch.status}, прошло {wait_time:.2f} секунд")
-            time.sleep(BATCH_CHECK_INTERVAL)
+            # Пауза до следующей проверки, прерываемая сигналом завершения
+            try:
+                await asyncio.wait_for(self.shutdown_event.wait(), timeout=interval)
+            except TimeoutError:
+                pass
+            interval = min(interval * 2, BATCH_CHECK_MAX_INTERVAL)
 
         # Если превышено максимальное время ожидания
         logger.error(f"Превышено максимальное время ожидания ({BATCH_MAX_WAIT_TIME} секунд) для batch-задания {batch_id}")
         return None
 
-    def check_batch_status(self, batch_id):
+    async def check_batch_status(self, batch_id):
         """
         Проверка статуса batch-задания без ожидания
 
@@ -301,18 +495,21 @@ class EmbeddingProcessor:
         :return: Статус задания и объект batch
         """
         try:
-            batch = self.sync_client.batches.retrieve(batch_id)
+            async with self.semaphore:
+                batch = await self.async_client.batches.retrieve(batch_id)
             return batch.status, batch
         except Exception as e:
             logger.error(f"Ошибка при проверке статуса batch-задания {batch_id}: {e}")
             return "error", None
 
-    def process_batch_results(self, batch, domain_tokens):
+    def process_batch_results(self, batch, domain_tokens, page_domains=None, duplicates=None):
         """
         Обработка результатов batch-задания и сохранение эмбеддингов в БД
 
         :param batch: Объект batch с результатами
         :param domain_tokens: Словарь с токенами по доменам
+        :param page_domains: Словарь {id_page: домен} для точного учета результатов по доменам
+        :param duplicates: Список пар (id_page повтора, id_page первого экземпляра текста)
         :return: Количество успешно обработанных эмбеддингов
         """
         if not batch or not batch.output_file_id:
@@ -320,83 +517,106 @@ class EmbeddingProcessor:
             return 0
 
         try:
-            # Получение результатов
-            output_content = self.sync_client.files.content(batch.output_file_id)
-            output_text = output_content.text
-
-            # Обработка ошибок, если они есть
+            # Обработка ошибок, если они есть (файл читается построчно по мере загрузки)
             error_data = {}
             if batch.error_file_id:
-                error_content = self.sync_client.files.content(batch.error_file_id)
-                for line in error_content.text.strip().split('\n'):
-                    error_obj = json.loads(line)
-                    error_data[error_obj['custom_id']] = error_obj['error']
+                with self.sync_client.files.with_streaming_response.content(batch.error_file_id) as error_content:
+                    for error_obj in iter_jsonl(error_content):
+                        error_data[error_obj['custom_id']] = error_obj['error']
 
             # Парсинг результатов
             embeddings = []
             successful_count = 0
             failed_count = 0
-
-            # Обработка каждой строки результатов
-            with self.connect_to_db() as conn:
+            # Страницы по результату для учета статистики по доменам
+            succeeded_ids = []
+            failed_ids = []
+            # Точное число токенов по данным API (id_page -> токены)
+            page_tokens = {}
+
+            # Обработка каждой строки результатов: файл не загружается в память целиком,
+            # строки разбираются по мере получения и загружаются через COPY пачками.
+            # Все результаты задания сохраняются в одной транзакции с одной фиксацией
+            with self.get_conn() as conn, \
+                    self.sync_client.files.with_streaming_response.content(batch.output_file_id) as output_content:
                 with conn.cursor() as cursor:
-                    for line in output_text.strip().split('\n'):
-                        result = json.loads(line)
+                    for result in iter_jsonl(output_content):
                         custom_id = result['custom_id']
                         id_page = int(custom_id)
 
                         # Проверка наличия ошибки
                         if result.get('error') or result['response']['status_code'] != 200:
                             failed_count += 1
+                            failed_ids.append(id_page)
                             logger.error(f"Ошибка при получении эмбеддинга для id_page={id_page}: {result.get('error')}")
                             continue
 
-                        # Извлечение эмбеддинга
+                        # Извлечение эмбеддинга и числа оплаченных токенов
                         response_body = result['response']['body']
                         embedding = response_body['data'][0]['embedding']
+                        usage = response_body.get('usage')
+                        page_tokens[id_page] = usage['total_tokens'] if usage else 0
 
-                        # Добавление в список для пакетной вставки
-                        embeddings.append((id_page, embedding))
+                        # Добавление в список для пакетной вставки в компактном бинарном виде
+                        embeddings.append((id_page, pack_halfvec(embedding)))
                         successful_count += 1
+                        succeeded_ids.append(id_page)
 
-                        # Пакетная вставка каждые 100 эмбеддингов для экономии памяти
+                        # Загрузка каждых 100 эмбеддингов для экономии памяти
                         if len(embeddings) >= 100:
-                            execute_values(
-                                cursor,
-                                "INSERT INTO content_embeddings (id_page, embedding) VALUES %s ON CONFLICT (id_page) DO UPDATE SET embedding = EXCLUDED.embedding",
-                                embeddings,
-                                template="(%s, %s)"
-                            )
-                            conn.commit()
+                            self.copy_embeddings(cursor, embeddings)
                             embeddings = []
 
-                    # Вставка оставшихся эмбеддингов
+                    # Загрузка оставшихся эмбеддингов и перенос всех в content_embeddings
                     if embeddings:
-                        execute_values(
-                            cursor,
-                            "INSERT INTO content_embeddings (id_page, embedding) VALUES %s ON CONFLICT (id_page) DO UPDATE SET embedding = EXCLUDED.embedding",
-                            embeddings,
-                            template="(%s, %s)"
-                        )
-                        conn.commit()
+                        self.copy_embeddings(cursor, embeddings)
+                    if successful_count:
+                        self.move_copied_embeddings(cursor)
+
+                    # Копирование эмбеддингов первых экземпляров текста их повторам одним запросом
+                    if duplicates:
+                        duplicate_ids, source_ids = zip(*duplicates)
+                        cursor.execute("""
+                        INSERT INTO content_embeddings (id_page, embedding)
+                        SELECT d.id_page, ce.embedding
+                        FROM unnest(%s::int[], %s::int[]) AS d(id_page, source_id)
+                        JOIN content_embeddings ce ON ce.id_page = d.source_id
+                        ON CONFLICT (id_page) DO UPDATE SET embedding = EXCLUDED.embedding
+                        RETURNING id_page
+                        """, (list(duplicate_ids), list(source_ids)))
+                        copied_ids = {id_page for id_page, in cursor.fetchall()}
+                        successful_count += len(copied_ids)
+                        self.stats['duplicate_texts'] += len(copied_ids)
+                        succeeded_ids.extend(copied_ids)
+
+                        # Повторы текстов, для которых эмбеддинг не получен, считаются неудачными
+                        missed_ids = [id_page for id_page in duplicate_ids if id_page not in copied_ids]
+                        failed_count += len(missed_ids)
+                        failed_ids.extend(missed_ids)
 
             # Обновление статистики
             self.stats['successful_embeddings'] += successful_count
             self.stats['failed_embeddings'] += failed_count
+            self.stats['tokens_sent'] += sum(page_tokens.values())
 
             # Обновление статистики по доменам
-            for domain, tokens in domain_tokens.items():
-                if domain not in self.stats['domains_stats']:
-                    self.stats['domains_stats'][domain] = {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0}
-
-                # Пропорционально распределяем успехи и неудачи по доменам на основе их доли токенов
-                domain_ratio = tokens / sum(domain_tokens.values()) if sum(domain_tokens.values()) > 0 else 0
-                domain_success = round(successful_count * domain_ratio)
-                domain_failed = round(failed_count * domain_ratio)
-
-                self.stats['domains_stats'][domain]['success'] += domain_success
-                self.stats['domains_stats'][domain]['failed'] += domain_failed
-                self.stats['domains_stats'][domain]['tokens'] += tokens
+            if page_domains is None:
+                # Для заданий без сохраненных доменов страниц успехи и неудачи распределяются
+                # пропорционально доле токенов домена, токены берутся из оценки при создании задания
+                total_tokens = sum(domain_tokens.values()) or 1
+                for domain, tokens in domain_tokens.items():
+                    domain_ratio = tokens / total_tokens
+                    self.stats['domains_stats'][domain]['tokens'] += tokens
+                    self.stats['domains_stats'][domain]['success'] += round(successful_count * domain_ratio)
+                    self.stats['domains_stats'][domain]['failed'] += round(failed_count * domain_ratio)
+            else:
+                # Точный учет результата и токенов каждой страницы по ее домену
+                for id_page in succeeded_ids:
+                    self.stats['domains_stats'][page_domains[id_page]]['success'] += 1
+                for id_page in failed_ids:
+                    self.stats['domains_stats'][page_domains[id_page]]['failed'] += 1
+                for id_page, tokens in page_tokens.items():
+                    self.stats['domains_stats'][page_domains[id_page]]['tokens'] += tokens
 
             logger.info(f"Обработано эмбеддингов: {successful_count} успешно, {failed_count} с ошибками")
             return successful_count
@@ -409,27 +629,20 @@ class EmbeddingProcessor:
         """
         Создание batch-заданий без ожидания результатов
         """
-        contents = self.get_unprocessed_contents()
-        total = len(contents)
-        self.stats['total_texts'] = total
-
-        if total == 0:
-            logger.info("Все тексты уже обработаны или находятся в очереди на обработку")
-            return
-
-        logger.info(f"Найдено {total} текстов для обработки через Batch API")
-
-        # Разбиение на пакеты
-        for i in range(0, total, BATCH_SIZE):
-            batch_contents = contents[i:i+BATCH_SIZE]
-            logger.info(f"Создание пакета {i//BATCH_SIZE + 1}/{(total+BATCH_SIZE-1)//BATCH_SIZE} ({len(batch_contents)} текстов)")
+        # Общее число текстов заранее неизвестно: строки читаются потоком пакетами по BATCH_SIZE
+        for batch_number, batch_contents in enumerate(self.get_unprocessed_contents(), 1):
+            if self.shutdown_event.is_set():
+                logger.warning("Создание batch-заданий остановлено по сигналу завершения")
+                break
+            self.stats['total_texts'] += len(batch_contents)
+            logger.info(f"Создание пакета {batch_number} ({len(batch_contents)} текстов)")
 
             try:
                 # Шаг 1: Подготовка JSONL файла
-                batch_file_path, domain_tokens, page_ids = self.prepare_batch_file(batch_contents)
+                batch_file, domain_tokens, page_ids, page_domains, duplicates = self.prepare_batch_file(batch_contents)
 
                 # Шаг 2: Загрузка файла
-                file_id = self.upload_batch_file(batch_file_path)
+                file_id = self.upload_batch_file(batch_file)
 
                 # Шаг 3: Создание batch-задания
                 batch_id = self.create_batch_job(file_id)
@@ -441,21 +654,22 @@ class EmbeddingProcessor:
                     'created_at': datetime.now().isoformat(),
                     'status': 'pending',
                     'page_ids': page_ids,
-                    'domain_tokens': domain_tokens
+                    'page_domains': page_domains,
+                    'domain_tokens': domain_tokens,
+                    'duplicates': duplicates
                 }
 
                 self.batch_jobs['pending'].append(job_info)
                 self.save_batch_jobs()
 
-                # Очистка временного файла
-                try:
-                    os.remove(batch_file_path)
-                except Exception as e:
-                    logger.warning(f"Не удалось удалить временный файл {batch_file_path}: {e}")
-
             except Exception as e:
                 logger.error(f"Ошибка при создании batch-задания: {e}")
 
+        if self.stats['total_texts'] == 0:
+            logger.info("Все тексты уже обработаны или находятся в очереди на обработку")
+            return
+
+        logger.info(f"Найдено {self.stats['total_texts']} текстов для обработки через Batch API")
         logger.info(f"Создано {self.stats['batch_jobs']} batch-заданий")
 
     async def check_pending_batches(self):
@@ -468,33 +682,52 @@ class EmbeddingProcessor:
 
         logger.info(f"Проверка статуса {len(self.batch_jobs['pending'])} ожидающих batch-заданий")
 
-        # Создаем копию списка, т.к. будем его изменять
-        pending_jobs = self.batch_jobs['pending'].copy()
+        pending_jobs = self.batch_jobs['pending']
+        # Задания, которые остаются в ожидании (список пересобирается за один проход)
+        still_pending = []
 
-        for job in pending_jobs:
+        # Статусы заданий запрашивают max_concurrency воркеров из общей очереди,
+        # результаты обрабатываются последовательно в исходном порядке
+        statuses = [("not_checked", None)] * len(pending_jobs)
+        queue = asyncio.Queue()
+        for index, job in enumerate(pending_jobs):
+            queue.put_nowait((index, job['batch_id']))
+
+        async def worker():
+            # После сигнала завершения новые задания не проверяются и остаются в ожидании
+            while not queue.empty() and not self.shutdown_event.is_set():
+                index, batch_id = queue.get_nowait()
+                statuses[index] = await self.check_batch_status(batch_id)
+
+        async with asyncio.TaskGroup() as task_group:
+            for _ in range(min(self.max_concurrency, len(pending_jobs))):
+                task_group.create_task(worker())
+
+        for job, (status, batch) in zip(pending_jobs, statuses):
             batch_id = job['batch_id']
-            status, batch = self.check_batch_status(batch_id)
 
             logger.info(f"Статус задания {batch_id}: {status}")
 
-            if status in ["completed", "failed", "expired", "cancelled"]:
+            if status not in ["completed", "failed", "expired", "cancelled"] or self.shutdown_event.is_set():
+                still_pending.append(job)
+            else:
                 # Обновляем информацию о задании
                 job['status'] = status
                 job['completed_at'] = datetime.now().isoformat()
 
                 # Обрабатываем результаты для завершенных заданий
                 if status == "completed":
-                    result_count = self.process_batch_results(batch, job['domain_tokens'])
+                    page_domains = dict(zip(job['page_ids'], job['page_domains'])) if 'page_domains' in job else None
+                    result_count = self.process_batch_results(batch, job['domain_tokens'], page_domains, job.get('duplicates'))
                     job['processed_count'] = result_count
                     self.batch_jobs['completed'].append(job)
                 else:
                     self.batch_jobs['failed'].append(job)
 
-                # Удаляем из списка ожидающих
-                self.batch_jobs['pending'].remove(job)
-
                 logger.info(f"Задание {batch_id} перемещено в список {status}")
 
+        self.batch_jobs['pending'] = still_pending
+
         # Сохраняем обновленную информацию
         self.save_batch_jobs()
 
@@ -515,7 +748,20 @@ class EmbeddingProcessor:
         else:
             # Полный цикл: создание и проверка
             await self.create_batches()
-            await self.check_pending_batches()
+            if not self.shutdown_event.is_set():
+                await self.check_pending_batches()
+
+    def request_shutdown(self):
+        """Обработчик SIGINT/SIGTERM: первый сигнал завершает работу штатно, повторный - прерывает сразу"""
+        if self.shutdown_event.is_set():
+            raise KeyboardInterrupt
+        logger.warning("Получен сигнал завершения, текущие операции будут завершены и сохранены")
+        self.shutdown_event.set()
+
+    async def aclose(self):
+        """Закрытие асинхронного HTTP-клиента"""
+        if self.async_client is not None:
+            await self.async_client.close()
 
     async def process_batch(self, contents):
         """
@@ -531,27 +777,19 @@ class EmbeddingProcessor:
 
         try:
             # Шаг 1: Подготовка JSONL файла
-            batch_file_path, domain_tokens, _ = self.prepare_batch_file(contents)
+            batch_file, domain_tokens, page_ids, page_domains, duplicates = self.prepare_batch_file(contents)
 
             # Шаг 2: Загрузка файла
-            file_id = self.upload_batch_file(batch_file_path)
+            file_id = self.upload_batch_file(batch_file)
 
             # Шаг 3: Создание batch-задания
             batch_id = self.create_batch_job(file_id)
 
             # Шаг 4: Ожидание завершения
-            batch = self.wait_for_batch_completion(batch_id)
+            batch = await self.wait_for_batch_completion(batch_id)
 
             # Шаг 5: Обработка результатов
-            result_count = self.process_batch_results(batch, domain_tokens)
-
-            # Очистка временного файла
-            try:
-                os.remove(batch_file_path)
-            except Exception as e:
-                logger.warning(f"Не удалось удалить временный файл {batch_file_path}: {e}")
-
-            return result_count
+            return self.process_batch_results(batch, domain_tokens, dict(zip(page_ids, page_domains)), duplicates)
 
         except Exception as e:
             logger.error(f"Ошибка при обработке пакета через Batch API: {e}")
@@ -583,10 +821,8 @@ class EmbeddingProcessor:
 
                     # Обновление статистики успешной обработки
                     self.stats['successful_embeddings'] += 1
-                    if domain not in self.stats['domains_stats']:
-                        self.stats['domains_stats'][domain] = {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0}
                     self.stats['domains_stats'][domain]['success'] += 1
-                    self.stats['domains_stats'][domain]['tokens'] = self.stats['domains_stats'][domain].get('tokens', 0) + token_count
+                    self.stats['domains_stats'][domain]['tokens'] += token_count
 
                     return id_page, embedding
                 except Exception as e:
@@ -598,12 +834,43 @@ class EmbeddingProcessor:
 
                         # Обновление статистики неудачной обработки
                         self.stats['failed_embeddings'] += 1
-                        if domain not in self.stats['domains_stats']:
-                            self.stats['domains_stats'][domain] = {'success': 0, 'failed': 0, 'skipped': 0, 'tokens': 0}
                         self.stats['domains_stats'][domain]['failed'] += 1
 
                         raise
 
+    def copy_embeddings(self, cursor, embeddings):
+        """
+        Загрузка порции эмбеддингов через COPY во временную таблицу.
+        Таблица создается при первой порции и удаляется при фиксации транзакции
+
+        :param cursor: Курсор открытой транзакции
+        :param embeddings: Список кортежей (id_page, эмбеддинг, упакованный pack_halfvec)
+        """
+        # Строки передаются в бинарном формате COPY: два поля - integer и halfvec
+        buffer = io.BytesIO()
+        buffer.write(COPY_BINARY_HEADER)
+        for id_page, packed_embedding in embeddings:
+            buffer.write(struct.pack('>hii', 2, 4, id_page))
+            buffer.write(struct.pack('>i', len(packed_embedding)))
+            buffer.write(packed_embedding)
+        buffer.write(COPY_BINARY_TRAILER)
+        buffer.seek(0)
+
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_embeddings (id_page integer, embedding halfvec) ON COMMIT DROP")
+        cursor.copy_expert("COPY tmp_embeddings (id_page, embedding) FROM STDIN WITH (FORMAT binary)", buffer)
+
+    def move_copied_embeddings(self, cursor):
+        """
+        Перенос загруженных во временную таблицу эмбеддингов в content_embeddings одним запросом
+
+        :param cursor: Курсор транзакции, в которой выполнялся copy_embeddings
+        """
+        cursor.execute("""
+        INSERT INTO content_embeddings (id_page, embedding)
+        SELECT id_page, embedding FROM tmp_embeddings
+        ON CONFLICT (id_page) DO UPDATE SET embedding = EXCLUDED.embedding
+        """)
+
     def save_embeddings(self, embeddings):
         """
         Сохранение эмбеддингов в БД
@@ -613,18 +880,10 @@ class EmbeddingProcessor:
         if not embeddings:
             return
 
-        with self.connect_to_db() as conn:
+        with self.get_conn() as conn:
             with conn.cursor() as cursor:
-                # Подготовка данных для вставки
-                values = [(id_page, embedding) for id_page, embedding in embeddings]
-
-                # Вставка данных с использованием execute_values для эффективности
-                execute_values(
-                    cursor,
-                    "INSERT INTO content_embeddings (id_page, embedding) VALUES %s ON CONFLICT (id_page) DO UPDATE SET embedding = EXCLUDED.embedding",
-                    values,
-                    template="(%s, %s)"
-                )
+                self.copy_embeddings(cursor, [(id_page, pack_halfvec(embedding)) for id_page, embedding in embeddings])
+                self.move_copied_embeddings(cursor)
 
             conn.commit()
 
@@ -648,6 +907,8 @@ class EmbeddingProcessor:
             ["Успешно созданных эмбеддингов", self.stats['successful_embeddings']],
             ["Неудачных попыток", self.stats['failed_embeddings']],
             ["Пропущенных текстов", self.stats['skipped_texts']],
+            ["Повторов текста в пакетах", self.stats['duplicate_texts']],
+            ["Обрезанных текстов", self.stats['truncated_texts']],
             ["Всего отправлено токенов", f"{self.stats['tokens_sent']:,}".replace(',', ' ')],
             ["Среднее кол-во токенов на текст", f"{self.stats['avg_tokens_per_text']:.1f}"],
             ["Стоимость API (с 50% скидкой Batch API)", f"${cost:.6f}"],
@@ -725,45 +986,82 @@ class EmbeddingProcessor:
             ))
 
 def parse_args():
-    """Парсинг аргументов командной строки"""
+    """
+    Парсинг аргументов командной строки.
+    Запуск без аргументов или только с --mode разбирается напрямую, без построения argparse
+    """
+    argv = sys.argv[1:]
+    mode = None
+    if not argv:
+        mode = 'full'
+    elif len(argv) == 1 and argv[0].startswith('--mode='):
+        mode = argv[0].removeprefix('--mode=')
+    elif len(argv) == 2 and argv[0] == '--mode':
+        mode = argv[1]
+    if mode in MODES:
+        return SimpleNamespace(mode=mode, max_concurrency=CONCURRENCY_LIMIT, precount_tokens=False)
+
+    # Остальные варианты (в том числе --help и ошибки) обрабатывает argparse
+    import argparse
     parser = argparse.ArgumentParser(description='Создание эмбеддингов для текстов через Batch API OpenAI')
-    parser.add_argument('--mode', type=str, choices=['full', 'create', 'check', 'status'], default='full',
+    parser.add_argument('--mode', type=str, choices=MODES, default='full',
                         help='Режим работы: full (полный цикл), create (только создание заданий), '
                              'check (проверка и обработка результатов), status (вывод текущего статуса)')
+    parser.add_argument('--max-concurrency', type=int, default=CONCURRENCY_LIMIT,
+                        help=f'Максимальное число одновременных запросов к API (по умолчанию {CONCURRENCY_LIMIT})')
+    parser.add_argument('--precount-tokens', action='store_true',
+                        help='Точно подсчитывать токены всех текстов при создании заданий '
+                             '(по умолчанию токенизируются только тексты, которые могут потребовать обрезки)')
     return parser.parse_args()
 
 def main():
     args = parse_args()
-    start_time = time.time()
+    start_ns = time.perf_counter_ns()
     processor = None
 
     try:
-        # Загрузка конфигурации из файла
-        db_config, openai_config = load_config()
+        # Загрузка конфигурации из файла (для вывода статуса параметры БД не нужны)
+        db_config, openai_config = load_config(with_db=args.mode != 'status')
 
         # Создание процессора эмбеддингов
-        processor = EmbeddingProcessor(db_config, openai_config)
+        processor = EmbeddingProcessor(db_config, openai_config, precount_tokens=args.precount_tokens,
+                                        max_concurrency=args.max_concurrency, status_only=args.mode == 'status')
 
         if args.mode == 'status':
             # Только вывод статуса batch-заданий
             processor.print_batch_status()
         else:
-            # Запуск обработки в выбранном режиме
-            asyncio.run(processor.process_all(args.mode))
-            logger.info(f"Обработка в режиме '{args.mode}' завершена успешно")
+            # Запуск обработки в выбранном режиме; закрытие асинхронного клиента
+            # выполняется в том же цикле событий, без создания нового
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+                # Сигналы завершения обрабатываются в цикле событий, а не исключением посреди await
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    try:
+                        runner.get_loop().add_signal_handler(sig, processor.request_shutdown)
+                    except NotImplementedError:
+                        # На Windows обработчики сигналов цикла событий не поддерживаются
+                        pass
+                try:
+                    runner.run(processor.process_all(args.mode))
+                finally:
+                    runner.run(processor.aclose())
+            elapsed_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
+            logger.info(f"Обработка в режиме '{args.mode}' завершена успешно за {elapsed_ms} мс")
 
             # Вывод статистики
             processor.print_stats()
             processor.print_batch_status()
 
     except KeyboardInterrupt:
-        logger.info("Обработка прервана пользователем")
+        elapsed_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
+        logger.info(f"Обработка в режиме '{args.mode}' прервана пользователем через {elapsed_ms} мс")
     except Exception as e:
         logger.error(f"Ошибка при выполнении: {e}", exc_info=True)
     finally:
         # Сохранение информации о batch-заданиях, если был создан процессор
         if processor:
             processor.save_batch_jobs()
+            processor.close()
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,37 @@
 #!/usr/bin/env python
-import requests
-import xml.etree.ElementTree as ET
+import httpx
+import importlib.util
+from lxml import etree
 import re
 import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import datetime
 import dateparser
 import configparser
-import json
+import orjson
+import gzip
 import os
 from loguru import logger
 from urllib.parse import urlparse
 from dataclasses import dataclass
-from typing import List, Optional, Dict, Any
+from contextlib import contextmanager, nullcontext
+from typing import List, Optional, Dict, Any, Iterator
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from collections import defaultdict
+from functools import lru_cache
 from dateutil.relativedelta import relativedelta
 from tabulate import tabulate
 
+# Быстрый C-парсер ISO-8601, если установлен ciso8601
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
 # Настройка логирования с помощью loguru
 # Удаляем стандартный обработчик
 logger.remove()
@@ -49,9 +63,93 @@ HEADERS = {
 }
 MAX_RETRIES = 3
 RETRY_DELAY = 1
-MAX_WORKERS = 5
+MAX_WORKERS = 5  # Потоков на один домен
+MAX_DOMAIN_WORKERS = 4  # Доменов, обрабатываемых одновременно (по процессу на домен)
+# Подключений к БД в процессе-воркере: по одному на поток дочерних sitemap и два у потока разбора
+# мастер-sitemap (его подключение плюс загрузка кэша свежести). Родительский процесс подключений
+# не держит, всего за запуск открывается MAX_DOMAIN_WORKERS * DB_POOL_SIZE подключений
+DB_POOL_SIZE = MAX_WORKERS + 2
 MAX_REDIRECTS = 5  # Максимальное количество редиректов
 TIMEOUT = 60
+# Размер пула keep-alive соединений HTTP-клиента
+HTTP_POOL_SIZE = 32
+# HTTP-статусы, при которых загрузка повторяется
+RETRY_STATUSES = {502, 503, 504}
+# HTTP/2 доступен только при установленном пакете h2
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+# Количество страниц, накапливаемых перед пакетной вставкой в БД (весь пакет - один INSERT)
+PAGE_BATCH_SIZE = 10000
+# Количество дочерних sitemap, сохраняемых одним запросом при разборе мастер-sitemap
+SITEMAP_BATCH_SIZE = 100
+# Ответы не больше этого размера (в байтах) разбираются целиком, а не потоково
+SMALL_XML_SIZE = 64 * 1024
+# Начиная с этого количества строк таблицы выводятся без рамок
+LARGE_TABLE_ROWS = 1000
+# Настройки парсеров lxml: терпимость к ошибкам разметки, без комментариев, PI, индекса id,
+# подстановки сущностей и сетевых запросов за DTD
+XML_PARSER_OPTIONS = {
+    'recover': True,
+    'huge_tree': True,
+    'remove_comments': True,
+    'remove_pis': True,
+    'collect_ids': False,
+    'resolve_entities': False,
+    'no_network': True
+}
+
+# Частые запросы, которые подготавливаются один раз на каждом подключении пула
+PREPARED_STATEMENTS = [
+    """
+    PREPARE save_sitemap_stmt (text, text, boolean, integer, timestamptz, boolean) AS
+    INSERT INTO sitemaps (domain, sitemap_url, is_master, parent_id, last_mod, is_fresh)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (sitemap_url) DO UPDATE
+    SET is_fresh = EXCLUDED.is_fresh OR sitemaps.is_fresh
+    RETURNING id_sitemap, (xmax = 0) AS inserted, is_fresh, is_master
+    """,
+    """
+    PREPARE update_freshness_stmt (boolean, integer) AS
+    UPDATE sitemaps SET is_fresh = $1, processed_at = NOW() WHERE id_sitemap = $2
+    RETURNING sitemap_url, is_fresh, is_master
+    """,
+    """
+    PREPARE domain_exists_stmt (text) AS
+    SELECT EXISTS (SELECT 1 FROM sitemaps WHERE domain = $1)
+    """
+]
+
+# Регулярные выражения, компилируемые один раз при импорте
+RE_HTML_TAG = re.compile(r'<[^>]+>')
+RE_CDATA = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+
+# Теги (локальные имена) с датой публикации в порядке приоритета:
+# lastmod, news:publication_date и распространенные нестандартные варианты
+DATE_TAG_PRIORITY = {
+    name: priority for priority, name in enumerate([
+        'lastmod', 'publication_date', 'pubDate', 'date', 'updated',
+        'modified', 'published', 'created', 'issued', 'time'
+    ])
+}
+
+# XPath-выражения без привязки к пространству имен: текст прямых потомков и все теги с датами
+CHILD_TEXT_XPATHS = {
+    name: f"*[local-name()='{name}']/text()" for name in ('loc', 'lastmod')
+}
+DATE_TAGS_XPATH = ".//*[" + " or ".join(f"local-name()='{name}'" for name in DATE_TAG_PRIORITY) + "]"
+# Хранилище скомпилированных XPath для каждого потока
+xpath_cache = threading.local()
+
+# Форматы дат, которые пробуются, если dateparser не смог распознать дату
+DATE_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S%z',
+    '%Y-%m-%dT%H:%M:%S.%f%z',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%d.%m.%Y %H:%M:%S',
+    '%d.%m.%Y',
+    '%Y/%m/%d',
+    '%d/%m/%Y'
+]
 
 # Функция для вычисления минимальной даты на основе текущей даты и количества месяцев
 def get_min_date() -> datetime.datetime:
@@ -98,6 +196,39 @@ class SiteStats:
         if self.max_date is None or date > self.max_date:
             self.max_date = date
 
+    def to_tuple(self) -> tuple:
+        """Компактное представление для передачи между процессами: даты как POSIX-время."""
+        return (
+            self.sitemaps_processed,
+            self.pages_added,
+            self.pages_skipped,
+            self.pages_no_date,
+            self.min_date.timestamp() if self.min_date else None,
+            self.max_date.timestamp() if self.max_date else None
+        )
+
+    @classmethod
+    def from_tuple(cls, values: tuple) -> 'SiteStats':
+        """Восстанавливает статистику из результата to_tuple."""
+        sitemaps_processed, pages_added, pages_skipped, pages_no_date, min_ts, max_ts = values
+        return cls(
+            sitemaps_processed=sitemaps_processed,
+            pages_added=pages_added,
+            pages_skipped=pages_skipped,
+            pages_no_date=pages_no_date,
+            min_date=datetime.datetime.fromtimestamp(min_ts, datetime.timezone.utc) if min_ts is not None else None,
+            max_date=datetime.datetime.fromtimestamp(max_ts, datetime.timezone.utc) if max_ts is not None else None
+        )
+
+    def merge(self, other: 'SiteStats'):
+        """Добавляет статистику, собранную в другом процессе."""
+        self.sitemaps_processed += other.sitemaps_processed
+        self.pages_added += other.pages_added
+        self.pages_skipped += other.pages_skipped
+        self.pages_no_date += other.pages_no_date
+        self.update_date_range(other.min_date)
+        self.update_date_range(other.max_date)
+
 # Датаклассы для хранения информации
 @dataclass
 class Sitemap:
@@ -120,49 +251,113 @@ def get_domain(url: str) -> str:
     parsed_url = urlparse(url)
     return parsed_url.netloc
 
+def local_name(tag) -> str:
+    """Вернуть имя тега без пространства имен (для комментариев и PI - пустую строку)."""
+    return tag.rpartition('}')[2] if isinstance(tag, str) else ''
+
+def compiled_xpath(expression: str) -> etree.XPath:
+    """Вернуть скомпилированное XPath-выражение; объекты XPath не разделяются между потоками."""
+    expressions = getattr(xpath_cache, 'expressions', None)
+    if expressions is None:
+        expressions = xpath_cache.expressions = {}
+
+    xpath = expressions.get(expression)
+    if xpath is None:
+        xpath = expressions[expression] = etree.XPath(expression)
+    return xpath
+
+def find_child_text(elem, name: str) -> Optional[str]:
+    """Найти непустой текст прямого потомка с указанным локальным именем тега (loc или lastmod)."""
+    # Обычно потомок в том же пространстве имен, что и родитель: прямой поиск без XPath
+    namespace = elem.tag[:elem.tag.rfind('}') + 1]
+    text = elem.findtext(namespace + name)
+    if text and text.strip():
+        return text.strip()
+
+    # Нестандартные документы: ищем по локальному имени в любом пространстве имен
+    for text in compiled_xpath(CHILD_TEXT_XPATHS[name])(elem):
+        text = text.strip()
+        if text:
+            return text
+    return None
+
+def iter_batches(items: Iterator, size: int) -> Iterator[list]:
+    """Разбить поток элементов на списки не длиннее size."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 def load_cookies(domain: str) -> Dict[str, str]:
     """Загружает cookies для указанного домена из соответствующего файла."""
     today = datetime.datetime.now().strftime("%d-%m-%Y")
-    cookies_file = f"{domain}_{today}.json"
+    return read_cookies(domain, today)
+
+@lru_cache(maxsize=128)
+def read_cookies(domain: str, today: str) -> Dict[str, str]:
+    """Прочитать файл cookies домена за указанный день (результат кэшируется на время запуска)."""
+    cookies_file = f"{domain}_{today}.json.gz"
+    opener = gzip.open
+    # Поддержка несжатых файлов старого формата
+    if not os.path.exists(cookies_file):
+        cookies_file = f"{domain}_{today}.json"
+        opener = open
 
     try:
         if os.path.exists(cookies_file):
-            with open(cookies_file, 'r') as f:
-                cookies_list = json.load(f)
+            with opener(cookies_file, 'rb') as f:
+                cookies_list = orjson.loads(f.read())
 
-                # Преобразуем список словарей cookies в словарь для requests
-                cookies_dict = {}
-                for cookie in cookies_list:
-                    cookies_dict[cookie['name']] = cookie['value']
+            # Преобразуем список словарей cookies в словарь имя -> значение
+            cookies_dict = {cookie['name']: cookie['value'] for cookie in cookies_list}
 
-                logger.info(f"Loaded {len(cookies_dict)} cookies for {domain}")
-                return cookies_dict
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+            logger.info(f"Loaded {len(cookies_dict)} cookies for {domain}")
+            return cookies_dict
+    except (FileNotFoundError, orjson.JSONDecodeError) as e:
         logger.warning(f"Could not load cookies for {domain}: {e}")
 
     return {}
 
-def fetch_xml(url: str) -> Optional[ET.Element]:
-    """Загрузить XML по URL с повторными попытками, cookies и обработкой редиректов."""
-    domain = get_domain(url)
-    cookies_dict = load_cookies(domain)
-    redirect_count = 0
-    current_url = url
-
+def create_client() -> httpx.Client:
+    """Создать общий HTTP-клиент: пул keep-alive соединений, HTTP/2 (если установлен h2), повтор подключения."""
+    transport = httpx.HTTPTransport(
+        http2=HTTP2_AVAILABLE,
+        retries=MAX_RETRIES,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+    )
+    return httpx.Client(transport=transport, headers=HEADERS, timeout=TIMEOUT, follow_redirects=False)
+
+def cookie_headers(cookies_dict: Dict[str, str]) -> Dict[str, str]:
+    """Сформировать заголовок Cookie для запроса (per-request cookies в httpx устарели)."""
+    if not cookies_dict:
+        return {}
+    return {'Cookie': '; '.join(f"{name}={value}" for name, value in cookies_dict.items())}
+
+def open_stream(client: httpx.Client, url: str, cookies_dict: Dict[str, str]) -> httpx.Response:
+    """Отправить GET-запрос, не читая тело ответа."""
+    request = client.build_request("GET", url, headers=cookie_headers(cookies_dict))
+    return client.send(request, stream=True)
+
+def stream_xml(url: str, client: httpx.Client) -> Optional[httpx.Response]:
+    """Открыть потоковую загрузку XML по URL через общий клиент с повторами, cookies и обработкой редиректов."""
     for attempt in range(MAX_RETRIES):
+        domain = get_domain(url)
+        cookies_dict = load_cookies(domain)
+        redirect_count = 0
+        current_url = url
         try:
-            response = requests.get(
-                current_url,
-                headers=HEADERS,
-                cookies=cookies_dict,
-                timeout=TIMEOUT,
-                allow_redirects=False
-            )
+            response = open_stream(client, current_url, cookies_dict)
 
-            # Обработка редиректов вручную
+            # Обработка редиректов вручную, чтобы подгружать cookies при смене домена
             while response.is_redirect and redirect_count < MAX_REDIRECTS:
                 redirect_count += 1
                 redirect_url = response.headers.get('Location')
+                # Тело редиректа не читаем, соединение возвращаем в пул
+                response.close()
 
                 # Обработка относительных URL
                 if redirect_url.startswith('/'):
@@ -179,59 +374,104 @@ def fetch_xml(url: str) -> Optional[ET.Element]:
                     cookies_dict = load_cookies(domain)
                     logger.debug(f"Domain changed to {domain}, loaded new cookies")
 
-                response = requests.get(
-                    current_url,
-                    headers=HEADERS,
-                    cookies=cookies_dict,
-                    timeout=TIMEOUT,
-                    allow_redirects=False
-                )
+                response = open_stream(client, current_url, cookies_dict)
 
             if redirect_count >= MAX_REDIRECTS:
+                response.close()
                 logger.warning(f"Too many redirects for {url}, max {MAX_REDIRECTS} allowed")
                 return None
 
-            response.raise_for_status()
-
-            # Более безопасное удаление XML-декларации и стилей
-            content = response.text
             try:
-                # Пытаемся сначала распарсить как есть
-                root = ET.fromstring(content)
-                return root
-            except ET.ParseError:
-                # Если не получилось, пробуем удалить XML-декларацию и стили
-                content = re.sub(r'<\?xml[^>]+\?>', '', content)
-                content = re.sub(r'<\?xml-stylesheet[^>]+\?>', '', content)
-                try:
-                    root = ET.fromstring(content)
-                    return root
-                except ET.ParseError as e:
-                    logger.error(f"XML parsing error after removing declarations for {url}: {e}")
-                    return None
-        except requests.RequestException as e:
+                response.raise_for_status()
+            except httpx.HTTPStatusError:
+                response.close()
+                raise
+
+            return response
+        except httpx.HTTPError as e:
+            # Повторяем только временные ошибки сервера и сетевые сбои
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
             logger.warning(f"Attempt {attempt+1}/{MAX_RETRIES} failed for {url}: {e}")
+            if status is not None and status not in RETRY_STATUSES:
+                return None
             if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY)
-        except ET.ParseError as e:
-            logger.error(f"XML parsing error for {url}: {e}")
-            return None
+                time.sleep(RETRY_DELAY * 2 ** attempt)
 
     logger.error(f"Failed to load XML after {MAX_RETRIES} attempts for {url}")
     return None
 
+def parse_small_xml(response: httpx.Response) -> Optional[Any]:
+    """
+    Разобрать небольшой XML целиком (запасной путь).
+    Парсер с recover=True сам справляется с лишними декларациями и стилями.
+    """
+    try:
+        # Парсер lxml не потокобезопасен, поэтому создаем его на каждый вызов
+        parser = etree.XMLParser(**XML_PARSER_OPTIONS)
+        # Байты уходят в libxml2 как есть, без декодирования в str
+        root = etree.fromstring(response.read(), parser=parser)
+    except etree.XMLSyntaxError as e:
+        logger.error(f"XML parsing error for {response.url}: {e}")
+        return None
+    except httpx.HTTPError as e:
+        logger.error(f"Error reading {response.url}: {e}")
+        return None
+
+    if root is None:
+        logger.error(f"XML parsing error for {response.url}: document is empty")
+    return root
+
+def iter_xml_elements(response: httpx.Response, tag_name: str) -> Iterator[Any]:
+    """
+    Потоково разобрать XML из ответа и по одному отдавать элементы с указанным локальным именем
+    (url или sitemap) в любом пространстве имен. После обработки элемент и уже разобранные
+    соседи удаляются, поэтому в памяти не держится все дерево.
+    """
+    try:
+        # Небольшие ответы разбираем целиком, как раньше
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) <= SMALL_XML_SIZE:
+            root = parse_small_xml(response)
+            if root is None:
+                return
+            # Фильтр по тегу с подстановкой пространства имен выполняет сам lxml
+            yield from root.iter(f"{{*}}{tag_name}")
+            return
+
+        # Тело приходит чанками (уже распакованными из gzip/deflate) и подается в pull-парсер
+        parser = etree.XMLPullParser(events=("end",), tag=f"{{*}}{tag_name}", **XML_PARSER_OPTIONS)
+        try:
+            for chunk in response.iter_bytes():
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    yield elem
+                    # Освобождаем обработанный элемент и его предыдущих соседей
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+            parser.close()
+            for _, elem in parser.read_events():
+                yield elem
+        except etree.XMLSyntaxError as e:
+            logger.error(f"XML parsing error for {response.url}: {e}")
+        except httpx.HTTPError as e:
+            # Обрыв соединения или таймаут при чтении тела: уже разобранные элементы отданы,
+            # разбор завершается так же, как при ошибке разметки
+            logger.error(f"Error reading {response.url}, document truncated: {e}")
+    finally:
+        response.close()
+
+@lru_cache(maxsize=4096)
 def parse_date(date_str: Optional[str]) -> Optional[datetime.datetime]:
-    """Парсинг даты и конвертация в UTC используя dateparser."""
+    """Парсинг даты и конвертация в UTC: ISO-8601, затем dateparser, затем явные форматы."""
     if not date_str:
         return None
 
     try:
-        # Удаляем CDATA если есть
-        if '<![CDATA[' in date_str and ']]>' in date_str:
-            date_str = date_str.replace('<![CDATA[', '').replace(']]>', '')
-
-        # Удаляем HTML-теги, если они есть
-        date_str = re.sub(r'<[^>]+>', '', date_str)
+        # CDATA и HTML-теги встречаются редко: регулярные выражения запускаем только при разметке
+        if '<' in date_str:
+            date_str = RE_CDATA.sub(r'\1', date_str)
+            date_str = RE_HTML_TAG.sub('', date_str)
 
         # Очищаем строку от лишних пробелов
         date_str = date_str.strip()
@@ -241,29 +481,36 @@ def parse_date(date_str: Optional[str]) -> Optional[datetime.datetime]:
             logger.warning(f"Invalid date value found: {date_str}")
             return None
 
-        # Используем dateparser для парсинга даты с расширенными настройками
-        dt = dateparser.parse(
-            date_str,
-            settings={
-                'TIMEZONE': 'UTC',        # Установка временной зоны по умолчанию
-                'RETURN_AS_TIMEZONE_AWARE': True,  # Возврат даты с учетом временной зоны
-                'STRICT_PARSING': False   # Нестрогий парсинг для поддержки различных форматов
-            }
-        )
+        # Быстрый путь: ISO-8601, в котором записано подавляющее большинство lastmod и publication_date
+        dt = None
+        if ciso8601 is not None:
+            try:
+                dt = ciso8601.parse_datetime(date_str)
+            except ValueError:
+                pass
+
+        # fromisoformat принимает и часть записей, которые ciso8601 отвергает
+        if dt is None:
+            try:
+                dt = datetime.datetime.fromisoformat(date_str)
+            except ValueError:
+                pass
 
-        # Если dateparser не смог распознать дату
+        # Остальное разбирает dateparser: порядок дня и месяца в неоднозначных датах
+        # (01/02/2024, 02.03.2024) должен оставаться таким, как он их понимает
         if dt is None:
-            # Пробуем разные форматы для сложных случаев
-            for fmt in [
-                '%Y-%m-%dT%H:%M:%S%z',
-                '%Y-%m-%dT%H:%M:%S.%f%z',
-                '%Y-%m-%dT%H:%M:%S',
-                '%Y-%m-%d %H:%M:%S',
-                '%d.%m.%Y %H:%M:%S',
-                '%d.%m.%Y',
-                '%Y/%m/%d',
-                '%d/%m/%Y'
-            ]:
+            dt = dateparser.parse(
+                date_str,
+                settings={
+                    'TIMEZONE': 'UTC',        # Установка временной зоны по умолчанию
+                    'RETURN_AS_TIMEZONE_AWARE': True,  # Возврат даты с учетом временной зоны
+                    'STRICT_PARSING': False   # Нестрогий парсинг для поддержки различных форматов
+                }
+            )
+
+        # Если dateparser не смог распознать дату, пробуем явные форматы для сложных случаев
+        if dt is None:
+            for fmt in DATE_FORMATS:
                 try:
                     dt = datetime.datetime.strptime(date_str, fmt)
                     break
@@ -308,67 +555,108 @@ def print_stats_box(domain: str, stats: SiteStats):
 
     logger.info("=" * 80)
 
+class PreparedConnection(psycopg2.extensions.connection):
+    """Подключение пула, помнящее, подготовлены ли на нем запросы из PREPARED_STATEMENTS."""
+    statements_prepared = False
+
 class SitemapProcessor:
-    def __init__(self):
+    def __init__(self, connect: bool = True):
+        """
+        connect=False - без подключений к БД и HTTP-клиента: так создается обработчик в родительском
+        процессе, который только раздает домены процессам-воркерам и собирает статистику.
+        """
         self.db_config = load_db_config()
-        self.namespaces = {
-            'sm': 'http://www.sitemaps.org/schemas/sitemap/0.9',
-            'news': 'http://www.google.com/schemas/sitemap-news/0.9',
-            'image': 'http://www.google.com/schemas/sitemap-image/1.1',
-            'xhtml': 'http://www.w3.org/1999/xhtml',
-            'mobile': 'http://www.google.com/schemas/sitemap-mobile/1.0',
-            'video': 'http://www.google.com/schemas/sitemap-video/1.1'
-        }
+        self.pool = None
+        self.client = None
+        if connect:
+            # Пул подключений к БД, общий для всех потоков обработки дочерних sitemap
+            try:
+                self.pool = ThreadedConnectionPool(
+                    # psycopg2 закрывает возвращенное подключение, если свободных уже minconn,
+                    # поэтому держим открытыми все подключения, иначе каждая аренда - новый connect
+                    minconn=DB_POOL_SIZE,
+                    maxconn=DB_POOL_SIZE,
+                    connection_factory=PreparedConnection,
+                    **self.db_config
+                )
+            except psycopg2.Error as e:
+                logger.error(f"Database connection error: {e}")
+                raise
+            # Общий HTTP-клиент для всех потоков: соединения (и потоки HTTP/2) переиспользуются между sitemap
+            self.client = create_client()
         # Словарь для хранения статистики по доменам
         self.site_stats = defaultdict(SiteStats)
+        # Дочерние sitemap обрабатываются в нескольких потоках, счетчики меняем под блокировкой
+        self.stats_lock = threading.Lock()
+        # Кэш флагов (is_fresh, is_master) по URL sitemap и домены, для которых он загружен целиком
+        self.freshness_cache = {}
+        self.cached_domains = set()
+        # Домены без единого sitemap в базе; домен перестает быть новым, как только сохранен
+        # любой его sitemap (тот же ответ дал бы запрос EXISTS в is_new_domain)
+        self.new_domains = set()
+        # id sitemap, сохраненных за время запуска: дочерний sitemap не ищется в БД повторно
+        self.sitemap_ids = {}
+        # Решения should_exclude_sitemap по URL; сохранение sitemap сбрасывает решение, поэтому
+        # проверки после сохранения видят его новый флаг is_fresh, как и запрос к БД
+        self.exclude_cache = {}
         # Минимальная дата для поиска новостей
         self.min_date = get_min_date()
+        # Та же граница в виде POSIX-времени: в цикле по страницам сравниваем числа, а не datetime
+        self.min_timestamp = self.min_date.timestamp()
         logger.info(f"Минимальная дата для поиска новостей: {self.min_date.strftime('%Y-%m-%d')}")
 
-    def get_connection(self):
-        """Создать подключение к базе данных."""
+    @contextmanager
+    def get_connection(self, autocommit: bool = False):
+        """
+        Взять подключение из пула и вернуть его после завершения транзакции.
+        autocommit=True - для одиночных запросов: без отдельных BEGIN и COMMIT на каждый вызов.
+        """
+        conn = self.pool.getconn()
         try:
-            return psycopg2.connect(**self.db_config)
-        except psycopg2.Error as e:
-            logger.error(f"Database connection error: {e}")
-            raise
-
-    def save_sitemap(self, sitemap: Sitemap) -> int:
-        """Сохранить информацию о sitemap в БД."""
+            # Подготавливаем частые запросы при первом использовании подключения
+            if not conn.statements_prepared:
+                with conn.cursor() as cursor:
+                    for statement in PREPARED_STATEMENTS:
+                        cursor.execute(statement)
+                conn.commit()
+                conn.statements_prepared = True
+
+            conn.autocommit = autocommit
+            if autocommit:
+                # С psycopg2 2.9 блок with открывает транзакцию и в режиме autocommit,
+                # поэтому каждый запрос фиксируется сам, без with conn
+                yield conn
+            else:
+                with conn:
+                    yield conn
+        finally:
+            self.pool.putconn(conn)
+
+    def close(self):
+        """Закрыть подключения пула и HTTP-клиент."""
+        if self.pool is not None:
+            self.pool.closeall()
+        if self.client is not None:
+            self.client.close()
+
+    def save_sitemap(self, sitemap: Sitemap, conn=None) -> int:
+        """
+        Сохранить информацию о sitemap в БД.
+        conn - уже взятое из пула подключение вызывающего кода (например, на время разбора мастер-sitemap).
+        """
         domain = get_domain(sitemap.url)
 
         # Мастер sitemap всегда должен быть помечен как свежий
         if sitemap.is_master:
             sitemap.is_fresh = True
 
-        with self.get_connection() as conn:
+        connection = nullcontext(conn) if conn is not None else self.get_connection(autocommit=True)
+        with connection as conn:
             with conn.cursor() as cursor:
                 try:
-                    # Проверяем, существует ли sitemap с таким URL
-                    cursor.execute(
-                        "SELECT id_sitemap FROM sitemaps WHERE sitemap_url = %s",
-                        (sitemap.url,)
-                    )
-                    result = cursor.fetchone()
-
-                    if result:
-                        # Если sitemap существует, возвращаем его ID
-                        # Если это мастер-sitemap, обновляем его флаг is_fresh на True
-                        if sitemap.is_master:
-                            cursor.execute("""
-                                UPDATE sitemaps
-                                SET is_fresh = TRUE
-                                WHERE id_sitemap = %s
-                            """, (result[0],))
-                            conn.commit()
-                        return result[0]
-
-                    # Вставляем новый sitemap
-                    cursor.execute("""
-                        INSERT INTO sitemaps (domain, sitemap_url, is_master, parent_id, last_mod, is_fresh)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                        RETURNING id_sitemap
-                    """, (
+                    # Вставляем sitemap одним запросом; если он уже есть, флаг свежести
+                    # только поднимается (мастер-sitemap всегда становится свежим)
+                    cursor.execute("EXECUTE save_sitemap_stmt (%s, %s, %s, %s, %s, %s)", (
                         domain,
                         sitemap.url,
                         sitemap.is_master,
@@ -377,173 +665,162 @@ class SitemapProcessor:
                         sitemap.is_fresh
                     ))
 
-                    sitemap_id = cursor.fetchone()[0]
-                    conn.commit()
+                    sitemap_id, inserted, is_fresh, is_master = cursor.fetchone()
+                    self.freshness_cache[sitemap.url] = (is_fresh, is_master)
+                    self.sitemap_ids[sitemap.url] = sitemap_id
+                    self.new_domains.discard(domain)
+                    self.exclude_cache.pop(sitemap.url, None)
+
+                    # Существующий sitemap не считаем заново
+                    if not inserted:
+                        return sitemap_id
 
                     # Увеличиваем счетчик обработанных sitemap
-                    self.site_stats[domain].sitemaps_processed += 1
+                    with self.stats_lock:
+                        self.site_stats[domain].sitemaps_processed += 1
 
                     return sitemap_id
 
                 except psycopg2.Error as e:
-                    conn.rollback()
                     logger.error(f"Error saving sitemap {sitemap.url}: {e}")
                     raise
 
+    def save_sitemaps(self, sitemaps: List[Sitemap], conn):
+        """
+        Сохранить пакет sitemap в БД одним запросом (upsert, как в save_sitemap).
+        conn - подключение вызывающего кода в режиме autocommit.
+        """
+        if not sitemaps:
+            return
+
+        # ON CONFLICT DO UPDATE не допускает повтор одного URL в запросе
+        rows = {
+            sitemap.url: (get_domain(sitemap.url), sitemap.url, sitemap.is_master,
+                          sitemap.parent_id, sitemap.last_mod, sitemap.is_fresh)
+            for sitemap in sitemaps
+        }
+
+        with conn.cursor() as cursor:
+            try:
+                results = execute_values(cursor, """
+                    INSERT INTO sitemaps (domain, sitemap_url, is_master, parent_id, last_mod, is_fresh)
+                    VALUES %s
+                    ON CONFLICT (sitemap_url) DO UPDATE
+                    SET is_fresh = EXCLUDED.is_fresh OR sitemaps.is_fresh
+                    RETURNING sitemap_url, id_sitemap, (xmax = 0) AS inserted, is_fresh, is_master
+                """, list(rows.values()), page_size=len(rows), fetch=True)
+            except psycopg2.Error as e:
+                logger.error(f"Error saving {len(rows)} sitemaps: {e}")
+                raise
+
+        inserted_by_domain = defaultdict(int)
+        for sitemap_url, sitemap_id, inserted, is_fresh, is_master in results:
+            self.freshness_cache[sitemap_url] = (is_fresh, is_master)
+            self.sitemap_ids[sitemap_url] = sitemap_id
+            self.new_domains.discard(rows[sitemap_url][0])
+            self.exclude_cache.pop(sitemap_url, None)
+            # Существующие sitemap не считаем заново
+            if inserted:
+                inserted_by_domain[rows[sitemap_url][0]] += 1
+
+        with self.stats_lock:
+            for domain, count in inserted_by_domain.items():
+                self.site_stats[domain].sitemaps_processed += count
+
     def update_sitemap_freshness(self, sitemap_id: int, is_fresh: bool):
         """Обновить флаг свежести sitemap в БД."""
-        with self.get_connection() as conn:
+        with self.get_connection(autocommit=True) as conn:
             with conn.cursor() as cursor:
                 try:
-                    cursor.execute("""
-                        UPDATE sitemaps
-                        SET is_fresh = %s, processed_at = NOW()
-                        WHERE id_sitemap = %s
-                    """, (is_fresh, sitemap_id))
-                    conn.commit()
+                    cursor.execute("EXECUTE update_freshness_stmt (%s, %s)", (is_fresh, sitemap_id))
+                    result = cursor.fetchone()
+                    if result:
+                        self.freshness_cache[result[0]] = (result[1], result[2])
                 except psycopg2.Error as e:
-                    conn.rollback()
                     logger.error(f"Error updating sitemap freshness for ID {sitemap_id}: {e}")
 
-    def save_news_page(self, news_page: NewsPage, domain: str) -> Optional[int]:
-        """Сохранить информацию о странице новостей в БД."""
-        # Проверяем, является ли домен новым
-        is_new_domain = self.is_new_domain(domain)
+    def save_news_pages(self, news_pages: List[NewsPage], domain: str) -> int:
+        """
+        Сохранить пакет страниц новостей в БД одним запросом.
+        Уже существующие страницы пропускаются через ON CONFLICT, возвращается количество обработанных страниц.
+        """
+        if not news_pages:
+            return 0
 
-        # Проверяем дату публикации по минимальной допустимой дате
-        # Для новых доменов пропускаем эту проверку
-        if not is_new_domain and (news_page.publication_date is None or news_page.publication_date < self.min_date):
-            months_ago = CHECK_LAST_MONTHS
-            logger.debug(f"Skipping page {news_page.page_url} - publication date is older than {months_ago} months")
-            self.site_stats[domain].pages_skipped += 1
-            return None
+        rows = [(page.id_sitemap, page.page_url, page.publication_date, page.is_error) for page in news_pages]
 
         with self.get_connection() as conn:
             with conn.cursor() as cursor:
                 try:
-                    # Проверяем, существует ли страница с таким URL
-                    cursor.execute(
-                        "SELECT id_page FROM news_pages WHERE page_url = %s",
-                        (news_page.page_url,)
-                    )
-                    result = cursor.fetchone()
-
-                    if result:
-                        # Если страница существует, увеличиваем счетчик пропущенных
-                        self.site_stats[domain].pages_skipped += 1
-                        return result[0]
-
-                    # Вставляем новую страницу
-                    cursor.execute("""
+                    inserted = execute_values(cursor, """
                         INSERT INTO news_pages (id_sitemap, page_url, publication_date, is_error)
-                        VALUES (%s, %s, %s, %s)
-                        RETURNING id_page
-                    """, (
-                        news_page.id_sitemap,
-                        news_page.page_url,
-                        news_page.publication_date,
-                        news_page.is_error
-                    ))
-
-                    page_id = cursor.fetchone()[0]
+                        VALUES %s
+                        ON CONFLICT (page_url) DO NOTHING
+                        RETURNING publication_date
+                    """, rows, page_size=PAGE_BATCH_SIZE, fetch=True)
                     conn.commit()
-
-                    # Увеличиваем счетчик добавленных страниц
-                    self.site_stats[domain].pages_added += 1
-
-                    # Обновляем информацию о диапазоне дат
-                    self.site_stats[domain].update_date_range(news_page.publication_date)
-
-                    return page_id
-
                 except psycopg2.Error as e:
                     conn.rollback()
-                    logger.error(f"Error saving page {news_page.page_url}: {e}")
-                    return None
-
-    def check_sitemap_freshness(self, root) -> bool:
-        """
-        Проверяет, содержит ли sitemap новости с датами публикации не старше CHECK_LAST_MONTHS месяцев.
-        Sitemap считается "свежим", если хотя бы одна страница имеет дату не старше минимальной.
-        """
-        # Определяем, какое пространство имен используется в XML
-        namespace = root.tag.split('}')[0] + '}' if '}' in root.tag else ''
-
-        # Проверяем разные варианты поиска URL элементов
-        url_elements = []
-        search_paths = [
-            # С пространством имен по умолчанию
-            f".//{namespace}url",
-            # С префиксом sm
-            ".//sm:url",
-            # Без пространства имен
-            ".//url"
-        ]
-
-        for path in search_paths:
-            try:
-                if path.startswith(".//sm:"):
-                    elements = root.findall(path, self.namespaces)
-                else:
-                    elements = root.findall(path)
-
-                if elements:
-                    url_elements = elements
-                    logger.debug(f"Found URL elements using path: {path}")
-                    break
-            except Exception as e:
-                logger.warning(f"Error searching with path {path}: {e}")
-
-        logger.debug(f"Checking freshness of sitemap with {len(url_elements)} URL elements")
-        found_fresh = False
-        no_date_count = 0
-
-        # Проверяем даты публикации
-        for url_elem in url_elements:
-            pub_date = self.extract_publication_date(url_elem, namespace)
-            if pub_date is None:
-                no_date_count += 1
-                continue
-
-            if pub_date >= self.min_date:
-                # Если найдена хотя бы одна страница с датой не старше CHECK_LAST_MONTHS месяцев, считаем sitemap свежим
-                found_fresh = True
-                break
-
-        # Если большинство страниц не имеют дат, это может указывать на проблему
-        if no_date_count > len(url_elements) * 0.9 and len(url_elements) > 10:
-            logger.warning(f"Sitemap has {no_date_count}/{len(url_elements)} URLs without dates, which may indicate issues")
+                    logger.error(f"Error saving {len(rows)} pages for {domain}: {e}")
+                    return 0
+
+        # Страницы, не вернувшиеся из RETURNING, уже были в базе
+        with self.stats_lock:
+            stats = self.site_stats[domain]
+            stats.pages_added += len(inserted)
+            stats.pages_skipped += len(rows) - len(inserted)
+            for (publication_date,) in inserted:
+                stats.update_date_range(publication_date)
+
+        return len(rows)
+
+    def load_freshness_cache(self, domain: str) -> bool:
+        """Загрузить флаги is_fresh и is_master всех sitemap домена в память одним запросом."""
+        with self.get_connection(autocommit=True) as conn:
+            with conn.cursor() as cursor:
+                try:
+                    cursor.execute(
+                        "SELECT sitemap_url, is_fresh, is_master FROM sitemaps WHERE domain = %s",
+                        (domain,)
+                    )
+                    rows = cursor.fetchall()
+                except psycopg2.Error as e:
+                    logger.error(f"Error loading sitemap freshness for {domain}: {e}")
+                    return False
 
-        return found_fresh
+        for sitemap_url, is_fresh, is_master in rows:
+            self.freshness_cache[sitemap_url] = (is_fresh, is_master)
+        # Домен без единого sitemap в базе - новый (до сохранения первого его sitemap)
+        if rows:
+            self.new_domains.discard(domain)
+        else:
+            self.new_domains.add(domain)
+        self.cached_domains.add(domain)
+        return True
 
     def is_sitemap_marked_as_not_fresh(self, sitemap_url: str) -> bool:
         """
         Проверяет, отмечен ли sitemap как не свежий (is_fresh=False) в базе данных.
         Возвращает True, если sitemap существует и помечен как не свежий.
+        Ответ берется из кэша; домен, встреченный впервые, загружается в кэш одним запросом.
         """
-        with self.get_connection() as conn:
-            with conn.cursor() as cursor:
-                try:
-                    cursor.execute(
-                        "SELECT is_fresh, is_master FROM sitemaps WHERE sitemap_url = %s",
-                        (sitemap_url,)
-                    )
-                    result = cursor.fetchone()
+        # Домен еще не в кэше (например, дочерний sitemap на другом хосте) - загружаем его целиком
+        domain = get_domain(sitemap_url)
+        if domain not in self.cached_domains and not self.load_freshness_cache(domain):
+            return False
 
-                    # Если записи нет, возвращаем False
-                    if result is None:
-                        return False
+        result = self.freshness_cache.get(sitemap_url)
 
-                    # Если это мастер-sitemap, считаем его всегда свежим
-                    if result[1] is True:  # result[1] - это is_master
-                        return False
+        # Если записи нет, возвращаем False
+        if result is None:
+            return False
 
-                    # Если sitemap найден и is_fresh=False, возвращаем True
-                    return result[0] is False
+        # Если это мастер-sitemap, считаем его всегда свежим
+        if result[1] is True:  # result[1] - это is_master
+            return False
 
-                except psycopg2.Error as e:
-                    logger.error(f"Error checking sitemap freshness for {sitemap_url}: {e}")
-                    return False
+        # Если sitemap найден и is_fresh=False, возвращаем True
+        return result[0] is False
 
     def should_exclude_sitemap(self, url: str) -> bool:
         """
@@ -555,7 +832,16 @@ class SitemapProcessor:
         3. Содержат '/category/' в URL
         4. Содержат '/author/' в URL
         5. Уже отмечены как не свежие (is_fresh=False) в базе данных
+
+        Результат запоминается для URL до следующего сохранения этого sitemap.
         """
+        excluded = self.exclude_cache.get(url)
+        if excluded is None:
+            excluded = self.exclude_cache[url] = self.check_exclude_sitemap(url)
+        return excluded
+
+    def check_exclude_sitemap(self, url: str) -> bool:
+        """Проверить sitemap по шаблонам URL и флагу is_fresh без учета запомненных решений."""
         # Проверка по шаблонам URL
         if url.endswith('category-sitemap.xml') or url.endswith('author-sitemap.xml'):
             logger.debug(f"Excluding sitemap (by extension): {url}")
@@ -572,84 +858,53 @@ class SitemapProcessor:
 
         return False
 
-    def process_master_sitemap(self, sitemap_url: str) -> List[str]:
-        """Обработать мастер-sitemap и вернуть список дочерних sitemap."""
+    def process_master_sitemap(self, sitemap_url: str) -> Iterator[str]:
+        """Обработать мастер-sitemap, по одному отдавая URL дочерних sitemap по мере разбора."""
         logger.info(f"Processing master sitemap: {sitemap_url}")
         domain = get_domain(sitemap_url)
 
-        # Сохраняем мастер-sitemap в БД (всегда с is_fresh=True)
-        master_sitemap = Sitemap(url=sitemap_url, is_master=True, is_fresh=True)
-        master_id = self.save_sitemap(master_sitemap)
-
-        # Получаем XML
-        root = fetch_xml(sitemap_url)
-        if root is None:
-            logger.error(f"Failed to load master sitemap: {sitemap_url}")
-            return []
-
-        # Определяем, какое пространство имен используется в XML
-        namespace = root.tag.split('}')[0] + '}' if '}' in root.tag else ''
-        logger.debug(f"Master sitemap XML namespace: {namespace}")
-
-        # Извлекаем ссылки на дочерние sitemap
-        child_sitemaps = []
-
-        # Проверяем разные варианты поиска sitemap элементов
-        sitemap_elements = []
-        search_paths = [
-            # С пространством имен по умолчанию
-            f".//{namespace}sitemap",
-            # С префиксом sm
-            ".//sm:sitemap",
-            # Без пространства имен
-            ".//sitemap"
-        ]
-
-        for path in search_paths:
-            try:
-                if path.startswith(".//sm:"):
-                    elements = root.findall(path, self.namespaces)
-                else:
-                    elements = root.findall(path)
-
-                if elements:
-                    sitemap_elements = elements
-                    logger.debug(f"Found sitemap elements using path: {path}")
-                    break
-            except Exception as e:
-                logger.warning(f"Error searching with path {path}: {e}")
-
-        for sitemap_elem in sitemap_elements:
-            # Пытаемся найти URL с использованием различных путей
-            loc_text = None
-            loc_search_paths = [
-                # С пространством имен по умолчанию
-                f".//{namespace}loc",
-                # С префиксом sm
-                ".//sm:loc",
-                # Без пространства имен
-                ".//loc"
-            ]
+        # Загружаем флаги свежести sitemap домена, чтобы не опрашивать БД по каждому дочернему
+        self.load_freshness_cache(domain)
+
+        # Одно подключение на весь разбор мастер-sitemap, без транзакции вокруг него: в режиме
+        # autocommit каждый upsert фиксируется сразу, поэтому дочерний sitemap виден потокам
+        # обработки до их запуска, а ошибка одного запроса не прерывает последующие
+        with self.get_connection(autocommit=True) as conn:
+            # Сохраняем мастер-sitemap в БД (всегда с is_fresh=True)
+            master_sitemap = Sitemap(url=sitemap_url, is_master=True, is_fresh=True)
+            master_id = self.save_sitemap(master_sitemap, conn)
+
+            # Открываем потоковую загрузку XML
+            response = stream_xml(sitemap_url, self.client)
+            if response is None:
+                logger.error(f"Failed to load master sitemap: {sitemap_url}")
+                return
 
-            for loc_path in loc_search_paths:
-                try:
-                    if loc_path.startswith(".//sm:"):
-                        loc_elem = sitemap_elem.find(loc_path, self.namespaces)
-                    else:
-                        loc_elem = sitemap_elem.find(loc_path)
-
-                    if loc_elem is not None and loc_elem.text:
-                        loc_text = loc_elem.text.strip()
-                        break
-                except Exception as e:
-                    continue
+            # Извлекаем ссылки на дочерние sitemap
+            child_count = 0
+
+            # Дочерние sitemap сохраняются пакетами по SITEMAP_BATCH_SIZE одним запросом
+            for batch in iter_batches(self.iter_child_sitemaps(response, master_id), SITEMAP_BATCH_SIZE):
+                self.save_sitemaps(batch, conn)
+
+                for child_sitemap in batch:
+                    # Отдаем URL для дальнейшей обработки, не накапливая список
+                    # Свежесть sitemap будет определена при обработке
+                    child_count += 1
+                    yield child_sitemap.url
+
+            logger.info(f"Found {child_count} child sitemaps in {sitemap_url}")
 
-            if not loc_text:
+    def iter_child_sitemaps(self, response, master_id: int) -> Iterator[Sitemap]:
+        """Разобрать элементы sitemap мастер-sitemap и отдать неисключенные дочерние sitemap (еще не сохраненные)."""
+        for sitemap_elem in iter_xml_elements(response, 'sitemap'):
+            # Ищем URL среди прямых потомков по локальному имени тега
+            child_url = find_child_text(sitemap_elem, 'loc')
+
+            if not child_url:
                 logger.warning("Could not find location (URL) for sitemap element")
                 continue
 
-            child_url = loc_text
-
             # Проверяем, нужно ли исключить этот sitemap
             # Сюда также входит проверка на is_fresh=False в БД
             if self.should_exclude_sitemap(child_url):
@@ -657,146 +912,48 @@ class SitemapProcessor:
                 continue
 
             # Ищем дату последнего изменения
-            lastmod_text = None
-            lastmod_search_paths = [
-                # С пространством имен по умолчанию
-                f".//{namespace}lastmod",
-                # С префиксом sm
-                ".//sm:lastmod",
-                # Без пространства имен
-                ".//lastmod"
-            ]
-
-            for lastmod_path in lastmod_search_paths:
-                try:
-                    if lastmod_path.startswith(".//sm:"):
-                        lastmod_elem = sitemap_elem.find(lastmod_path, self.namespaces)
-                    else:
-                        lastmod_elem = sitemap_elem.find(lastmod_path)
-
-                    if lastmod_elem is not None and lastmod_elem.text:
-                        lastmod_text = lastmod_elem.text.strip()
-                        break
-                except Exception:
-                    continue
+            lastmod_text = find_child_text(sitemap_elem, 'lastmod')
 
-            last_mod = None
-            if lastmod_text:
-                last_mod = parse_date(lastmod_text)
-
-            # Сначала сохраняем дочерний sitemap без флага свежести (он будет проверен позже)
-            child_sitemap = Sitemap(
+            # Дочерний sitemap сохраняется без флага свежести (он будет проверен позже)
+            yield Sitemap(
                 url=child_url,
                 is_master=False,
                 parent_id=master_id,
-                last_mod=last_mod,
+                last_mod=parse_date(lastmod_text) if lastmod_text else None,
                 is_fresh=False  # По умолчанию не свежий, будет проверен при обработке
             )
-            child_id = self.save_sitemap(child_sitemap)
-
-            # Добавляем URL в список для дальнейшей обработки
-            # Свежесть sitemap будет определена при обработке
-            child_sitemaps.append(child_url)
-
-        logger.info(f"Found {len(child_sitemaps)} child sitemaps in {sitemap_url}")
-        return child_sitemaps
-
-    def extract_publication_date(self, url_elem, namespace='') -> Optional[datetime.datetime]:
-        """Извлекает дату публикации из элемента URL различными способами."""
-        # Находим URL страницы для логирования
-        url = None
-
-        # Пытаемся найти элемент loc разными способами
-        loc_search_paths = [
-            # С пространством имен по умолчанию
-            f"./{namespace}loc",
-            # С префиксом sm
-            "./sm:loc",
-            # Без пространства имен
-            "./loc"
-        ]
-
-        for loc_path in loc_search_paths:
-            try:
-                if loc_path.startswith("./sm:"):
-                    loc_elem = url_elem.find(loc_path, self.namespaces)
-                else:
-                    loc_elem = url_elem.find(loc_path)
-
-                if loc_elem is not None and loc_elem.text:
-                    url = loc_elem.text.strip()
-                    break
-            except Exception as e:
-                continue
-
-        # Проверяем различные пути для поиска дат публикации
-        date_search_paths = [
-            # lastmod с разными пространствами имен
-            f"./{namespace}lastmod",
-            "./sm:lastmod",
-            "./lastmod",
-
-            # news:publication_date с разными пространствами имен
-            ".//news:news/news:publication_date",
-
-            # Другие стандартные теги с датами
-            ".//publication_date",
-            ".//pubDate",
-            ".//date",
-            ".//updated",
-            ".//modified",
-            ".//published",
-            ".//created",
-            ".//issued",
-            ".//time",
-
-            # Dublin Core и Open Graph
-            ".//dc:date",
-            ".//article:published_time",
-
-            # Атрибуты HTML meta
-            ".//meta[@property='article:published_time']/@content",
-            ".//meta[@name='date']/@content",
-            ".//meta[@name='pubdate']/@content",
-            ".//meta[@name='publish_date']/@content",
-            ".//meta[@name='article:published_time']/@content",
-            ".//meta[@itemprop='datePublished']/@content",
-
-            # Атрибуты с датами
-            ".//*[@date]/@date",
-            ".//*[@datetime]/@datetime",
-            ".//*[@pubdate]/@pubdate",
-            ".//*[@published]/@published",
-            ".//*[@created]/@created"
-        ]
-
-        # Проверяем каждый путь поиска
-        for path in date_search_paths:
-            try:
-                if path.startswith(".//news:") or path.startswith("./sm:"):
-                    date_elem = url_elem.find(path, self.namespaces)
-                else:
-                    date_elem = url_elem.find(path)
-
-                if date_elem is not None:
-                    date_text = date_elem.text if hasattr(date_elem, 'text') and date_elem.text else str(date_elem)
-                    if date_text:
-                        date = parse_date(date_text.strip())
-                        if date:
-                            return date
-            except Exception:
-                continue
-
-        # Если дата публикации не найдена, логируем ошибку
-        if url:
-            logger.debug(f"Publication date not found for URL: {url}")
-        else:
-            logger.debug("Publication date not found for URL element (URL not found)")
 
+    def extract_publication_date(self, url_elem) -> Optional[datetime.datetime]:
+        """Извлекает дату публикации из элемента URL по тегам из DATE_TAG_PRIORITY."""
+        # Обычный случай: lastmod (самый приоритетный тег) - прямой потомок, поддерево не обходим
+        lastmod_text = find_child_text(url_elem, 'lastmod')
+        if lastmod_text:
+            date = parse_date(lastmod_text)
+            if date:
+                return date
+
+        # Один запрос по поддереву: запоминаем первый текст для каждого тега с датой
+        candidates = {}
+        for elem in compiled_xpath(DATE_TAGS_XPATH)(url_elem):
+            name = local_name(elem.tag)
+            if name not in candidates and elem.text:
+                candidates[name] = elem.text.strip()
+
+        # Проверяем найденные даты в порядке приоритета тегов
+        for name in sorted(candidates, key=DATE_TAG_PRIORITY.__getitem__):
+            date = parse_date(candidates[name])
+            if date:
+                return date
+
+        # Страница без даты логируется и учитывается вызывающим кодом
         return None
 
     def process_child_sitemap(self, sitemap_url: str, parent_id: Optional[int] = None) -> int:
-        """Обработать дочерний sitemap и извлечь URL страниц."""
+        """
+        Обработать дочерний sitemap и извлечь URL страниц.
+        Свежесть sitemap определяется в том же проходе, что и сохранение страниц: sitemap свежий,
+        если хотя бы одна страница прошла фильтр по дате (для нового домена - всегда).
+        """
         logger.info(f"Processing child sitemap: {sitemap_url}")
 
         # Проверяем, нужно ли исключить этот sitemap
@@ -807,35 +964,28 @@ class SitemapProcessor:
 
         domain = get_domain(sitemap_url)
 
-        # Получаем XML перед сохранением sitemap
-        root = fetch_xml(sitemap_url)
-        if root is None:
+        # Открываем потоковую загрузку XML перед сохранением sitemap
+        response = stream_xml(sitemap_url, self.client)
+        if response is None:
             logger.error(f"Failed to load child sitemap: {sitemap_url}")
             return 0
 
-        # Определяем, какое пространство имен используется в XML
-        namespace = root.tag.split('}')[0] + '}' if '}' in root.tag else ''
-        logger.debug(f"XML namespace: {namespace}")
-
         # Проверяем, существует ли этот домен в базе данных
-        is_new_domain = self.is_new_domain(domain)
-
         # Для нового домена все sitemap считаются свежими
-        # Для существующих доменов проверяем содержимое sitemap
+        is_new_domain = self.is_new_domain(domain)
         if is_new_domain:
-            is_fresh = True
             logger.info(f"New domain detected: {domain}. Marking all sitemaps as fresh.")
-        else:
-            # Проверяем свежесть sitemap - есть ли в нем страницы с датой не старше CHECK_LAST_MONTHS месяцев
-            is_fresh = self.check_sitemap_freshness(root)
 
-        # Сохраняем дочерний sitemap в БД, если его еще нет
+        # Сохраняем дочерний sitemap в БД, если его еще нет; флаг свежести выставляется после разбора
         if parent_id:
-            child_sitemap = Sitemap(url=sitemap_url, is_master=False, parent_id=parent_id, is_fresh=is_fresh)
+            child_sitemap = Sitemap(url=sitemap_url, is_master=False, parent_id=parent_id)
             sitemap_id = self.save_sitemap(child_sitemap)
+        elif sitemap_url in self.sitemap_ids:
+            # Sitemap только что сохранен при разборе мастер-sitemap
+            sitemap_id = self.sitemap_ids[sitemap_url]
         else:
             # Ищем существующий sitemap в БД
-            with self.get_connection() as conn:
+            with self.get_connection(autocommit=True) as conn:
                 with conn.cursor() as cursor:
                     cursor.execute(
                         "SELECT id_sitemap FROM sitemaps WHERE sitemap_url = %s",
@@ -843,120 +993,135 @@ class SitemapProcessor:
                     )
                     result = cursor.fetchone()
 
-                    if result:
-                        sitemap_id = result[0]
-                        # Обновляем флаг свежести
-                        self.update_sitemap_freshness(sitemap_id, is_fresh)
-                    else:
-                        # Если не найден, создаем новый
-                        child_sitemap = Sitemap(url=sitemap_url, is_master=False, is_fresh=is_fresh)
-                        sitemap_id = self.save_sitemap(child_sitemap)
-
-        # Если sitemap не свежий, пропускаем обработку URL
-        if not is_fresh:
-            months_ago = CHECK_LAST_MONTHS
-            logger.info(f"Skipping outdated sitemap: {sitemap_url} (no news younger than {months_ago} months)")
-            return 0
+            if result:
+                sitemap_id = result[0]
+            else:
+                # Если не найден, создаем новый
+                child_sitemap = Sitemap(url=sitemap_url, is_master=False)
+                sitemap_id = self.save_sitemap(child_sitemap)
 
-        # Извлекаем URL страниц
+        # Извлекаем URL страниц потоково, разобранные элементы сразу освобождаются
+        url_count = 0
         page_count = 0
         skipped_no_date = 0
+        skipped_old = 0
+        found_fresh = False
+        pending_pages = []
 
-        # Проверяем разные варианты поиска URL элементов
-        url_elements = []
-        search_paths = [
-            # С пространством имен по умолчанию
-            f".//{namespace}url",
-            # С префиксом sm
-            ".//sm:url",
-            # Без пространства имен
-            ".//url"
-        ]
-
-        for path in search_paths:
-            try:
-                if path.startswith(".//sm:"):
-                    elements = root.findall(path, self.namespaces)
-                else:
-                    elements = root.findall(path)
-
-                if elements:
-                    url_elements = elements
-                    logger.debug(f"Found URL elements using path: {path}")
-                    break
-            except Exception as e:
-                logger.warning(f"Error searching with path {path}: {e}")
-
-        logger.info(f"Found {len(url_elements)} URL elements in {sitemap_url}")
-
-        for url_elem in url_elements:
-            # Пытаемся найти элемент loc разными способами
-            loc_text = None
-            loc_search_paths = [
-                # С пространством имен по умолчанию
-                f"./{namespace}loc",
-                # С префиксом sm
-                "./sm:loc",
-                # Без пространства имен
-                "./loc"
-            ]
+        # Атрибуты, нужные на каждой странице, связываем с локальными переменными один раз
+        min_timestamp = self.min_timestamp
+        extract_publication_date = self.extract_publication_date
 
-            for loc_path in loc_search_paths:
-                try:
-                    if loc_path.startswith("./sm:"):
-                        loc_elem = url_elem.find(loc_path, self.namespaces)
-                    else:
-                        loc_elem = url_elem.find(loc_path)
-
-                    if loc_elem is not None and loc_elem.text:
-                        loc_text = loc_elem.text.strip()
-                        break
-                except Exception as e:
-                    logger.warning(f"Error searching for loc with path {loc_path}: {e}")
+        for url_elem in iter_xml_elements(response, 'url'):
+            # Ищем URL среди прямых потомков по локальному имени тега
+            page_url = find_child_text(url_elem, 'loc')
 
-            if not loc_text:
+            if not page_url:
                 logger.warning("Could not find location (URL) for URL element")
                 continue
-
-            page_url = loc_text
+            url_count += 1
 
             # Извлекаем дату публикации разными способами
-            publication_date = self.extract_publication_date(url_elem, namespace)
+            publication_date = extract_publication_date(url_elem)
 
             # Пропускаем страницы без даты публикации
             if publication_date is None:
                 skipped_no_date += 1
-                logger.debug(f"Skipping page {page_url} - publication date not found")
+                # Аргументы вместо f-строки: при уровне выше DEBUG строка не форматируется
+                logger.debug("Skipping page {} - publication date not found", page_url)
                 continue
 
+            # Страница не старше CHECK_LAST_MONTHS месяцев делает sitemap свежим.
             # Если это новый домен - сохраняем все страницы, независимо от даты
             # Для существующих доменов - пропускаем страницы с датой старше минимальной
-            if not is_new_domain and publication_date < self.min_date:
-                months_ago = CHECK_LAST_MONTHS
-                logger.debug(f"Skipping page {page_url} - publication date is older than {months_ago} months")
-                self.site_stats[domain].pages_skipped += 1
+            if publication_date.timestamp() >= min_timestamp:
+                found_fresh = True
+            elif not is_new_domain:
+                # Старые страницы не логируем по одной - их количество попадает в статистику
+                skipped_old += 1
                 continue
 
-            # Логируем информацию о дате публикации для отладки
-            logger.debug(f"Found publication date for {page_url}: {publication_date}")
-
-            # Сохраняем страницу
-            news_page = NewsPage(
+            # Накапливаем страницу для пакетной вставки
+            pending_pages.append(NewsPage(
                 page_url=page_url,
                 id_sitemap=sitemap_id,
                 publication_date=publication_date,
                 is_error=False  # По умолчанию отмечаем страницу как не содержащую ошибок
-            )
+            ))
 
-            if self.save_news_page(news_page, domain):
-                page_count += 1
+            if len(pending_pages) >= PAGE_BATCH_SIZE:
+                page_count += self.save_news_pages(pending_pages, domain)
+                pending_pages = []
 
-        # Обновляем счетчик страниц без дат
-        self.site_stats[domain].pages_no_date += skipped_no_date
+        # Сохраняем оставшиеся страницы
+        page_count += self.save_news_pages(pending_pages, domain)
+
+        logger.info(f"Found {url_count} URL elements in {sitemap_url}")
+
+        # Если большинство страниц не имеют дат, это может указывать на проблему
+        if skipped_no_date > url_count * 0.9 and url_count > 10:
+            logger.warning(f"Sitemap has {skipped_no_date}/{url_count} URLs without dates, which may indicate issues")
+
+        is_fresh = is_new_domain or found_fresh
+        self.update_sitemap_freshness(sitemap_id, is_fresh)
+
+        # Если sitemap не свежий, ни одна страница не сохранена и статистику не трогаем
+        if not is_fresh:
+            logger.info(f"Skipping outdated sitemap: {sitemap_url} (no news younger than {CHECK_LAST_MONTHS} months)")
+            return 0
+
+        # Обновляем счетчики пропущенных страниц
+        with self.stats_lock:
+            stats = self.site_stats[domain]
+            stats.pages_skipped += skipped_old
+            stats.pages_no_date += skipped_no_date
 
         logger.info(f"Found {page_count} valid pages in {sitemap_url} (skipped {skipped_no_date} without dates)")
         return page_count
 
+    def process_domain(self, master_url: str) -> tuple:
+        """
+        Обработать один мастер-sitemap: дочерние sitemap отправляются в пул потоков по мере разбора.
+        Возвращает количество найденных дочерних sitemap и страниц.
+        """
+        domain = get_domain(master_url)
+        logger.info(f"Обработка домена: {domain}")
+
+        child_count = 0
+        total_pages = 0
+        excluded_count = 0
+
+        # Дочерние sitemap отправляем в пул потоков сразу по мере разбора мастер-sitemap,
+        # предварительно отфильтровав исключенные
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            future_to_url = {}
+            for url in self.process_master_sitemap(master_url):
+                child_count += 1
+                if self.should_exclude_sitemap(url):
+                    excluded_count += 1
+                    logger.debug(f"Исключаю sitemap из обработки: {url}")
+                    continue
+                future_to_url[executor.submit(self.process_child_sitemap, url)] = url
+
+            if excluded_count > 0:
+                logger.info(f"Исключено {excluded_count} sitemap из обработки для {domain}")
+
+            logger.info(f"Обрабатывается {len(future_to_url)} дочерних sitemap для {domain}")
+
+            completed = 0
+            for future in as_completed(future_to_url):
+                url = future_to_url[future]
+                completed += 1
+                try:
+                    total_pages += future.result()
+                    logger.info(f"Прогресс {domain}: {completed}/{len(future_to_url)} sitemap обработано ({completed/len(future_to_url)*100:.1f}%)")
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке {url}: {e}")
+
+        # Выводим статистику по домену в рамке
+        print_stats_box(domain, self.site_stats[domain])
+        return child_count, total_pages
+
     def process_master_sitemaps_file(self, file_path: str):
         """Обработать файл с URL мастер-sitemap."""
         logger.info(f"Начинаю обработку файла с мастер-sitemap: {file_path}")
@@ -976,59 +1141,31 @@ class SitemapProcessor:
 
             logger.info(f"Обнаружено {len(master_urls)} мастер-sitemap в файле")
 
-            # Обрабатываем мастер-sitemaps
+            # Статистику заводим заранее в порядке файла, чтобы итоговая таблица не зависела
+            # от порядка завершения доменов
             for master_url in master_urls:
-                domain = get_domain(master_url)
-                total_domains += 1
-
-                logger.info("=" * 40)
-                logger.info(f"Обработка домена: {domain}")
-                logger.info("=" * 40)
-
-                try:
-                    # Сбрасываем статистику для текущего домена
-                    self.site_stats[domain] = SiteStats()
-
-                    child_sitemaps = self.process_master_sitemap(master_url)
-                    total_child_sitemaps += len(child_sitemaps)
-
-                    # Фильтруем дочерние sitemap перед обработкой
-                    filtered_child_sitemaps = []
-                    excluded_count = 0
-
-                    for url in child_sitemaps:
-                        if self.should_exclude_sitemap(url):
-                            excluded_count += 1
-                            logger.debug(f"Исключаю sitemap из обработки: {url}")
-                        else:
-                            filtered_child_sitemaps.append(url)
-
-                    if excluded_count > 0:
-                        logger.info(f"Исключено {excluded_count} sitemap из обработки")
-
-                    logger.info(f"Начинаю обработку {len(filtered_child_sitemaps)} дочерних sitemap для {domain}")
-
-                    # Обрабатываем отфильтрованные дочерние sitemaps в многопоточном режиме
-                    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                        future_to_url = {executor.submit(self.process_child_sitemap, url): url for url in filtered_child_sitemaps}
-
-                        completed = 0
-                        for future in as_completed(future_to_url):
-                            url = future_to_url[future]
-                            completed += 1
-                            try:
-                                page_count = future.result()
-                                total_pages += page_count
-                                logger.info(f"Прогресс: {completed}/{len(filtered_child_sitemaps)} sitemap обработано ({completed/len(filtered_child_sitemaps)*100:.1f}%)")
-                            except Exception as e:
-                                logger.error(f"Ошибка при обработке {url}: {e}")
-
-                    # Выводим статистику по домену в рамке
-                    print_stats_box(domain, self.site_stats[domain])
-
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке домена {domain}: {e}", exc_info=True)
-                    failed_domains.append(domain)
+                self.site_stats[get_domain(master_url)] = SiteStats()
+
+            # Домены обрабатываются в отдельных процессах (разбор XML и дат не делит GIL),
+            # внутри домена - не больше MAX_WORKERS потоков
+            with ProcessPoolExecutor(max_workers=MAX_DOMAIN_WORKERS, initializer=init_domain_worker) as domain_executor:
+                future_to_domain = {
+                    domain_executor.submit(process_domain_in_worker, master_url): get_domain(master_url)
+                    for master_url in master_urls
+                }
+                total_domains = len(future_to_domain)
+
+                for future in as_completed(future_to_domain):
+                    domain = future_to_domain[future]
+                    try:
+                        child_count, page_count, worker_stats = future.result()
+                        total_child_sitemaps += child_count
+                        total_pages += page_count
+                        for stats_domain, stats in worker_stats.items():
+                            self.site_stats[stats_domain].merge(SiteStats.from_tuple(stats))
+                    except Exception as e:
+                        logger.error(f"Ошибка при обработке домена {domain}: {e}", exc_info=True)
+                        failed_domains.append(domain)
 
             # Итоговая статистика
             logger.info("=" * 80)
@@ -1072,32 +1209,53 @@ class SitemapProcessor:
         # Заголовки столбцов
         headers = ["Domain", "Sitemaps processed", "Pages added", "Pages skipped", "Date from", "Date to"]
 
-        # Выводим таблицу
+        # Выводим таблицу; рамки grid для больших таблиц слишком дороги, их выводим в формате plain
+        tablefmt = "grid" if len(table_data) < LARGE_TABLE_ROWS else "plain"
         print("\n" + "=" * 100)
-        print(tabulate(table_data, headers=headers, tablefmt="grid"))
+        print(tabulate(table_data, headers=headers, tablefmt=tablefmt))
         print("=" * 100 + "\n")
 
     def is_new_domain(self, domain: str) -> bool:
         """
         Проверяет, является ли домен новым (отсутствующим в базе данных).
         Возвращает True, если домен новый, иначе False.
+        Для доменов, загруженных в кэш свежести, ответ берется из кэша без запроса к БД.
         """
-        with self.get_connection() as conn:
+        if domain in self.cached_domains:
+            return domain in self.new_domains
+
+        with self.get_connection(autocommit=True) as conn:
             with conn.cursor() as cursor:
                 try:
-                    cursor.execute(
-                        "SELECT COUNT(*) FROM sitemaps WHERE domain = %s",
-                        (domain,)
-                    )
-                    result = cursor.fetchone()
+                    cursor.execute("EXECUTE domain_exists_stmt (%s)", (domain,))
 
-                    # Если количество записей > 0, то домен уже существует
-                    return result[0] == 0
+                    # Если в базе есть хотя бы один sitemap домена, то домен уже существует
+                    return not cursor.fetchone()[0]
                 except psycopg2.Error as e:
                     logger.error(f"Error checking if domain {domain} is new: {e}")
                     # В случае ошибки считаем домен существующим (более безопасное поведение)
                     return False
 
+# Обработчик доменов процесса-воркера: подключения к БД и HTTP-клиент между процессами не передаются
+domain_worker = None
+
+def init_domain_worker():
+    """Создать SitemapProcessor при запуске процесса-воркера."""
+    global domain_worker
+    domain_worker = SitemapProcessor()
+
+def process_domain_in_worker(master_url: str) -> tuple:
+    """
+    Обработать мастер-sitemap в процессе-воркере.
+    Возвращает счетчики и статистику по всем затронутым доменам (дочерние sitemap могут быть на других хостах).
+    """
+    domain_worker.site_stats.clear()
+    child_count, page_count = domain_worker.process_domain(master_url)
+    # Статистика передается кортежами чисел, а не датаклассами с datetime
+    return child_count, page_count, {
+        domain: stats.to_tuple() for domain, stats in domain_worker.site_stats.items()
+    }
+
 def main():
     """Основная функция программы."""
     start_time = time.time()
@@ -1105,12 +1263,17 @@ def main():
     logger.info("Запуск парсера sitemap")
     logger.info(f"Минимальная дата для новостей: {get_min_date().strftime('%Y-%m-%d')}")
 
+    processor = None
     try:
-        processor = SitemapProcessor()
+        # Родительский процесс только распределяет домены, подключения открывают воркеры
+        processor = SitemapProcessor(connect=False)
         processor.process_master_sitemaps_file(SITEMAP_FILE_PATH)
     except Exception as e:
         logger.error(f"Критическая ошибка при выполнении программы: {e}", exc_info=True)
     finally:
+        if processor is not None:
+            processor.close()
+
         end_time = time.time()
         execution_time = end_time - start_time
 
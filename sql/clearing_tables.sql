@@ -1 +1 @@
-TRUNCATE TABLE content_embeddings, news_pages_content, news_pages, sitemaps RESTART IDENTITY CASCADE;
+TRUNCATE TABLE embedding_cache, content_embeddings, news_pages_content, news_pages, sitemaps RESTART IDENTITY CASCADE;
@@ -38,6 +38,7 @@ CREATE TABLE public.news_pages_content (
 	page_url TEXT NULL,
 	publication_date TIMESTAMP WITH TIME ZONE NULL,
 	page_raw_content text NULL,
+	raw_lz4 bytea NULL,
 	"content" text NULL,
 	content_length integer NULL,
 	fetched_at timestamptz DEFAULT now() NULL,
@@ -50,18 +51,36 @@ CREATE INDEX idx_news_pages_content_id_page ON public.news_pages_content USING b
 CREATE INDEX idx_news_pages_content_page_url ON public.news_pages_content USING btree (page_url);
 CREATE INDEX idx_news_pages_content_publication_date ON public.news_pages_content USING btree (publication_date);
 CREATE INDEX idx_news_pages_content_length ON public.news_pages_content USING btree (content_length);
+-- Частичный индекс для выборки свежего контента без эмбеддингов (порог совпадает с CONTENT_MIN_LENGTH)
+CREATE INDEX IF NOT EXISTS idx_news_pages_content_embedding_candidates ON public.news_pages_content USING btree (publication_date DESC) WHERE length(content) >= 500;
+
+-- Сырой HTML хранится сжатым LZ4 на стороне приложения, повторное сжатие TOAST не требуется
+-- (для существующих баз колонка добавляется этими же командами)
+ALTER TABLE public.news_pages_content ADD COLUMN IF NOT EXISTS raw_lz4 bytea NULL;
+ALTER TABLE public.news_pages_content ALTER COLUMN raw_lz4 SET STORAGE EXTERNAL;
 
 -- Создание расширения pgvector для работы с векторными эмбеддингами
 CREATE EXTENSION IF NOT EXISTS vector;
 
 -- Создание таблицы для хранения эмбеддингов контента
+-- Эмбеддинги хранятся в половинной точности (halfvec, pgvector >= 0.7)
+-- Для существующих баз: ALTER TABLE public.content_embeddings ALTER COLUMN embedding TYPE halfvec(1536);
+--                       ALTER TABLE public.embedding_cache ALTER COLUMN embedding TYPE halfvec(1536);
 CREATE TABLE IF NOT EXISTS public.content_embeddings (
     id serial4 NOT NULL,
     id_page int4 NOT NULL,
-    embedding vector(1536) NULL,
+    embedding halfvec(1536) NULL,
     CONSTRAINT content_embeddings_pkey PRIMARY KEY (id),
     CONSTRAINT content_embeddings_id_page_key UNIQUE (id_page),
     CONSTRAINT content_embeddings_id_page_fkey FOREIGN KEY (id_page) REFERENCES public.news_pages(id_page)
 );
 
 CREATE INDEX idx_content_embeddings_id_page ON public.content_embeddings USING btree (id_page);
+
+-- Кэш эмбеддингов по SHA-256 хэшу отправляемого в API текста
+CREATE TABLE IF NOT EXISTS public.embedding_cache (
+    content_hash bytea NOT NULL,
+    embedding halfvec(1536) NOT NULL,
+    created_at timestamptz DEFAULT now() NULL,
+    CONSTRAINT embedding_cache_pkey PRIMARY KEY (content_hash)
+);
@@ -1,3 +1,4 @@
+DROP TABLE IF EXISTS embedding_cache CASCADE;
 DROP TABLE IF EXISTS content_embeddings CASCADE;
 DROP TABLE IF EXISTS news_pages_content CASCADE;
 DROP TABLE IF EXISTS news_pages, sitemaps CASCADE;
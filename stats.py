@@ -4,13 +4,19 @@ import configparser
 import psycopg2
 from tabulate import tabulate
 from datetime import datetime
+from functools import lru_cache
 
 # Константы
 CONFIG_PATH = "config/config.ini"
 CONFIG_SECTION_DB = "RSS-News.postgres_local"
+# Количество строк, забираемых с сервера за раз при потоковом чтении результатов
+STREAM_ITERSIZE = 2000
+# Начиная с этого количества строк таблицы выводятся без рамок
+LARGE_TABLE_ROWS = 1000
 
+@lru_cache(maxsize=1)
 def load_config():
-    """Загрузка конфигурации из файла"""
+    """Загрузка конфигурации из файла (файл читается один раз за процесс)"""
     config = configparser.ConfigParser()
     config.read(CONFIG_PATH)
 
@@ -28,13 +34,38 @@ def connect_to_db(db_config):
     """Создание подключения к БД"""
     return psycopg2.connect(**db_config)
 
-def execute_query(conn, query):
-    """Выполнение SQL-запроса и получение результатов"""
-    with conn.cursor() as cursor:
-        cursor.execute(query)
-        columns = [desc[0] for desc in cursor.description]
-        results = cursor.fetchall()
-        return columns, results
+def execute_query(conn, query, stream=False):
+    """
+    Выполнение SQL-запроса и получение результатов.
+    При stream=True строки читаются серверным курсором порциями по STREAM_ITERSIZE и отдаются генератором
+    """
+    if not stream:
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+            columns = [desc[0] for desc in cursor.description]
+            results = cursor.fetchall()
+            return columns, results
+
+    cursor = conn.cursor(name="stats_cursor")
+    cursor.itersize = STREAM_ITERSIZE
+    cursor.execute(query)
+    # У серверного курсора описание колонок появляется только после первой выборки
+    first_row = cursor.fetchone()
+    columns = [desc[0] for desc in cursor.description]
+    return columns, iterate_rows(cursor, first_row)
+
+def iterate_rows(cursor, first_row):
+    """Генератор строк серверного курсора; курсор закрывается после чтения"""
+    try:
+        if first_row is not None:
+            yield first_row
+        yield from cursor
+    finally:
+        cursor.close()
+
+def table_format(rows):
+    """Формат таблицы: pretty для небольших таблиц, plain для больших (рамки pretty дорого строить)"""
+    return "pretty" if len(rows) < LARGE_TABLE_ROWS else "plain"
 
 def show_monthly_stats(conn):
     """Отображение ежемесячной статистики контента по доменам"""
@@ -54,7 +85,7 @@ def show_monthly_stats(conn):
     ORDER BY s.domain, month DESC;
     """
 
-    columns, results = execute_query(conn, query)
+    columns, results = execute_query(conn, query, stream=True)
 
     # Добавляем нумерацию и меняем названия колонок
     numbered_results = []
@@ -65,28 +96,53 @@ def show_monthly_stats(conn):
     colalign = ["right", "left", "right", "right", "right", "right"]
 
     print("\n📊 ПОМЕСЯЧНАЯ СТАТИСТИКА КОНТЕНТА ПО ДОМЕНАМ")
-    print(tabulate(numbered_results, headers=headers, tablefmt="pretty", colalign=colalign))
+    print(tabulate(numbered_results, headers=headers, tablefmt=table_format(numbered_results), colalign=colalign))
 
 def show_domain_stats(conn):
     """Отображение общей статистики страниц по доменам"""
+    # Каждая таблица агрегируется по sitemap отдельно, затем агрегаты соединяются:
+    # без общего соединения трех таблиц и COUNT(DISTINCT) над ним.
+    # octet_length читает только заголовок значения, без распаковки TOAST
     query = """
+    WITH pages AS (
+        SELECT id_sitemap, COUNT(*) AS total_pages
+        FROM news_pages
+        GROUP BY id_sitemap
+    ), content AS (
+        SELECT
+            np.id_sitemap,
+            COUNT(*) AS parsed_pages,
+            COUNT(*) FILTER (WHERE octet_length(npc.content) > 0) AS non_empty_pages
+        FROM news_pages_content npc
+        JOIN news_pages np ON np.id_page = npc.id_page
+        GROUP BY np.id_sitemap
+    ), embeddings AS (
+        SELECT
+            np.id_sitemap,
+            COUNT(*) AS embedded_pages,
+            MIN(np.publication_date) AS min_publication_date,
+            MAX(np.publication_date) AS max_publication_date
+        FROM content_embeddings ce
+        JOIN news_pages np ON np.id_page = ce.id_page
+        GROUP BY np.id_sitemap
+    )
     SELECT
         s.domain,
-        COUNT(np.id_page) AS total_pages,
-        COUNT(npc.id_page) AS pages_in_news_pages_content,
-        COUNT(CASE WHEN npc.content IS NOT NULL AND npc.content <> '' THEN 1 END) AS pages_with_non_empty_content,
-        COUNT(DISTINCT ce.id_page) AS pages_with_embeddings,
-        MIN(np.publication_date) FILTER (WHERE ce.id_page IS NOT NULL)::date AS min_publication_date,
-        MAX(np.publication_date) FILTER (WHERE ce.id_page IS NOT NULL)::date AS max_publication_date
+        SUM(p.total_pages)::bigint AS total_pages,
+        COALESCE(SUM(c.parsed_pages), 0)::bigint AS pages_in_news_pages_content,
+        COALESCE(SUM(c.non_empty_pages), 0)::bigint AS pages_with_non_empty_content,
+        COALESCE(SUM(e.embedded_pages), 0)::bigint AS pages_with_embeddings,
+        MIN(e.min_publication_date)::date AS min_publication_date,
+        MAX(e.max_publication_date)::date AS max_publication_date
     FROM sitemaps s
-    JOIN news_pages np ON s.id_sitemap = np.id_sitemap
-    LEFT JOIN news_pages_content npc ON np.id_page = npc.id_page
-    LEFT JOIN content_embeddings ce ON np.id_page = ce.id_page
+    JOIN pages p ON p.id_sitemap = s.id_sitemap
+    LEFT JOIN content c ON c.id_sitemap = s.id_sitemap
+    LEFT JOIN embeddings e ON e.id_sitemap = s.id_sitemap
     GROUP BY s.domain
     ORDER BY s.domain;
     """
 
-    columns, results = execute_query(conn, query)
+    columns, results = execute_query(conn, query, stream=True)
 
     # Добавляем нумерацию и меняем названия колонок
     numbered_results = []
@@ -99,22 +155,34 @@ def show_domain_stats(conn):
     colalign = ["right", "left", "right", "right", "right", "right", "right", "right"]
 
     print("\n📈 ОБЩАЯ СТАТИСТИКА СТРАНИЦ ПО ДОМЕНАМ")
-    print(tabulate(numbered_results, headers=headers, tablefmt="pretty", colalign=colalign))
+    print(tabulate(numbered_results, headers=headers, tablefmt=table_format(numbered_results), colalign=colalign))
 
 def show_summary_stats(conn):
     """Отображение общей итоговой статистики по всем доменам"""
+    # Каждая страница принадлежит sitemap (id_sitemap NOT NULL), поэтому таблицы
+    # считаются по отдельности, без соединения с sitemaps
     query = """
+    WITH content AS (
+        SELECT
+            COUNT(*) AS parsed_pages,
+            COUNT(*) FILTER (WHERE octet_length(content) > 0) AS non_empty_pages
+        FROM news_pages_content
+    ), embeddings AS (
+        SELECT
+            COUNT(*) AS embedded_pages,
+            MIN(np.publication_date)::date AS min_publication_date,
+            MAX(np.publication_date)::date AS max_publication_date
+        FROM content_embeddings ce
+        JOIN news_pages np ON np.id_page = ce.id_page
+    )
     SELECT
-        COUNT(np.id_page) AS total_pages,
-        COUNT(npc.id_page) AS pages_in_news_pages_content,
-        COUNT(CASE WHEN npc.content IS NOT NULL AND npc.content <> '' THEN 1 END) AS pages_with_non_empty_content,
-        COUNT(DISTINCT ce.id_page) AS pages_with_embeddings,
-        MIN(np.publication_date) FILTER (WHERE ce.id_page IS NOT NULL)::date AS min_publication_date,
-        MAX(np.publication_date) FILTER (WHERE ce.id_page IS NOT NULL)::date AS max_publication_date
-    FROM sitemaps s
-    JOIN news_pages np ON s.id_sitemap = np.id_sitemap
-    LEFT JOIN news_pages_content npc ON np.id_page = npc.id_page
-    LEFT JOIN content_embeddings ce ON np.id_page = ce.id_page;
+        (SELECT COUNT(*) FROM news_pages) AS total_pages,
+        c.parsed_pages AS pages_in_news_pages_content,
+        c.non_empty_pages AS pages_with_non_empty_content,
+        e.embedded_pages AS pages_with_embeddings,
+        e.min_publication_date,
+        e.max_publication_date
+    FROM content c, embeddings e;
     """
 
     columns, results = execute_query(conn, query)